@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+'''Equivalence check and micro-benchmark of cookie propagation.
+
+Usage: PYTHONPATH=. python bench/cookies.py [-n iterations] [corpus...]
+
+Corpus files hold Set-Cookie headers captured from the remote host, each
+response preceded by a line with the request path and separated by blank lines:
+
+    /browse/PHPBB3-1
+    Set-Cookie: JSESSIONID=0123456789ABCDEF; Path=/; HttpOnly
+    Set-Cookie: atlassian.xsrf.token=B4RT-...|lin; Path=/
+
+Without corpus files a synthetic corpus of JIRA cookies and edge cases is used.
+
+Set-Cookie headers sent to clients by the former propagation, through
+cookielib.CookieJar and Cookie.SimpleCookie, are compared with those sent
+by tools.set_cookie. Differences which are intended, see tools/set_cookie.py,
+are counted by kind for each cookie; other differences are printed and make the exit status 1.
+Then both are timed, together with responses for public paths whose
+cookies are no longer parsed at all.
+'''
+
+import sys, time, calendar, getopt, re, cookielib, urllib2, mimetools, Cookie, cStringIO
+
+from tools import set_cookie
+
+remote_host = 'tracker.phpbb.com'
+
+SYNTHETIC_CORPUS = '''/browse/PHPBB3-1
+Set-Cookie: JSESSIONID=0123456789ABCDEF0123456789ABCDEF; Path=/; HttpOnly
+Set-Cookie: atlassian.xsrf.token=B4RT-U2VR-5EA2-N9TH|0123456789abcdef0123456789abcdef01234567|lout; Path=/
+
+/login.jsp
+Set-Cookie: JSESSIONID=FEDCBA9876543210FEDCBA9876543210; Path=/; HttpOnly
+Set-Cookie: seraph.rememberme.cookie=12345%3A0123456789abcdef; Expires=Sun, 18 Oct 2037 10:00:00 GMT; Path=/; HttpOnly
+Set-Cookie: atlassian.xsrf.token=B4RT-U2VR-5EA2-N9TH|0123456789abcdef0123456789abcdef01234567|lin; Path=/
+
+/secure/Logout!default.jspa
+Set-Cookie: seraph.rememberme.cookie=""; Expires=Thu, 01 Jan 1970 00:00:00 GMT; Path=/
+
+/secure/Dashboard.jspa
+Set-Cookie: jira.conglomerate.cookie="|jira.toggleblocks.cong.cookie=com.atlassian.jira.plugin"; Max-Age=31536000; Path=/
+Set-Cookie: remember=YWJjZGVm/Z2hp==; Max-Age=3600; Path=/; secure; httponly
+
+/browse/PHPBB3-2
+Set-Cookie: session=abc; Domain=.phpbb.com; Path=/
+Set-Cookie: tracking=1; Domain=.example.com; Path=/
+
+/rest/api/2/issue/PHPBB3-3
+Set-Cookie: lang=en_US
+Set-Cookie: badage=1; Max-Age=soon
+Set-Cookie: flag
+
+/s/en_USabc123/6346/1/_/images/icons/bug.gif
+Set-Cookie: JSESSIONID=0123456789ABCDEF0123456789ABCDEF; Path=/; HttpOnly
+'''
+
+class CapturedResponse:
+    def __init__(self, values):
+        self._info = mimetools.Message(cStringIO.StringIO(''.join(['Set-Cookie: %s\r\n' % value for value in values]) + '\r\n'))
+    
+    def info(self):
+        return self._info
+
+def parse_corpus(text):
+    '''Returns a list of (path, set-cookie values) of responses in text'''
+    
+    responses = []
+    for block in text.replace('\r\n', '\n').split('\n\n'):
+        lines = [line for line in block.split('\n') if line.strip()]
+        if not lines:
+            continue
+        values = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep and name.strip().lower() == 'set-cookie':
+                values.append(value.strip())
+        responses.append((lines[0].strip(), values))
+    return responses
+
+def former_headers(path, values):
+    # cookie handling of BaseProxy before tools.set_cookie
+    jar = cookielib.CookieJar()
+    jar.extract_cookies(CapturedResponse(values), urllib2.Request('http://' + remote_host + path))
+    cookies = Cookie.SimpleCookie()
+    now = int(time.time())
+    for cookie in jar:
+        cookies[cookie.name] = cookie.value
+        morsel = cookies[cookie.name]
+        if cookie.secure:
+            morsel['secure'] = cookie.secure
+        if cookie.path:
+            morsel['path'] = cookie.path
+        if cookie.expires:
+            morsel['expires'] = cookie.expires - now
+        if cookie.get_nonstandard_attr('httponly', False) != False:
+            morsel['httponly'] = cookie.get_nonstandard_attr('httponly')
+    output = cookies.output()
+    if not output:
+        return []
+    return output.split('\r\n')
+
+def current_headers(path, values):
+    cookies = []
+    for value in CapturedResponse(values).info().getheaders('set-cookie'):
+        cookie = set_cookie.parse(value, remote_host, path)
+        if cookie is not None:
+            cookies.append(cookie)
+    if not cookies:
+        return []
+    return set_cookie.SetCookieHeaders(cookies).output().split('\r\n')
+
+expires_re = re.compile(r'expires=([^;]*)')
+
+def split_expires(header):
+    # returns header without its expiration date, and the date
+    match = expires_re.search(header)
+    if match is None:
+        return header, None
+    return header[:match.start()] + header[match.end():], calendar.timegm(time.strptime(match.group(1), '%a, %d %b %Y %H:%M:%S GMT'))
+
+def same(former, current):
+    former, former_expires = split_expires(former)
+    current, current_expires = split_expires(current)
+    if former != current:
+        return False
+    if former_expires is None or current_expires is None:
+        return former_expires == current_expires
+    # expiration dates of the former propagation may be a second late
+    return abs(former_expires - current_expires) <= 1
+
+def by_name(headers):
+    cookies = {}
+    for header in headers:
+        cookies[header[len('Set-Cookie: '):].split('=', 1)[0]] = header
+    return cookies
+
+def difference(former, current):
+    '''Returns kind of an intended difference between headers of
+    a cookie, either of which may be None, or None if the difference is not intended'''
+    
+    if former is None:
+        if current is not None and split_expires(current)[1] < time.time():
+            return 'deletion passed on'
+        return None
+    if current is None:
+        if former.split('; ')[0].endswith('=None'):
+            return 'cookie without value dropped'
+        return None
+    if same(former, current.replace('; httponly', '')):
+        return 'httponly kept'
+    if same(former.replace('\\"', '').replace('"', ''), current.replace('"', '')):
+        return 'value not quoted'
+    return None
+
+def check(responses):
+    '''Compares former and current headers of responses, returning
+    the number of unintended differences'''
+    
+    identical = unexpected = 0
+    intended = {}
+    for path, values in responses:
+        former = by_name(former_headers(path, values))
+        current = by_name(current_headers(path, values))
+        for name in sorted(set(former.keys() + current.keys())):
+            if former.has_key(name) and current.has_key(name) and same(former[name], current[name]):
+                identical += 1
+                continue
+            kind = difference(former.get(name), current.get(name))
+            if kind is None:
+                unexpected += 1
+                print 'difference in cookie %s for %s:\n  former  %r\n  current %r' % (name, path, former.get(name), current.get(name))
+            else:
+                intended[kind] = intended.get(kind, 0) + 1
+    print '%d cookie(s) identical, %s' % (identical,
+        ', '.join(['%d %s' % (count, kind) for kind, count in sorted(intended.items())]) or 'no intended differences')
+    return unexpected
+
+def measure(label, func, responses, iterations):
+    start = time.time()
+    for i in range(iterations):
+        for path, values in responses:
+            func(path, values)
+    elapsed = time.time() - start
+    print '%-28s %8.2f us/response' % (label, elapsed * 1000000 / iterations / len(responses))
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'n:')
+    iterations = 2000
+    for opt, value in opts:
+        if opt == '-n':
+            iterations = int(value)
+    
+    if args:
+        responses = []
+        for path in args:
+            responses.extend(parse_corpus(open(path).read()))
+    else:
+        responses = parse_corpus(SYNTHETIC_CORPUS)
+    
+    unexpected = check(responses)
+    
+    from issues import proxy
+    
+    public_paths_re = proxy.Proxy.public_paths_re
+    measure('cookielib and Cookie', former_headers, responses, iterations)
+    measure('set_cookie', current_headers, responses, iterations)
+    measure('set_cookie, public skipped', lambda path, values: public_paths_re.match(path) or current_headers(path, values),
+        responses, iterations)
+    if unexpected:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
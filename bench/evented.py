@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+'''Concurrent requests for a single page through the evented server.
+
+Usage: PYTHONPATH=. python bench/evented.py [-c clients] [-d delay] [-r rounds]
+
+Starts a fake JIRA server (see fake_jira.py) answering after delay seconds
+(default 0.2) and an evented server with the cache enabled, then sends
+-c concurrent requests (default 20) for the same page, each over
+a connection of its own, and reports how long the slowest one took.
+
+Requests for a cacheable issue page share a single remote request.
+Requests for a page which is not cached, json with no-store, wait for
+the first one to find out and then fetch it on their own, so all of them
+should be done in about two delays rather than one delay per request.
+Remote requests are not capped below the number of clients.
+'''
+
+import sys, os, time, getopt, signal, tempfile, shutil, threading, httplib
+import cherrypy
+
+import fake_jira
+
+remote_port = 18971
+local_port = 18972
+
+CASES = [
+    ('cacheable', '/browse/PROJ-%d'),
+    ('uncacheable', '/rest/api/2/issue/PROJ-%d'),
+]
+
+def run_server(cache_dir):
+    from issues import environment, evented_server
+    
+    cherrypy.config.update({
+        'remote.host': '127.0.0.1:%d' % remote_port,
+        'local.cache.enabled': True,
+        'local.cache.dir': cache_dir,
+        'remote.pool.max_connections': 1000,
+        'log.screen': False,
+        'engine.autoreload.on': False,
+        'checker.on': False,
+    })
+    environment.setup(cache_dir, plugins=False)
+    server = evented_server.EventedServer('127.0.0.1', local_port)
+    try:
+        server.serve_forever()
+    finally:
+        server.tasks.stop()
+
+def fork_server(cache_dir):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_server(cache_dir)
+        finally:
+            os._exit(0)
+    fake_jira.wait_for_port(local_port)
+    return pid
+
+def get(path, statuses, lock):
+    connection = httplib.HTTPConnection('127.0.0.1', local_port, timeout=60)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        status = response.status
+    except Exception, e:
+        status = e.__class__.__name__
+    connection.close()
+    lock.acquire()
+    try:
+        statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        lock.release()
+
+def measure(path, clients):
+    '''Returns seconds taken by clients concurrent requests for path, and their statuses'''
+    
+    statuses = {}
+    lock = threading.Lock()
+    threads = [threading.Thread(target=get, args=(path, statuses, lock)) for i in range(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started, statuses
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'c:d:r:')
+    clients = 20
+    delay = 0.2
+    rounds = 3
+    for opt, value in opts:
+        if opt == '-c':
+            clients = int(value)
+        elif opt == '-d':
+            delay = float(value)
+        elif opt == '-r':
+            rounds = int(value)
+    
+    cache_dir = tempfile.mkdtemp()
+    remote_pid = fake_jira.fork_server(remote_port, delay=delay)
+    try:
+        local_pid = fork_server(cache_dir)
+        try:
+            print '%d concurrent requests, remote host answering after %.3f s' % (clients, delay)
+            print '%-12s %9s %9s  %s' % ('page', 'seconds', 'delays', 'statuses')
+            for name, path in CASES:
+                for i in range(rounds):
+                    # a page of its own in each round, so that cacheable pages are misses
+                    elapsed, statuses = measure(path % i, clients)
+                    print '%-12s %9.3f %9.1f  %s' % (name, elapsed, elapsed / delay,
+                        ' '.join(['%s:%d' % item for item in sorted(statuses.items())]))
+        finally:
+            os.kill(local_pid, signal.SIGTERM)
+            os.waitpid(local_pid, 0)
+    finally:
+        fake_jira.stop_server(remote_pid)
+        shutil.rmtree(cache_dir)
+
+if __name__ == '__main__':
+    main()
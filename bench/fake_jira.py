@@ -0,0 +1,166 @@
+'''Stand-in for a JIRA server, for benchmarks.
+
+Serves responses resembling those of JIRA under the paths the proxy sees,
+with bodies of configurable sizes:
+
+/browse/PROJ-N          html issue page, public, max-age, sets a cookie
+/browse/PROJ-N?private  html issue page, private, sets a session cookie
+/si/jira.issueviews:issue-xml/PROJ-N/PROJ-N.xml
+                        xml issue view, public with an Expires header
+/rest/api/2/issue/PROJ-N
+                        json, no-cache and no-store
+/s/N/_/styles.css       stylesheet, cacheable for a year
+/secure/Dashboard.jspa  redirect to the login page
+
+Bodies of html, xml and json responses link back to the server's host,
+so that the proxy has links to rewrite.
+'''
+
+import os, time, signal, socket, email.utils
+import BaseHTTPServer, SocketServer
+
+DEFAULT_SIZES = dict(html=60000, xml=30000, json=8000, css=20000)
+
+def make_body(kind, host, size, issue):
+    if kind == 'html':
+        head = '<html><head><title>[PROJ-%d] Issue</title><!-- page header --></head><body>' % issue
+        block = '''<div class="issue"><a href="http://%(host)s/browse/PROJ-%(i)d">PROJ-%(i)d</a>
+<!-- activity block %(i)d -->
+<img src="http://%(host)s/images/icons/bug.gif"/> Summary of issue %(i)d with some text</div>
+'''
+        tail = '</body></html>'
+    elif kind == 'xml':
+        head = '<?xml version="1.0" encoding="UTF-8"?><rss version="0.92"><channel><item>'
+        block = '<comment id="%(i)d"><link>http://%(host)s/browse/PROJ-%(i)d</link><body>Comment %(i)d text</body></comment>\n'
+        tail = '</item></channel></rss>'
+    elif kind == 'json':
+        head = '{"key": "PROJ-%d", "fields": {"comments": [' % issue
+        block = '{"id": %(i)d, "self": "http://%(host)s/rest/api/2/issue/PROJ-%(i)d/comment/%(i)d", "body": "Comment text"},'
+        tail = '{}]}}'
+    else:
+        head = '/* styles */\n'
+        block = '.issue-%(i)d { background: url(/images/icons/bug.gif); color: #333 }\n'
+        tail = ''
+    parts = [head]
+    length = len(head) + len(tail)
+    i = 0
+    while length < size:
+        part = block % dict(host=host, i=i)
+        parts.append(part)
+        length += len(part)
+        i += 1
+    parts.append(tail)
+    return ''.join(parts)
+
+class FakeJiraHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send responses in as few packets as possible; writing headers one
+    # by one with nagle's algorithm on stalls keep-alive clients on delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    
+    def do_GET(self):
+        if self.server.delay:
+            # time the real remote host takes to render a page
+            time.sleep(self.server.delay)
+        path, query = (self.path.split('?', 1) + [''])[:2]
+        host = self.server.host
+        headers = []
+        if path.startswith('/browse/'):
+            issue = self._issue(path)
+            content_type = 'text/html; charset=UTF-8'
+            body = self.server.body('html', issue)
+            if query.startswith('private'):
+                headers.append(('Cache-Control', 'private, no-cache'))
+                headers.append(('Set-Cookie', 'JSESSIONID=%x; Path=/; HttpOnly' % issue))
+            else:
+                headers.append(('Cache-Control', 'public, max-age=300'))
+                headers.append(('Set-Cookie', 'atlassian.xsrf.token=B2%x|lout; Path=/' % issue))
+        elif path.startswith('/si/'):
+            content_type = 'text/xml; charset=UTF-8'
+            body = self.server.body('xml', self._issue(path.split('/')[-1][:-4]))
+            headers.append(('Cache-Control', 'public'))
+            headers.append(('Expires', email.utils.formatdate(time.time() + 3600, usegmt=True)))
+        elif path.startswith('/rest/'):
+            content_type = 'application/json;charset=UTF-8'
+            body = self.server.body('json', self._issue(path))
+            headers.append(('Cache-Control', 'no-cache, no-store, no-transform'))
+        elif path.startswith('/s/'):
+            content_type = 'text/css'
+            body = self.server.body('css', 0)
+            headers.append(('Cache-Control', 'public, max-age=31536000'))
+        elif path == '/secure/Dashboard.jspa':
+            self.send_response(302)
+            self.send_header('Location', 'http://%s/login.jsp?os_destination=%%2Fsecure%%2FDashboard.jspa' % host)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        else:
+            self.send_error(404)
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _issue(self, path):
+        try:
+            return int(path.rstrip('/').split('-')[-1])
+        except ValueError:
+            return 0
+    
+    def log_message(self, *args):
+        pass
+
+class FakeJiraServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+    
+    def __init__(self, port, sizes=None, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), FakeJiraHandler)
+        self.host = '127.0.0.1:%d' % port
+        self.delay = delay
+        self.sizes = dict(DEFAULT_SIZES)
+        self.sizes.update(sizes or {})
+        self._bodies = {}
+    
+    def body(self, kind, issue):
+        # bodies differ per issue only in the title, a few variants will do
+        key = (kind, issue % 10)
+        body = self._bodies.get(key)
+        if body is None:
+            body = self._bodies[key] = make_body(kind, self.host, self.sizes[kind], issue % 10)
+        return body
+
+def fork_server(port, sizes=None, delay=0):
+    '''Runs a fake JIRA server on port in a child process, returning its pid
+    once the server accepts connections. Responses are delayed by delay seconds.'''
+    
+    pid = os.fork()
+    if pid == 0:
+        try:
+            FakeJiraServer(port, sizes, delay).serve_forever()
+        finally:
+            os._exit(0)
+    wait_for_port(port)
+    return pid
+
+def stop_server(pid):
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
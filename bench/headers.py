@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+'''Micro-benchmark of response header processing.
+
+Usage: PYTHONPATH=. python bench/headers.py [-n iterations] corpus...
+
+Corpus files hold response headers captured from the remote host, each
+preceded by a line with the request path and separated by blank lines:
+
+    /browse/PHPBB3-1
+    HTTP/1.1 200 OK
+    Content-Type: text/html;charset=UTF-8
+    Cache-Control: no-cache, no-store
+    ...
+
+e.g. built with `(echo /browse/PHPBB3-1; curl -s -D - -o /dev/null
+http://tracker.phpbb.com/browse/PHPBB3-1) >> corpus.txt`. Without corpus
+files a synthetic corpus of typical JIRA responses is used.
+
+Compares the former header stages, which split Cache-Control in every
+stage and parsed dates with time.strptime, with those of the proxy,
+checking that both give the same caching headers and expiration times.
+'''
+
+import sys, time, calendar, getopt
+import cherrypy
+
+remote_host = 'tracker.phpbb.com'
+
+SYNTHETIC_CORPUS = '''/browse/PHPBB3-1
+HTTP/1.1 200 OK
+Content-Type: text/html;charset=UTF-8
+Cache-Control: no-cache, no-store, must-revalidate
+Pragma: no-cache
+Expires: Thu, 01 Jan 1970 00:00:00 GMT
+
+/s/en_USabc123/6346/1/1.0/_/download/batch/jira.webresources:global-static/jira.webresources:global-static.css
+HTTP/1.1 200 OK
+Content-Type: text/css;charset=UTF-8
+Cache-Control: max-age=31536000, private
+Expires: Sun, 18 Oct 2037 10:00:00 GMT
+Last-Modified: Mon, 01 Jan 2024 00:00:00 GMT
+ETag: "1704067200000"
+
+/s/en_USabc123/6346/1/_/images/icons/bug.gif
+HTTP/1.1 200 OK
+Content-Type: image/gif
+Cache-Control: public
+Expires: Sun, 18 Oct 2037 10:00:00 GMT
+Last-Modified: Mon, 01 Jan 2024 00:00:00 GMT
+
+/images/icons/priority_major.gif
+HTTP/1.1 200 OK
+Content-Type: image/gif
+Last-Modified: Mon, 01 Jan 2024 00:00:00 GMT
+ETag: W/"203-1704067200000"
+
+/sr/jira.issueviews:searchrequest-rss/temp/SearchRequest.xml
+HTTP/1.1 200 OK
+Content-Type: text/xml;charset=UTF-8
+Cache-Control: public, max-age=300
+Expires: 0
+
+/rest/api/1.0/header-separator
+HTTP/1.1 200 OK
+Content-Type: application/json;charset=UTF-8
+Cache-Control: no-cache, no-store, no-transform
+
+/secure/Dashboard.jspa
+HTTP/1.1 302 Moved Temporarily
+Location: http://tracker.phpbb.com/login.jsp
+Cache-Control: private
+Expires: Thu, 01 Jan 1970 00:00:00 GMT
+
+/browse/PHPBB3-99999
+HTTP/1.1 404 Not Found
+Content-Type: text/html;charset=UTF-8
+Cache-Control: no-cache
+'''
+
+PASS_REMOTE_HEADERS = ('content-type', 'content-disposition', 'location', 'cache-control', 'pragma', 'expires', 'vary', 'etag', 'last-modified', 'content-encoding')
+
+def parse_corpus(text):
+    '''Returns a list of (path, code, headers) of responses in text'''
+    
+    responses = []
+    for block in text.replace('\r\n', '\n').split('\n\n'):
+        lines = [line for line in block.split('\n') if line.strip()]
+        if len(lines) < 2:
+            continue
+        path, status = lines[0].strip(), lines[1].split()
+        headers = {}
+        for line in lines[2:]:
+            name, sep, value = line.partition(':')
+            name = name.strip().lower()
+            if sep and name in PASS_REMOTE_HEADERS:
+                headers[name] = value.strip()
+        responses.append((path, int(status[1]), headers))
+    return responses
+
+# former header stages, with list.delete in make_public fixed
+
+def former_expires_to_timestamp(expires):
+    try:
+        int(expires)
+        return time.time()-86400
+    except:
+        return calendar.timegm(time.strptime(expires, '%a, %d %b %Y %H:%M:%S %Z'))
+
+def former_make_public(h):
+    if h.has_key('cache-control'):
+        cache_control = [part.strip() for part in h['cache-control'].split(',')]
+        if 'private' in cache_control:
+            cache_control.remove('private')
+        if 'public' not in cache_control:
+            cache_control.append('public')
+        cache_control = ', '.join(cache_control)
+    else:
+        cache_control = 'public'
+    h['cache-control'] = cache_control
+
+def former_expiration_time(h):
+    expires_at = None
+    if h.has_key('cache-control'):
+        parts = [part.strip() for part in h['cache-control'].split(',')]
+        for part in parts:
+            if part.startswith('max-age='):
+                expires_at = int(time.time()) + int(part[8:])
+                break
+    if expires_at is None and h.has_key('expires'):
+        expires_at = former_expires_to_timestamp(h['expires'])
+    return expires_at
+
+def former_force_min_expiration(h, time_in_seconds):
+    expires_at = former_expiration_time(h)
+    if expires_at is None or expires_at < int(time.time()) + time_in_seconds:
+        if h.has_key('cache-control'):
+            cache_control = [part.strip() for part in h['cache-control'].split(',')]
+            for part in cache_control:
+                if part.startswith('max-age='):
+                    cache_control.remove(part)
+                    break
+        else:
+            cache_control = []
+        cache_control.append('max-age=%d' % time_in_seconds)
+        h['cache-control'] = ', '.join(cache_control)
+        if h.has_key('expires'):
+            del h['expires']
+
+def former_adjust_cache_directives(h):
+    public = False
+    if h.get('pragma') == 'no-cache':
+        del h['pragma']
+    if h.has_key('cache-control'):
+        parts = [part.strip() for part in h['cache-control'].split(',')]
+        new_parts = [part for part in parts if part not in ['no-cache', 'no-store']]
+        if len(parts) != len(new_parts):
+            h['cache-control'] = ', '.join(new_parts)
+        public = 'public' in new_parts
+    if h.has_key('expires'):
+        if former_expires_to_timestamp(h['expires']) < time.time():
+            del h['expires']
+    return public
+
+def former_pipeline(path, code, headers, public_paths_re):
+    h = dict(headers)
+    if public_paths_re.match(path):
+        former_make_public(h)
+        former_force_min_expiration(h, 86400)
+    public = former_adjust_cache_directives(h)
+    return h, public, former_expiration_time(h)
+
+def current_pipeline(proxy, path, code, headers):
+    # the response is reused so that creating it is not measured
+    r = proxy._remote_response
+    r.params.path = path
+    r.code = code
+    r.headers = dict(headers)
+    proxy._adjust_response()
+    proxy._adjust_cache_directives()
+    return r.headers, r.public, proxy._determine_response_expiration_time(r)
+
+def normalized(headers):
+    h = dict(headers)
+    if h.has_key('cache-control'):
+        h['cache-control'] = [part.strip().lower() for part in h['cache-control'].split(',') if part.strip()]
+        if not h['cache-control']:
+            del h['cache-control']
+    return h
+
+def measure(label, func, responses, iterations):
+    start = time.time()
+    for i in range(iterations):
+        for path, code, headers in responses:
+            func(path, code, headers)
+    elapsed = time.time() - start
+    count = iterations * len(responses)
+    print '%-24s %8.2f us/response' % (label, elapsed * 1000000 / count)
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'n:')
+    iterations = 2000
+    for opt, value in opts:
+        if opt == '-n':
+            iterations = int(value)
+    
+    if args:
+        responses = []
+        for path in args:
+            responses.extend(parse_corpus(open(path).read()))
+    else:
+        responses = parse_corpus(SYNTHETIC_CORPUS)
+    
+    cherrypy.config.update({'remote.host': remote_host, 'log.screen': False})
+    from issues import base_proxy, proxy as proxy_module
+    from tools import http_headers
+    
+    proxy = proxy_module.Proxy()
+    proxy._params = base_proxy.BaseParameters()
+    proxy._remote_response = proxy.ResponseClass(params=proxy._params)
+    public_paths_re = proxy_module.Proxy.public_paths_re
+    
+    for path, code, headers in responses:
+        former = former_pipeline(path, code, headers, public_paths_re)
+        current = current_pipeline(proxy, path, code, headers)
+        if (normalized(former[0]), former[1], former[2]) != (normalized(current[0]), current[1], current[2]):
+            print 'warning: headers of %s differ:\n  former  %r\n  current %r' % (path, former, current)
+    
+    dates = [headers[name] for path, code, headers in responses
+        for name in ('expires', 'last-modified') if headers.has_key(name) and headers[name] != '0']
+    
+    print '%d response(s), %d date(s)' % (len(responses), len(dates))
+    measure('former stages', lambda path, code, headers: former_pipeline(path, code, headers, public_paths_re),
+        responses, iterations)
+    measure('proxy stages', lambda path, code, headers: current_pipeline(proxy, path, code, headers),
+        responses, iterations)
+    if dates:
+        for label, parse in (('time.strptime', former_expires_to_timestamp), ('parse_http_date', http_headers.parse_http_date)):
+            start = time.time()
+            for i in range(iterations):
+                for date in dates:
+                    parse(date)
+            elapsed = time.time() - start
+            print '%-24s %8.2f us/date' % (label, elapsed * 1000000 / iterations / len(dates))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+'''Micro-benchmark of request parameter handling for large POSTs.
+
+Usage: PYTHONPATH=. python bench/params.py [-n iterations] [-k kilobytes]
+
+Builds form posts of the given size, like a JIRA issue edited with
+a long description, and runs them through the former parameter handling,
+where cherrypy decoded the body and the proxy encoded it again, and through
+MainController._munge_params and BaseProxy._collect_request_parameters,
+which forward the body as received unless a link to this proxy is in it.
+
+Both must send the remote host the same parameters; posts mentioning
+the proxy host take the decoding path and are timed separately.
+'''
+
+import sys, time, getopt, urllib, cgi, cStringIO
+import cherrypy
+from cherrypy import _cprequest, _cpreqbody
+from cherrypy.lib import httputil
+
+remote_host = 'tracker.phpbb.com'
+local_host = 'localhost:8011'
+
+def build_post(kilobytes, mention_host=False):
+    '''Returns urlencoded body of a form post of about kilobytes'''
+    
+    paragraph = 'When replying to a topic with quotes the preview shows "&amp;" for ampersands; 100% reproducible.\n'
+    description = paragraph * (kilobytes * 1024 / len(paragraph) + 1)
+    pairs = [('id', '12345'), ('atl_token', 'B4RT-U2VR-5EA2-N9TH|0123456789abcdef|lin'),
+        ('summary', 'Quotes are escaped twice in preview'), ('description', description)]
+    for i in range(20):
+        pairs.append(('customfield_%d' % (10000 + i), 'value %d' % i))
+    if mention_host:
+        pairs.append(('returnUrl', 'http://%s/browse/PHPBB3-1' % local_host))
+    return urllib.urlencode(pairs)
+
+def load_request(body, query_string='decorator=none'):
+    local = httputil.Host('127.0.0.1', 8011)
+    request = _cprequest.Request(local, local, 'http', 'HTTP/1.1')
+    request.method = 'POST'
+    request.path_info = '/secure/EditIssue.jspa'
+    request.query_string = query_string
+    request.params = {}
+    request.headers = httputil.HeaderMap()
+    request.headers['Host'] = local_host
+    request.headers['Content-Type'] = 'application/x-www-form-urlencoded; charset=UTF-8'
+    request.headers['Content-Length'] = str(len(body))
+    request.rfile = cStringIO.StringIO(body)
+    cherrypy.serving.load(request, _cprequest.Response())
+    return request
+
+def former_data(body):
+    # cherrypy decoded query and body into request.params, the controller
+    # replaced hosts twice and the proxy encoded the parameters again
+    request = load_request(body)
+    request.params = httputil.parse_query_string(request.query_string, encoding='utf8')
+    entity = _cpreqbody.RequestBody(request.rfile, request.headers, request_params=request.params)
+    entity.process()
+    params = request.params
+    for search_host in (local_host, local_host):
+        search = 'http://' + search_host
+        for key, value in params.items():
+            if isinstance(value, basestring) and value.startswith(search):
+                params[key] = 'http://' + remote_host + value[len(search):]
+    encoded = dict([(key, value.encode('utf8')) for key, value in params.items()])
+    return None, urllib.urlencode(encoded)
+
+def current_data(controller, proxy, body):
+    load_request(body)
+    controller._munge_params()
+    proxy._collect_request_parameters()
+    return proxy._params.query_string, proxy._params.data
+
+def sent_params(query_string, data):
+    # parameters the remote host sees, regardless of order and where they were sent
+    pairs = cgi.parse_qsl(query_string or '', True) + cgi.parse_qsl(data or '', True)
+    pairs.sort()
+    return pairs
+
+def measure(label, func, iterations, size):
+    start = time.time()
+    for i in range(iterations):
+        func()
+    elapsed = time.time() - start
+    print '%-32s %8.1f us/post %8.1f MB/s' % (label, elapsed * 1000000 / iterations, size * iterations / elapsed / 1024 / 1024)
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'n:k:')
+    iterations = 200
+    kilobytes = 256
+    for opt, value in opts:
+        if opt == '-n':
+            iterations = int(value)
+        elif opt == '-k':
+            kilobytes = int(value)
+    
+    cherrypy.config.update({'remote.host': remote_host, 'local.host': local_host, 'log.screen': False})
+    from issues import main_controller, proxy as proxy_module
+    
+    controller = main_controller.MainController()
+    proxy = proxy_module.Proxy()
+    
+    different = 0
+    for mention_host in (False, True):
+        body = build_post(kilobytes, mention_host)
+        former = sent_params(*former_data(body))
+        current = sent_params(*current_data(controller, proxy, body))
+        if former != current:
+            different += 1
+            print 'warning: parameters sent differ%s' % (mention_host and ' with host mentioned' or '')
+    
+    for mention_host in (False, True):
+        body = build_post(kilobytes, mention_host)
+        print '%d byte post%s' % (len(body), mention_host and ', host mentioned' or '')
+        measure('cherrypy decoding and urlencode', lambda: former_data(body), iterations, len(body))
+        measure('munge_params and collect', lambda: current_data(controller, proxy, body), iterations, len(body))
+    if different:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+'''Throughput, latency and memory of the proxy pipeline.
+
+Usage: PYTHONPATH=. python bench/pipeline.py [-n requests] [-C configs] [-S scenarios]
+    [-s kind=size,...] [-o results.json] [-b baseline.json]
+
+Requests are passed to MainController.default through cherrypy's wsgi
+application, without an http server in between, and the proxy talks to
+a fake JIRA server (see fake_jira.py). Each configuration runs in a process
+of its own:
+
+uncached       local.cache.enabled off
+cached         cache on disk, responses read from disk
+cached-memory  cache on disk and in memory
+cached-xaccel  cache on disk served by nginx through x-accel-redirect
+
+Scenarios are html, html_private, xml, json, static and redirect, see
+fake_jira.py. Each scenario makes a warm-up pass over its pages, then
+-n requests (default 500) are timed one at a time.
+
+Results are written as JSON to -o, together with the commit they were
+measured at. With -b, changes relative to results of another run are shown.
+'''
+
+import sys, os, time, getopt, gc, json, resource, tempfile, shutil, subprocess, cStringIO
+import cherrypy
+
+import fake_jira
+
+remote_port = 18961
+
+CONFIGS = {
+    'uncached': {'local.cache.enabled': False},
+    'cached': {'local.cache.enabled': True},
+    'cached-memory': {'local.cache.enabled': True, 'local.cache.memory.enabled': True},
+    'cached-xaccel': {'local.cache.enabled': True, 'local.cache.x_accel_redirect.enabled': True,
+        'local.cache.x_accel_redirect.prefix': '/internal'},
+}
+CONFIG_ORDER = ['uncached', 'cached', 'cached-memory', 'cached-xaccel']
+
+# scenario -> function of page number returning path and query string
+SCENARIOS = {
+    'html': lambda i: ('/browse/PROJ-%d' % i, ''),
+    'html_private': lambda i: ('/browse/PROJ-%d' % i, 'private'),
+    'xml': lambda i: ('/si/jira.issueviews:issue-xml/PROJ-%d/PROJ-%d.xml' % (i, i), ''),
+    'json': lambda i: ('/rest/api/2/issue/PROJ-%d' % i, ''),
+    'static': lambda i: ('/s/%d/_/styles.css' % i, ''),
+    'redirect': lambda i: ('/secure/Dashboard.jspa', ''),
+}
+SCENARIO_ORDER = ['html', 'html_private', 'xml', 'json', 'static', 'redirect']
+
+# distinct pages requested per scenario
+pages = 20
+
+def rss():
+    return int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize()
+
+def request(app, path, query_string):
+    '''Returns status and body of a request passed to app'''
+    
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query_string,
+        'SERVER_NAME': 'proxy.local',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+        'REMOTE_PORT': '40000',
+        'HTTP_HOST': 'proxy.local',
+        'HTTP_ACCEPT_ENCODING': 'gzip',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': cStringIO.StringIO(''),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    status = []
+    result = app(environ, lambda status_line, headers, exc_info=None: status.append(status_line))
+    try:
+        body = ''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return status[0].split()[0], body
+
+def run_config(name, scenarios, count):
+    '''Measures scenarios in a configuration, returning a list of results'''
+    
+    cache_dir = tempfile.mkdtemp()
+    try:
+        config = {
+            'remote.host': '127.0.0.1:%d' % remote_port,
+            'local.cache.dir': cache_dir,
+            'log.screen': False,
+            'engine.autoreload.on': False,
+            'checker.on': False,
+        }
+        config.update(CONFIGS[name])
+        cherrypy.config.update(config)
+        from issues import environment
+        
+        environment.setup(cache_dir, plugins=False)
+        cherrypy.server.unsubscribe()
+        cherrypy.engine.start()
+        try:
+            results = []
+            for scenario in scenarios:
+                results.append(measure(name, scenario, count))
+            return results
+        finally:
+            cherrypy.engine.exit()
+    finally:
+        shutil.rmtree(cache_dir)
+
+def measure(config, scenario, count):
+    app = cherrypy.tree
+    make_path = SCENARIOS[scenario]
+    for i in range(pages):
+        request(app, *make_path(i))
+    
+    statuses = {}
+    timings = []
+    gc.collect()
+    rss_before = rss()
+    started = time.time()
+    for i in range(count):
+        request_started = time.time()
+        status, body = request(app, *make_path(i % pages))
+        timings.append(time.time() - request_started)
+        statuses[status] = statuses.get(status, 0) + 1
+    elapsed = time.time() - started
+    gc.collect()
+    rss_after = rss()
+    
+    timings.sort()
+    return dict(config=config, scenario=scenario, requests=count,
+        requests_per_second=round(count / elapsed, 1),
+        p50_ms=round(timings[len(timings) // 2] * 1000, 3),
+        p99_ms=round(timings[min(len(timings) - 1, len(timings) * 99 // 100)] * 1000, 3),
+        rss_growth_per_request=(rss_after - rss_before) // count,
+        max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        statuses=statuses)
+
+def run_config_in_child(name, scenarios, count):
+    # configurations must not share module state, e.g. proxies created per thread
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            os.close(reader)
+            results = run_config(name, scenarios, count)
+            os.write(writer, json.dumps(results))
+            code = 0
+        finally:
+            os._exit(code)
+    os.close(writer)
+    data = []
+    while True:
+        chunk = os.read(reader, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(reader)
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError('Configuration %s failed' % name)
+    return json.loads(''.join(data))
+
+def current_commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def print_results(results, baseline=None):
+    previous = {}
+    if baseline is not None:
+        for result in baseline['results']:
+            previous[(result['config'], result['scenario'])] = result
+    print '%-14s %-13s %9s %9s %9s %10s  %s' % ('config', 'scenario', 'req/s', 'p50 ms', 'p99 ms', 'rss/req', 'statuses')
+    for result in results:
+        line = '%-14s %-13s %9.1f %9.3f %9.3f %10d  %s' % (result['config'], result['scenario'],
+            result['requests_per_second'], result['p50_ms'], result['p99_ms'], result['rss_growth_per_request'],
+            ' '.join(['%s:%d' % item for item in sorted(result['statuses'].items())]))
+        before = previous.get((result['config'], result['scenario']))
+        if before is not None:
+            line += '  req/s %+.1f%%, p99 %+.1f%%' % (
+                (result['requests_per_second'] / before['requests_per_second'] - 1) * 100,
+                (result['p99_ms'] / before['p99_ms'] - 1) * 100)
+        print line
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'n:C:S:s:o:b:')
+    count = 500
+    configs = CONFIG_ORDER
+    scenarios = SCENARIO_ORDER
+    sizes = {}
+    output = baseline = None
+    for opt, value in opts:
+        if opt == '-n':
+            count = int(value)
+        elif opt == '-C':
+            configs = value.split(',')
+        elif opt == '-S':
+            scenarios = value.split(',')
+        elif opt == '-s':
+            for item in value.split(','):
+                kind, size = item.split('=')
+                sizes[kind] = int(size)
+        elif opt == '-o':
+            output = value
+        elif opt == '-b':
+            baseline = json.load(open(value))
+    
+    server_pid = fake_jira.fork_server(remote_port, sizes)
+    try:
+        results = []
+        for config in configs:
+            results.extend(run_config_in_child(config, scenarios, count))
+    finally:
+        fake_jira.stop_server(server_pid)
+    
+    print_results(results, baseline)
+    if output is not None:
+        run = dict(commit=current_commit(), python=sys.version.split()[0], time=int(time.time()),
+            sizes=sizes, results=results)
+        json.dump(run, open(output, 'w'), indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
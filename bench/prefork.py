@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+'''Throughput of the prefork server by number of workers.
+
+Usage: PYTHONPATH=. python bench/prefork.py [-w 1,2,4] [-c clients] [-d seconds] [-C]
+
+Starts a fake remote host serving a synthetic issue page, then for each
+worker count a prefork server proxying it, and reports requests per second
+served to client processes over keep-alive connections. Pages are fetched
+and rewritten on every request unless -C enables the cache, in which case
+pages are served from the cache after the first request.
+'''
+
+import sys, os, time, getopt, signal, socket, tempfile, shutil, httplib, multiprocessing
+import BaseHTTPServer, SocketServer
+import cherrypy
+
+from issues import environment, prefork
+
+remote_port = 18951
+local_port = 18952
+pages = 100
+
+def synthetic_page():
+    row = '''<tr><td><a href="http://127.0.0.1:%(port)d/browse/PHPBB3-%(i)d">PHPBB3-%(i)d</a></td>
+<!-- issue row %(i)d -->
+<td><img src="http://127.0.0.1:%(port)d/images/icons/bug.gif"/> Some summary of issue %(i)d</td></tr>
+'''
+    body = ''.join([row % dict(port=remote_port, i=i) for i in range(1000)])
+    return '<html><head><!-- header --></head><body><table>%s</table></body></html>' % body
+
+class RemoteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    page = synthetic_page()
+    
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Cache-Control', 'public, max-age=3600')
+        self.send_header('Content-Length', str(len(self.page)))
+        self.end_headers()
+        self.wfile.write(self.page)
+    
+    def log_message(self, *args):
+        pass
+
+class RemoteServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def fork(function, *args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            function(*args)
+        finally:
+            os._exit(0)
+    return pid
+
+def serve_remote():
+    RemoteServer(('127.0.0.1', remote_port), RemoteHandler).serve_forever()
+
+def serve_local(workers, cache, cache_dir):
+    cherrypy.config.update({
+        'server.socket_host': '127.0.0.1',
+        'server.socket_port': local_port,
+        'server.thread_pool': 10,
+        'remote.host': '127.0.0.1:%d' % remote_port,
+        'local.cache.enabled': cache,
+        'local.cache.dir': cache_dir,
+        'log.screen': False,
+        'engine.autoreload.on': False,
+        'checker.on': False,
+    })
+    environment.setup(cache_dir, plugins=False)
+    prefork.Supervisor(prefork.bind_listener(), workers, prefork.run_worker).run()
+
+def wait_for_port(port):
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+
+def client(args):
+    index, duration = args
+    connection = httplib.HTTPConnection('127.0.0.1', local_port)
+    count = 0
+    end = time.time() + duration
+    while time.time() < end:
+        connection.request('GET', '/browse/PHPBB3-%d' % ((index * 7 + count) % pages))
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise ValueError('Unexpected status %d' % response.status)
+        count += 1
+    connection.close()
+    return count
+
+def measure(workers, clients, duration, cache):
+    cache_dir = tempfile.mkdtemp()
+    pid = fork(serve_local, workers, cache, cache_dir)
+    try:
+        wait_for_port(local_port)
+        # warm up workers and, if enabled, the cache
+        pool = multiprocessing.Pool(clients)
+        pool.map(client, [(index, 1) for index in range(clients)])
+        start = time.time()
+        count = sum(pool.map(client, [(index, duration) for index in range(clients)]))
+        elapsed = time.time() - start
+        pool.close()
+        print '%2d worker(s) %8.1f requests/s' % (workers, count / elapsed)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        shutil.rmtree(cache_dir)
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'w:c:d:C')
+    worker_counts = [1, 2, 4]
+    clients = 8
+    duration = 5
+    cache = False
+    for opt, value in opts:
+        if opt == '-w':
+            worker_counts = [int(count) for count in value.split(',')]
+        elif opt == '-c':
+            clients = int(value)
+        elif opt == '-d':
+            duration = float(value)
+        elif opt == '-C':
+            cache = True
+    
+    remote_pid = fork(serve_remote)
+    try:
+        wait_for_port(remote_port)
+        print '%d client(s), %d byte page, cache %s, %d processor(s)' % (clients,
+            len(RemoteHandler.page), cache and 'enabled' or 'disabled', multiprocessing.cpu_count())
+        for workers in worker_counts:
+            measure(workers, clients, duration, cache)
+    finally:
+        os.kill(remote_pid, signal.SIGTERM)
+        os.waitpid(remote_pid, 0)
+
+if __name__ == '__main__':
+    main()
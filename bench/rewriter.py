@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+'''Micro-benchmark of response content rewriting.
+
+Usage: PYTHONPATH=. python bench/rewriter.py [-n iterations] page...
+
+Pages should be JIRA pages saved from the remote host, e.g. with
+`curl -o browse.html http://tracker.phpbb.com/browse/PHPBB3-1`.
+Without pages a synthetic issue page is used.
+
+Compares the former rewriting (regular expression comment removal
+followed by two str.replace passes), a single pass over a compiled
+alternation of comments and host names, and the rewriter used by the proxy,
+on whole bodies and on bodies streamed in 64k chunks.
+'''
+
+import sys, re, time, getopt
+
+from issues import rewriter
+
+remote_host = 'tracker.phpbb.com'
+incoming_host = 'jp.etal.bsdpower.com:8011'
+local_host = 'jp.etal.bsdpower.com'
+
+html_comment_re = re.compile(r'<!--.*?-->', re.S)
+
+def three_pass(content):
+    content = html_comment_re.sub('', content)
+    content = content.replace(remote_host, local_host)
+    content = content.replace(incoming_host, local_host)
+    return content
+
+def single_pass_alternation():
+    mapping = {remote_host: local_host, incoming_host: local_host}
+    pattern = re.compile('|'.join([r'<!--.*?-->'] + [re.escape(host) for host in mapping.keys()]), re.S)
+    return lambda content: pattern.sub(lambda match: mapping.get(match.group(0), ''), content)
+
+def synthetic_page():
+    row = '''<tr><td><a href="http://%(host)s/browse/PHPBB3-%(i)d">PHPBB3-%(i)d</a></td>
+<!-- issue row %(i)d -->
+<td><img src="http://%(host)s/images/icons/bug.gif"/> Some summary of issue %(i)d</td></tr>
+'''
+    body = ''.join([row % dict(host=remote_host, i=i) for i in range(2000)])
+    return '<html><head><!-- header --></head><body><table>%s</table></body></html>' % body
+
+def chunked(content, size=65536):
+    return [content[i:i+size] for i in range(0, len(content), size)]
+
+def measure(label, func, pages, iterations):
+    total_bytes = sum([len(page) for page in pages])
+    start = time.time()
+    for i in range(iterations):
+        for page in pages:
+            func(page)
+    elapsed = time.time() - start
+    print '%-24s %8.2f ms/iteration %8.1f MB/s' % (label, elapsed * 1000 / iterations,
+        total_bytes * iterations / elapsed / 1024 / 1024)
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'n:')
+    iterations = 50
+    for opt, value in opts:
+        if opt == '-n':
+            iterations = int(value)
+    
+    if args:
+        pages = [open(path).read() for path in args]
+    else:
+        pages = [synthetic_page()]
+    
+    host_rewriter = rewriter.get_host_rewriter(remote_host, local_host, incoming_host, remote_host)
+    for page in pages:
+        if host_rewriter.rewrite(page) != three_pass(page):
+            print 'warning: rewriter output differs from three pass output'
+    chunked_pages = [chunked(page) for page in pages]
+    
+    print '%d page(s), %d bytes' % (len(pages), sum([len(page) for page in pages]))
+    measure('three pass', three_pass, pages, iterations)
+    measure('single pass alternation', single_pass_alternation(), pages, iterations)
+    measure('rewriter', host_rewriter.rewrite, pages, iterations)
+    start = time.time()
+    for i in range(iterations):
+        for chunks in chunked_pages:
+            ''.join(host_rewriter.rewrite_chunks(chunks))
+    elapsed = time.time() - start
+    print '%-24s %8.2f ms/iteration' % ('rewriter, streamed', elapsed * 1000 / iterations)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,12 @@
-import cherrypy, urllib, urllib2, Cookie, cookielib, time, urlgrabber.keepalive
+import cherrypy, urllib, urllib2, time
+
+import tools.file, tools.connection_pool, tools.set_cookie
+import environment, metrics, settings
 
 class BaseParameters:
     def __init__(self):
         self.host = self.path = self.method = self.params = self.data = self.query_string = self.cookie = self.headers = None
+        self.incoming_host = self.accept_encoding = self.stream = None
     
     def clear_cookies(self):
         self.cookie = None
@@ -10,15 +14,18 @@ class BaseParameters:
 class BaseResponse:
     def __init__(self, **kwargs):
         self.params = self.code = self.content = self.raw_response = None
+        # when streaming, content is an iterable of chunks rather than a string
+        self.streaming = False
         
         self.headers = {}
-        self.cookies = cookielib.CookieJar()
+        # tools.set_cookie.SetCookie objects
+        self.cookies = []
         
         for key, value in kwargs.items():
             setattr(self, key, value)
     
     def clear_cookies(self):
-        self.cookies = cookielib.CookieJar()
+        self.cookies = []
 
 class BaseProxy:
     ParametersClass = BaseParameters
@@ -30,53 +37,103 @@ class BaseProxy:
         def redirect_request(self, req, fp, code, msg, hdrs, newurl):
             return None
     
-    PASS_REMOTE_HEADERS = ('content-type', 'content-disposition', 'location', 'cache-control', 'pragma', 'expires', 'vary')
+    PASS_REMOTE_HEADERS = ('content-type', 'content-disposition', 'location', 'cache-control', 'pragma', 'expires', 'vary', 'etag', 'last-modified', 'content-encoding')
     
     def __init__(self):
-        self._create_opener()
+        self.settings = None
+        self._load_settings()
+    
+    def _load_settings(self):
+        # called when starting on a request; settings stay the same until it is done
+        current = settings.get()
+        if current is not self.settings:
+            self.settings = current
+            self._create_opener()
     
     def _create_opener(self):
-        if cherrypy.config.get('debug.http_requests'):
+        if self.settings.debug_http_requests:
             import httplib
             httplib.HTTPConnection.debuglevel = 1
         handlers = []
-        handlers.append(urlgrabber.keepalive.HTTPHandler())
+        # connections are shared by all proxies
+        handlers.append(tools.connection_pool.PooledHTTPHandler(environment.get_upstream_pool(),
+            self.settings.pool_retries))
         handlers.append(self.__class__.NoRedirectHandler())
         self._opener = urllib2.build_opener(*handlers)
-        user_agent = cherrypy.config.get('remote.user_agent')
-        if user_agent:
-            self._opener.addheaders = [('user-agent', user_agent)]
+        if self.settings.user_agent:
+            self._opener.addheaders = [('user-agent', self.settings.user_agent)]
     
     def perform(self, **kwargs):
         self._collect_request_parameters(**kwargs)
         self._create_remote_request()
         self._issue_remote_request()
-        self._rewrite_host_in_location()
+        self._complete_remote_request()
     
     def perform_and_propagate(self, **kwargs):
         self.perform(**kwargs)
         self._propagate_remote_response()
         return self._remote_response
     
+    # perform_and_propagate split into steps before and after talking to
+    # the remote host, for callers issuing remote requests themselves
+    
+    def prepare_remote_request(self, **kwargs):
+        '''Returns urllib2 request to be sent to the remote host,
+        with headers the opener would add'''
+        
+        self._collect_request_parameters(**kwargs)
+        self._create_remote_request()
+        request = self._remote_request
+        for processor in self._opener.process_request.get('http', []):
+            request = processor.http_request(request)
+        return request
+    
+    def complete_and_propagate(self, response):
+        '''Takes over urllib2 response object received for prepared
+        remote request and propagates it'''
+        
+        self._accept_remote_response(response)
+        self._complete_remote_request()
+        self._propagate_remote_response()
+        return self._remote_response
+    
     def _collect_request_parameters(self, **kwargs):
+        self._load_settings()
         parameters = self.__class__.ParametersClass()
-        host = kwargs.get('host') or self.__class__.default_remote_host
+        host = kwargs.get('host') or self.default_remote_host
         if host is None:
             raise ValueError('host not specified by client and no default provided')
         parameters.host = host
         parameters.path = kwargs.get('path_info') or cherrypy.request.path_info
         parameters.method = kwargs.get('method') or cherrypy.request.method.lower()
         
-        if parameters.method == 'post':
+        # query string and body as received, with links to this proxy
+        # pointed at the remote host, see MainController._munge_params
+        munged = not kwargs.get('params') and hasattr(cherrypy.request, 'forward_query_string')
+        
+        if parameters.method == 'post' and munged and not kwargs.get('params_in_qs'):
+            parameters.params = {}
+            parameters.query_string = cherrypy.request.forward_query_string or None
+            parameters.data = cherrypy.request.forward_body
+        elif parameters.method == 'post':
             parameters.params = kwargs.get('params') or cherrypy.request.params
-            parameters.data = urllib.urlencode(parameters.params)
+            parameters.data = urllib.urlencode(parameters.params, True)
             if kwargs.get('params_in_qs'):
                 parameters.query_string, parameters.data = parameters.data, None
             else:
                 parameters.query_string = None
+        elif kwargs.get('query_string') is not None:
+            # query string is already encoded, e.g. when revalidating a cached page
+            parameters.params = kwargs.get('params') or {}
+            parameters.query_string = kwargs['query_string']
+            parameters.data = None
+        elif munged:
+            parameters.params = {}
+            parameters.query_string = cherrypy.request.forward_query_string
+            parameters.data = None
         else:
             parameters.params = kwargs.get('params') or cherrypy.request.params
-            parameters.query_string = urllib.urlencode(parameters.params)
+            parameters.query_string = urllib.urlencode(parameters.params, True)
             parameters.data = None
         
         if cherrypy.request.headers.has_key('Cookie'):
@@ -84,7 +141,12 @@ class BaseProxy:
         else:
             parameters.cookie = None
         
-        parameters.headers = {}
+        parameters.incoming_host = kwargs.get('incoming_host') or cherrypy.request.headers.get('host')
+        parameters.accept_encoding = kwargs.get('accept_encoding') or cherrypy.request.headers.get('accept-encoding')
+        parameters.headers = dict(kwargs.get('headers') or {})
+        if parameters.data is not None and munged and cherrypy.request.headers.has_key('Content-Type'):
+            parameters.headers['Content-Type'] = cherrypy.request.headers['Content-Type']
+        parameters.stream = kwargs.get('stream', self.settings.stream)
         
         self._params = parameters
     
@@ -100,13 +162,35 @@ class BaseProxy:
         self._remote_request = urllib2.Request('http://' + params.host + params.path + query_string_append, params.data, headers)
     
     def _issue_remote_request(self):
+        # raises tools.load_shedding.Rejected when the remote host is failing or overloaded
+        guard = environment.get_upstream_guard()
+        token = guard.enter()
+        failed = True
         try:
-            response = self._opener.open(self._remote_request)
-        except urllib2.HTTPError, e:
-            response = e
-        
+            try:
+                response = self._opener.open(self._remote_request)
+            except urllib2.HTTPError, e:
+                response = e
+            
+            if getattr(response, 'connect_time', None) is not None:
+                metrics.observe('upstream_connect', response.connect_time)
+            if getattr(response, 'first_byte_time', None) is not None:
+                metrics.observe('upstream_ttfb', response.first_byte_time)
+            self._accept_remote_response(response)
+            failed = response.code is not None and response.code >= 500
+        finally:
+            guard.exit(token, failed)
+    
+    def _accept_remote_response(self, response):
         response_code = response.code
-        self._remote_response = self.__class__.ResponseClass(params=self._params, code=response_code, content=response.read(), raw_response=response)
+        if self._params.stream:
+            content = self._read_chunks_and_close(response, self.settings.stream_chunk_size)
+        else:
+            started = time.time()
+            content = response.read()
+            metrics.observe_since('body_read', started)
+            metrics.count('upstream_bytes', amount=len(content))
+        self._remote_response = self.__class__.ResponseClass(params=self._params, code=response_code, content=content, raw_response=response, streaming=self._params.stream)
         
         remote_info = response.info()
         
@@ -114,7 +198,39 @@ class BaseProxy:
             if key in self.__class__.PASS_REMOTE_HEADERS:
                 self._remote_response.headers[key.lower()] = value
         
-        self._remote_response.cookies.extract_cookies(response, self._remote_request)
+        if self._keeps_cookies():
+            self._remote_response.cookies = self._extract_cookies(response)
+    
+    def _keeps_cookies(self):
+        # whether cookies of the remote response are passed on
+        return True
+    
+    def _extract_cookies(self, response):
+        cookies = []
+        for value in response.info().getheaders('set-cookie'):
+            cookie = tools.set_cookie.parse(value, self._params.host, self._params.path)
+            if cookie is not None:
+                cookies.append(cookie)
+        return cookies
+    
+    def _read_chunks_and_close(self, response, chunk_size):
+        # returns the connection to the pool even if the client goes away
+        # before the whole response has been read
+        read_time = 0
+        try:
+            chunks = tools.file.read_chunks(response, chunk_size)
+            while True:
+                started = time.time()
+                try:
+                    chunk = chunks.next()
+                except StopIteration:
+                    break
+                read_time += time.time() - started
+                metrics.count('upstream_bytes', amount=len(chunk))
+                yield chunk
+        finally:
+            response.close()
+            metrics.observe('body_read', read_time)
     
     def _rewrite_host_in_url(self, url):
         if self.reverse_host_map is None:
@@ -133,6 +249,9 @@ class BaseProxy:
                     return new_url
         return url
     
+    def _complete_remote_request(self):
+        self._rewrite_host_in_location()
+    
     def _rewrite_host_in_location(self):
         if self._remote_response.headers.has_key('location'):
             location = self._remote_response.headers['location']
@@ -141,28 +260,17 @@ class BaseProxy:
                 self._remote_response.headers['location'] = new_location
     
     def _propagate_remote_response(self):
+        started = time.time()
         r = self._remote_response
         if r.code:
             cherrypy.response.status = r.code
+        if r.streaming:
+            cherrypy.response.stream = True
         
         for key, value in r.headers.items():
             cherrypy.response.headers[key] = value
         
-        cookies = Cookie.SimpleCookie()
-        # time returns a float, however Cookie code only converts integer offsets to rfc-formatted times
-        now = int(time.time())
-        for cookie in r.cookies:
-            cookies[cookie.name] = cookie.value
-            morsel = cookies[cookie.name]
-            if cookie.secure:
-                morsel['secure'] = cookie.secure
-            if cookie.path:
-                morsel['path'] = cookie.path
-            # forums don't set expiration date on cookie
-            if cookie.expires:
-                # cookielib's cookies have expires as time since epoch;
-                # Cookie's cookies expect expires as time since now
-                morsel['expires'] = cookie.expires - now
-            if cookie.get_nonstandard_attr('httponly', False) != False:
-                morsel['httponly'] = cookie.get_nonstandard_attr('httponly')
-        cherrypy.response.cookie = cookies
+        if r.cookies:
+            # set-cookie headers are not parsed again by Cookie
+            cherrypy.response.cookie = tools.set_cookie.SetCookieHeaders(r.cookies)
+        metrics.observe_since('propagate', started)
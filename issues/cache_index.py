@@ -0,0 +1,259 @@
+import sqlite3, threading, json, time
+
+SCHEMA = '''
+create table if not exists entries (
+    key text primary key,
+    headers text not null,
+    expires_at real not null,
+    size integer not null,
+    files integer not null,
+    accessed_at real not null,
+    etag text,
+    last_modified text,
+    file text,
+    stored_at real
+);
+create index if not exists entries_expires_at on entries (expires_at);
+create index if not exists entries_accessed_at on entries (accessed_at);
+'''
+
+# indexes on columns added after the table was first created
+LATE_SCHEMA = '''
+create index if not exists entries_file on entries (file);
+'''
+
+def _encode(value):
+    # header values and request paths are byte strings which are not necessarily utf-8;
+    # latin-1 maps every byte to a code point and back
+    if isinstance(value, str):
+        return value.decode('latin-1')
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return dict([(_encode(key), _encode(item)) for key, item in value.items()])
+    return value
+
+def _decode(value):
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if isinstance(value, dict):
+        return dict([(_decode(key), _decode(item)) for key, item in value.items()])
+    return value
+
+# columns added after the table was first created
+LATE_COLUMNS = (('file', 'text'), ('stored_at', 'real'))
+
+def _decode_entry_row(row):
+    key, expires_at, size, files, file = row
+    key = _decode(key)
+    if file is None:
+        # entries written before file paths were recorded use mirror layout
+        file = key[1:]
+    return key, expires_at, size, files, _decode(file)
+
+class CacheIndex:
+    '''Metadata of all cached pages, keyed on cache relative path,
+    stored in a single sqlite database.
+    
+    Besides headers each entry records expiration time, total size and number
+    of files of stored bodies, last access time, time it was stored, validators
+    and path of the body file relative to cache directory, taken from x-cache-file header.
+    Expiration and access times and file paths are indexed for the janitor.
+    
+    Connections are per thread; sqlite transactions make updates atomic
+    across threads and processes sharing the database.
+    '''
+    
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        # schema is created by the first connection of this process
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+    
+    def _connection(self):
+        try:
+            return self._local.connection
+        except AttributeError:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            try:
+                # readers do not block writers with write-ahead logging
+                connection.execute('pragma journal_mode=wal')
+            except sqlite3.DatabaseError:
+                pass
+            connection.execute('pragma synchronous=normal')
+            self._ensure_schema(connection)
+            self._local.connection = connection
+            return connection
+    
+    def _ensure_schema(self, connection):
+        self._schema_lock.acquire()
+        try:
+            if self._schema_ready:
+                return
+            # connections of other processes may be creating the schema at the same time,
+            # in which case sqlite reports that the schema has changed
+            for attempt in range(5):
+                try:
+                    self._create_schema(connection)
+                    break
+                except sqlite3.OperationalError:
+                    if attempt == 4:
+                        raise
+                    time.sleep(0.1)
+            self._schema_ready = True
+        finally:
+            self._schema_lock.release()
+    
+    def _create_schema(self, connection):
+        connection.executescript(SCHEMA)
+        columns = [row[1] for row in connection.execute('pragma table_info(entries)')]
+        for column, type in LATE_COLUMNS:
+            if column not in columns:
+                try:
+                    connection.execute('alter table entries add column %s %s' % (column, type))
+                except sqlite3.OperationalError:
+                    # another process added it first
+                    pass
+        connection.executescript(LATE_SCHEMA)
+    
+    def get(self, key):
+        '''Returns headers stored for key, or None'''
+        
+        row = self._connection().execute('select headers from entries where key = ?', (_encode(key),)).fetchone()
+        if row is None:
+            return None
+        return _decode(json.loads(row[0]))
+    
+    def has(self, key):
+        row = self._connection().execute('select 1 from entries where key = ?', (_encode(key),)).fetchone()
+        return row is not None
+    
+    def has_file(self, file):
+        '''Returns True if an entry stores its body in file, given relative to cache directory'''
+        
+        row = self._connection().execute('select 1 from entries where file = ?', (_encode(file),)).fetchone()
+        return row is not None
+    
+    def put(self, key, headers, size, files):
+        '''Stores headers for key, replacing existing entry if any'''
+        
+        connection = self._connection()
+        with connection:
+            now = time.time()
+            connection.execute('insert or replace into entries (key, headers, expires_at, size, files, accessed_at, etag, last_modified, file, stored_at) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (_encode(key), json.dumps(_encode(headers)), headers['x-expires-timestamp'], size, files, now,
+                _encode(headers.get('etag')), _encode(headers.get('last-modified')), _encode(headers.get('x-cache-file')), now))
+    
+    def update_headers(self, key, headers, expires_at=None, file=None):
+        '''Replaces headers for key without changing the rest of the entry.
+        If expires_at is given, the entry is only updated if it has not been
+        replaced since it had that expiration time. If file is given, it is
+        only updated if its body is still stored in file, relative to cache
+        directory.
+        
+        Returns True if an entry was updated.'''
+        
+        query = 'update entries set headers = ?, expires_at = ?, etag = ?, last_modified = ?, file = ? where key = ?'
+        params = [json.dumps(_encode(headers)), headers['x-expires-timestamp'],
+            _encode(headers.get('etag')), _encode(headers.get('last-modified')), _encode(headers.get('x-cache-file')), _encode(key)]
+        if expires_at is not None:
+            query += ' and expires_at = ?'
+            params.append(expires_at)
+        if file is not None:
+            # entries saved before file paths were recorded are stored under their keys
+            query += ' and coalesce(file, substr(key, 2)) = ?'
+            params.append(_encode(file))
+        connection = self._connection()
+        with connection:
+            return connection.execute(query, params).rowcount > 0
+    
+    def delete(self, key, expires_at=None):
+        '''Deletes entry for key. If expires_at is given, the entry is only
+        deleted if it has not been replaced since it had that expiration time.
+        
+        Returns True if an entry was deleted.'''
+        
+        connection = self._connection()
+        with connection:
+            if expires_at is None:
+                cursor = connection.execute('delete from entries where key = ?', (_encode(key),))
+            else:
+                cursor = connection.execute('delete from entries where key = ? and expires_at = ?', (_encode(key), expires_at))
+            return cursor.rowcount > 0
+    
+    def record_accesses(self, access_times):
+        '''Updates last access times from a dictionary of keys to timestamps'''
+        
+        connection = self._connection()
+        with connection:
+            connection.executemany('update entries set accessed_at = max(accessed_at, ?) where key = ?',
+                [(accessed_at, _encode(key)) for key, accessed_at in access_times.items()])
+    
+    def expired(self, before, limit=1000):
+        '''Returns up to limit (key, expires_at, size, files, file) tuples for entries
+        expiring before given time'''
+        
+        rows = self._connection().execute('select key, expires_at, size, files, file from entries where expires_at < ? order by expires_at limit ?',
+            (before, limit)).fetchall()
+        return [_decode_entry_row(row) for row in rows]
+    
+    def expiring(self, after, before, limit=1000):
+        '''Returns up to limit (key, expires_at, accessed_at) tuples for entries
+        expiring between given times, soonest first'''
+        
+        rows = self._connection().execute('select key, expires_at, accessed_at from entries where expires_at >= ? and expires_at < ? order by expires_at limit ?',
+            (after, before, limit)).fetchall()
+        return [(_decode(key), expires_at, accessed_at) for key, expires_at, accessed_at in rows]
+    
+    def least_recently_used(self, limit=1000):
+        '''Returns up to limit (key, expires_at, size, files, file) tuples for entries
+        accessed least recently'''
+        
+        rows = self._connection().execute('select key, expires_at, size, files, file from entries order by accessed_at limit ?',
+            (limit,)).fetchall()
+        return [_decode_entry_row(row) for row in rows]
+    
+    def keys(self, batch_size=1000):
+        '''Iterates over all keys'''
+        
+        last_key = u''
+        while True:
+            rows = self._connection().execute('select key from entries where key > ? order by key limit ?',
+                (last_key, batch_size)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield _decode(row[0])
+            last_key = rows[-1][0]
+    
+    def entries(self, prefix=None, batch_size=1000):
+        '''Iterates over (key, expires_at, size, files, file, accessed_at, stored_at)
+        tuples of all entries in key order, or of entries whose keys start with prefix.
+        
+        stored_at is None for entries stored before it was recorded.'''
+        
+        query = 'select key, expires_at, size, files, file, accessed_at, stored_at from entries where key > ?'
+        bounds = []
+        if prefix:
+            # keys are latin-1, every key starting with prefix sorts below prefix + u'\u0100'
+            query += ' and key >= ? and key < ?'
+            bounds = [_encode(prefix), _encode(prefix) + u'\u0100']
+        query += ' order by key limit ?'
+        last_key = u''
+        while True:
+            rows = self._connection().execute(query, [last_key] + bounds + [batch_size]).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield _decode_entry_row(row[:5]) + row[5:]
+            last_key = rows[-1][0]
+    
+    def totals(self):
+        '''Returns (number of entries, total size, total number of files)'''
+        
+        count, size, files = self._connection().execute('select count(*), sum(size), sum(files) from entries').fetchone()
+        return count, size or 0, files or 0
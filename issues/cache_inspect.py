@@ -0,0 +1,390 @@
+'''Lists, summarizes and purges cached pages.
+
+Usage: script/inspect-cache [-c concurrency] list [-v] [-e] [selection]
+       script/inspect-cache [-c concurrency] stats [-d depth] [-t top] [selection]
+       script/inspect-cache [-c concurrency] purge [-n] [-v] selection
+
+Pages are selected by their request paths, as cache keys are made of them:
+
+    url           the page at url, in all its variants, e.g. /browse/PHPBB3-1
+                  or http://tracker.example.com/browse/PHPBB3-1?page=2
+    -p prefix     pages whose paths start with prefix, e.g. /browse/PHPBB3-
+    -m pattern    pages whose paths match a shell-style pattern, e.g. '/browse/PHPBB3-*'
+
+list prints size, files and expiration time of each page, -v adds its url
+and -e limits the list to expired pages. stats reports totals, the share of
+expired pages, how many pages were served from the cache at least once
+since they were stored and bytes by path prefix of depth path segments,
+listing the top prefixes by size. Pages are served since stored when their
+last access, which running proxies record in the index if the janitor or
+the warmer runs, is later than their storage; this gives a lower bound
+of the hit ratio, metrics.py counts actual hits.
+purge removes the pages; -n and -v list them.
+
+Everything comes from the cache index; stats and purge look at body files
+in concurrency threads. The proxy may keep running: pages are removed from
+the index first, like the janitor does, so that the proxy stops serving
+them before their files go away. Pages held in memory caches of running
+proxies (local.cache.memory) are served from there for up to
+local.cache.memory.check_interval seconds, after which the proxies find
+them gone from the index; with x-accel-redirect, pages whose files are gone
+are fetched again rather than redirected to.
+'''
+
+import os, os.path, sys, getopt, time, fnmatch, urlparse, urllib, threading, Queue, cherrypy
+
+import tools.file
+import environment
+
+# entries handed to a thread at a time
+BATCH_SIZE = 500
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TB'
+    if unit == 'B':
+        return '%d B' % size
+    return '%.1f %s' % (size, unit)
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+def key_path(key):
+    # request path of a cache key, see cache_key.KeyBuilder.build
+    return key.split('::', 1)[0]
+
+class Selection:
+    '''Pages of a url, a path prefix or a path pattern; all pages without any'''
+    
+    def __init__(self, url=None, prefix=None, pattern=None, key_builder=None):
+        self.key_builder = key_builder
+        self.pattern = pattern
+        self.query_key = None
+        if url is not None:
+            scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+            self.path = urllib.unquote(path or '/')
+            self.query_string = query
+            # query strings equivalent under the key rules select the same pages
+            self.query_key = key_builder.build(self.path, query)[0]
+            self.prefix = self.path
+        elif pattern is not None:
+            # the literal start of the pattern narrows down the index lookup
+            self.prefix = pattern
+            for char in '*?[':
+                self.prefix = self.prefix.split(char, 1)[0]
+        else:
+            self.prefix = prefix
+    
+    def matches(self, key, index):
+        path = key_path(key)
+        if self.query_key is not None:
+            return path == self.path and self._same_query(key, index)
+        if self.pattern is not None:
+            return fnmatch.fnmatchcase(path, self.pattern)
+        return self.prefix is None or path.startswith(self.prefix)
+    
+    def _same_query(self, key, index):
+        headers = index.get(key)
+        if headers is None:
+            # removed while we were going
+            return False
+        if not headers.has_key('x-cache-request'):
+            # saved before requests were recorded, only the page without variants can be told
+            return key == self.query_key
+        path_info, query_string, incoming_host = headers['x-cache-request']
+        return self.key_builder.build(path_info, query_string)[0] == self.query_key
+
+class Stats:
+    '''Totals of a number of cached pages'''
+    
+    def __init__(self):
+        self.entries = self.size = self.files = 0
+        self.expired = self.expired_size = 0
+        # pages with known storage time, and how many of them were served since
+        self.tracked = self.served = 0
+        # files found on disk, pages whose files are all gone
+        self.disk_size = self.disk_files = self.missing = 0
+        # prefix -> [entries, size, expired, served]
+        self.prefixes = {}
+    
+    def add(self, other):
+        for name in ('entries', 'size', 'files', 'expired', 'expired_size', 'tracked', 'served', 'disk_size', 'disk_files', 'missing'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for prefix, counts in other.prefixes.items():
+            totals = self.prefixes.setdefault(prefix, [0, 0, 0, 0])
+            for i in range(len(counts)):
+                totals[i] += counts[i]
+
+def path_prefix(path, depth):
+    parts = path.split('/')
+    if len(parts) > depth + 1:
+        return '/'.join(parts[:depth + 1]) + '/'
+    return path
+
+def share(part, whole):
+    if not whole:
+        return '-'
+    return '%.1f%%' % (100.0 * part / whole)
+
+class CacheInspector:
+    def __init__(self, cache_dir, index, key_builder, publisher=None, concurrency=8, log=None):
+        self.cache_dir = cache_dir
+        self.index = index
+        self.key_builder = key_builder
+        self.publisher = publisher
+        self.concurrency = concurrency
+        self.log = log
+    
+    def select(self, selection):
+        '''Iterates over index entries of selected pages, see CacheIndex.entries'''
+        
+        for entry in self.index.entries(selection.prefix):
+            if selection.matches(entry[0], self.index):
+                yield entry
+    
+    def list(self, selection, expired_only=False, with_urls=False, out=sys.stdout):
+        '''Writes a line for each selected page to out, returning their number'''
+        
+        now = time.time()
+        count = 0
+        for key, expires_at, size, files, file, accessed_at, stored_at in self.select(selection):
+            expired = expires_at < now
+            if expired_only and not expired:
+                continue
+            line = '%10d %2d  %s%s  %s' % (size, files, format_time(expires_at), expired and ' expired' or '        ', key)
+            if with_urls:
+                line += '  ' + self._url(key)
+            out.write(line + '\n')
+            count += 1
+        return count
+    
+    def _url(self, key):
+        headers = self.index.get(key)
+        if headers is None or not headers.has_key('x-cache-request'):
+            return key_path(key)
+        path_info, query_string, incoming_host = headers['x-cache-request']
+        if query_string:
+            return path_info + '?' + query_string
+        return path_info
+    
+    def stats(self, selection, depth=1):
+        '''Returns Stats of selected pages, looking at their files in parallel'''
+        
+        now = time.time()
+        totals = Stats()
+        
+        def count(batch):
+            stats = Stats()
+            for key, expires_at, size, files, file, accessed_at, stored_at in batch:
+                stats.entries += 1
+                stats.size += size
+                stats.files += files
+                expired = expires_at < now
+                if expired:
+                    stats.expired += 1
+                    stats.expired_size += size
+                served = stored_at is not None and accessed_at > stored_at
+                if stored_at is not None:
+                    stats.tracked += 1
+                    if served:
+                        stats.served += 1
+                counts = stats.prefixes.setdefault(path_prefix(key_path(key), depth), [0, 0, 0, 0])
+                counts[0] += 1
+                counts[1] += size
+                counts[2] += int(expired)
+                counts[3] += int(served)
+                
+                found = 0
+                for path in self._body_paths(file):
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    stats.disk_size += stat.st_size
+                    stats.disk_files += 1
+                    found += 1
+                if files and not found:
+                    stats.missing += 1
+            return stats
+        
+        lock = threading.Lock()
+        
+        def add(stats):
+            lock.acquire()
+            try:
+                totals.add(stats)
+            finally:
+                lock.release()
+        
+        self._run(lambda batch: add(count(batch)), self.select(selection))
+        return totals
+    
+    def purge(self, selection, dry_run=False):
+        '''Removes selected pages, returning (number of pages, bytes) removed'''
+        
+        totals = [0, 0]
+        lock = threading.Lock()
+        
+        def remove(batch):
+            pages = size = 0
+            for entry in batch:
+                if dry_run or self._remove(entry):
+                    pages += 1
+                    size += entry[2]
+                    if self.log is not None:
+                        self.log(entry[0])
+            lock.acquire()
+            try:
+                totals[0] += pages
+                totals[1] += size
+            finally:
+                lock.release()
+        
+        self._run(remove, self.select(selection))
+        return tuple(totals)
+    
+    def _remove(self, entry):
+        # returns True if the page was removed, see CacheJanitor._remove
+        key, expires_at, size, files, file = entry[:5]
+        # unless it has been replaced since we looked it up, which makes it current
+        if not self.index.delete(key, expires_at):
+            return False
+        if self.publisher is not None:
+            self.publisher.unpublish(key)
+        for path in self._body_paths(file):
+            tools.file.safe_unlink(path)
+        return True
+    
+    def _body_paths(self, file):
+        absolute_path = os.path.join(self.cache_dir, file)
+        return (absolute_path, absolute_path + '.gz')
+    
+    def _run(self, function, entries):
+        # calls function with batches of entries in up to concurrency threads.
+        # entries are read from the index as threads take them, rather
+        # than all at once, so that large caches do not fill up memory
+        queue = Queue.Queue(self.concurrency * 2)
+        errors = []
+        
+        def work():
+            while True:
+                batch = queue.get()
+                if batch is None:
+                    break
+                try:
+                    function(batch)
+                except Exception, e:
+                    errors.append(e)
+        
+        threads = [threading.Thread(target=work) for i in range(self.concurrency)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        try:
+            batch = []
+            for entry in entries:
+                batch.append(entry)
+                if len(batch) >= BATCH_SIZE:
+                    queue.put(batch)
+                    batch = []
+            if batch:
+                queue.put(batch)
+        finally:
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+def print_stats(stats, top=20):
+    print 'Pages:          %d, %d files, %s' % (stats.entries, stats.files, format_bytes(stats.size))
+    print 'On disk:        %d files, %s, %d pages without files' % (stats.disk_files, format_bytes(stats.disk_size), stats.missing)
+    print 'Expired:        %d pages (%s), %s (%s)' % (stats.expired, share(stats.expired, stats.entries),
+        format_bytes(stats.expired_size), share(stats.expired_size, stats.size))
+    # each page was stored on a miss; pages served since were hit at least once
+    print 'Served since stored: %d of %d pages (%s)' % (stats.served, stats.tracked, share(stats.served, stats.tracked))
+    print 'Hit ratio estimate:  at least %s of requests for these pages' % share(stats.served, stats.tracked + stats.served)
+    if stats.prefixes:
+        print
+        print '%-40s %8s %10s %8s %8s' % ('prefix', 'pages', 'size', 'expired', 'served')
+        prefixes = sorted(stats.prefixes.items(), key=lambda item: item[1][1], reverse=True)
+        for prefix, (entries, size, expired, served) in prefixes[:top]:
+            print '%-40s %8d %10s %8s %8s' % (prefix, entries, format_bytes(size), share(expired, entries), share(served, entries))
+        if len(prefixes) > top:
+            print '(%d more prefixes)' % (len(prefixes) - top)
+
+def create_inspector(concurrency=8, log=None):
+    return CacheInspector(cherrypy.config['local.cache.dir'], environment.get_cache_index(),
+        environment.get_cache_key_builder(), environment.get_cache_publisher(), concurrency, log)
+
+def usage():
+    sys.stderr.write(__doc__.split('\n\n')[1] + '\n')
+    sys.exit(2)
+
+def main(args):
+    environment.load_config(os.path.join(os.path.dirname(__file__), '..'))
+    environment.add_config('production.ini')
+    
+    opts, args = getopt.getopt(args, 'c:')
+    concurrency = 8
+    for opt, value in opts:
+        if opt == '-c':
+            concurrency = int(value)
+    if not args or args[0] not in ('list', 'stats', 'purge'):
+        usage()
+    command = args[0]
+    
+    opts, args = getopt.getopt(args[1:], 'p:m:vend:t:')
+    prefix = pattern = None
+    with_urls = expired_only = dry_run = False
+    depth = 1
+    top = 20
+    for opt, value in opts:
+        if opt == '-p':
+            prefix = value
+        elif opt == '-m':
+            pattern = value
+        elif opt == '-v':
+            with_urls = True
+        elif opt == '-e':
+            expired_only = True
+        elif opt == '-n':
+            dry_run = True
+        elif opt == '-d':
+            depth = int(value)
+        elif opt == '-t':
+            top = int(value)
+    url = None
+    if args:
+        url = args[0]
+    if len(args) > 1 or len([value for value in (url, prefix, pattern) if value is not None]) > 1:
+        usage()
+    
+    if not cherrypy.config.get('local.cache.enabled'):
+        print 'Cache is not enabled'
+        sys.exit(1)
+    log = None
+    if command == 'purge' and (with_urls or dry_run):
+        log = lambda message: sys.stdout.write(message + '\n')
+    inspector = create_inspector(concurrency, log)
+    selection = Selection(url, prefix, pattern, inspector.key_builder)
+    
+    if command == 'list':
+        inspector.list(selection, expired_only, with_urls)
+    elif command == 'stats':
+        print_stats(inspector.stats(selection, depth), top)
+    else:
+        if selection.prefix is None and not dry_run:
+            # purging everything is what removing the cache directory is for
+            print 'Select pages to purge'
+            sys.exit(2)
+        pages, size = inspector.purge(selection, dry_run)
+        if dry_run:
+            print 'Would purge %d pages, %s' % (pages, format_bytes(size))
+        else:
+            print 'Purged %d pages, %s' % (pages, format_bytes(size))
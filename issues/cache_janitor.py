@@ -0,0 +1,190 @@
+import cherrypy, os, os.path, time
+
+import environment
+import tools.file
+
+class CacheJanitor:
+    '''Keeps the on-disk cache within its size and inode budget.
+    
+    Each sweep removes leftover temporary files, bodies that are not in
+    the cache index and empty directories, then expired pages. If the cache
+    is still over budget, least recently used pages are removed until it is
+    below low_water of the budget.
+    
+    Sweeps walk the whole cache and are meant to run in a background thread.
+    '''
+    
+    def __init__(self, cache_dir, index, max_bytes=None, max_inodes=None, tmp_max_age=3600, stale_grace=0, low_water=0.9, remove_empty_dirs=True):
+        self.cache_dir = cache_dir
+        self.index = index
+        self.remove_empty_dirs = remove_empty_dirs
+        self.max_bytes = max_bytes
+        self.max_inodes = max_inodes
+        self.tmp_max_age = tmp_max_age
+        self.stale_grace = stale_grace
+        self.low_water = low_water
+        # last access times of pages since previous sweep, the proxy updates this
+        self.access_times = {}
+    
+    def sweep(self):
+        '''Performs one pass over the cache'''
+        
+        now = time.time()
+        self.record_accesses()
+        total_bytes, total_inodes = self._scan(now)
+        
+        # expired pages go first regardless of budget.
+        # stop if nothing could be removed, which happens when pages
+        # are being replaced faster than we remove them
+        removed = True
+        while removed:
+            removed = False
+            for entry in self.index.expired(now - self.stale_grace):
+                if self._remove(entry):
+                    total_bytes, total_inodes = total_bytes - entry[2], total_inodes - entry[3]
+                    removed = True
+        
+        removed = True
+        while removed and self._over_budget(total_bytes, total_inodes, 1):
+            removed = False
+            for entry in self.index.least_recently_used():
+                if not self._over_budget(total_bytes, total_inodes, self.low_water):
+                    return
+                if self._remove(entry):
+                    total_bytes, total_inodes = total_bytes - entry[2], total_inodes - entry[3]
+                    removed = True
+    
+    def record_accesses(self):
+        '''Writes access times collected since last call to the index'''
+        
+        record_accesses(self.index, self.access_times)
+    
+    def _over_budget(self, total_bytes, total_inodes, fraction):
+        if self.max_bytes is not None and total_bytes > self.max_bytes * fraction:
+            return True
+        if self.max_inodes is not None and total_inodes > self.max_inodes * fraction:
+            return True
+        return False
+    
+    def _scan(self, now):
+        # returns (total_bytes, total_inodes) after removing leftover
+        # temporary files, files not belonging to any page and empty directories
+        total_bytes = total_inodes = 0
+        index_prefix = os.path.join(self.cache_dir, '.index')
+        locks_dir = os.path.join(self.cache_dir, '.locks')
+        publisher = environment.get_cache_publisher()
+        for dir, dirs, files in os.walk(self.cache_dir, topdown=False):
+            # lock files of single flight fetches across processes must stay put,
+            # pages published for nginx are links to files counted elsewhere
+            if dir == locks_dir or publisher is not None and (dir + '/').startswith(publisher.dir.rstrip('/') + '/'):
+                continue
+            if self.remove_empty_dirs and not files and not dirs and dir != self.cache_dir:
+                self._remove_empty_dir(dir)
+                continue
+            total_inodes += 1
+            for file in files:
+                path = os.path.join(dir, file)
+                if path.startswith(index_prefix):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # removed by somebody else
+                    continue
+                
+                # temporary files are left behind by a crashed tools.file.safe_write,
+                # orphans by a process that crashed between writing the body and
+                # indexing it, or they predate the index; give writers time to finish
+                if stat.st_mtime + self.tmp_max_age < now:
+                    if '.tmp.' in file or not self._is_indexed(path):
+                        tools.file.safe_unlink(path)
+                        continue
+                
+                total_bytes += stat.st_size
+                total_inodes += 1
+        return total_bytes, total_inodes
+    
+    def _is_indexed(self, path):
+        file = os.path.relpath(path, self.cache_dir)
+        if self.index.has_file(file):
+            return True
+        if file.endswith('.gz') and self.index.has_file(file[:-len('.gz')]):
+            return True
+        # entries saved before file paths were recorded
+        if self.index.has('/' + file):
+            return True
+        if file.endswith('.gz') and self.index.has('/' + file[:-len('.gz')]):
+            return True
+        return False
+    
+    def _remove(self, entry):
+        # returns True if the page was removed
+        key, expires_at, size, files, file = entry
+        # forget the page first so that the proxy stops serving it,
+        # unless it has been replaced since we looked it up
+        if not self.index.delete(key, expires_at):
+            return False
+        memory_cache = environment.get_memory_cache()
+        if memory_cache is not None:
+            memory_cache.delete(key)
+        publisher = environment.get_cache_publisher()
+        if publisher is not None:
+            publisher.unpublish(key)
+        absolute_path = os.path.join(self.cache_dir, file)
+        for path in (absolute_path, absolute_path + '.gz'):
+            tools.file.safe_unlink(path)
+        return True
+    
+    def _remove_empty_dir(self, dir):
+        try:
+            os.rmdir(dir)
+        except OSError:
+            # a page was saved into it in the meantime
+            pass
+
+def record_accesses(index, access_times):
+    '''Moves access times from access_times, which the proxy may be adding to, to index'''
+    
+    collected = {}
+    for key in access_times.keys():
+        collected[key] = access_times.pop(key)
+    if collected:
+        index.record_accesses(collected)
+
+def subscribe(bus, sweep=True):
+    '''Runs a janitor configured from cherrypy.config in a monitor thread on bus.
+    
+    If sweep is False, the janitor only records page accesses of this process,
+    leaving sweeping to a janitor in another process sharing the cache.'''
+    
+    import proxy
+    
+    janitor = CacheJanitor(cherrypy.config['local.cache.dir'], environment.get_cache_index(),
+        max_bytes=cherrypy.config.get('local.cache.max_bytes'),
+        max_inodes=cherrypy.config.get('local.cache.max_inodes'),
+        tmp_max_age=cherrypy.config.get('local.cache.janitor.tmp_max_age', 3600),
+        # pages past their stale grace may still be served when the remote host fails
+        stale_grace=max(cherrypy.config.get('local.cache.stale_grace', 0), cherrypy.config.get('local.cache.stale_if_error', 0)),
+        # shard directories are created once at startup
+        remove_empty_dirs=not environment.get_cache_layout().has_fixed_dirs())
+    janitor.access_times = proxy.cache_access_times
+    proxy.record_access_times = True
+    
+    if sweep:
+        work = janitor.sweep
+        frequency = cherrypy.config.get('local.cache.janitor.interval', 600)
+    else:
+        work = janitor.record_accesses
+        frequency = cherrypy.config.get('local.cache.janitor.access_interval', 60)
+    
+    def run():
+        try:
+            work()
+        except Exception:
+            cherrypy.log('Error sweeping cache', traceback=True)
+    
+    from cherrypy.process import plugins
+    
+    monitor = plugins.Monitor(bus, run, frequency=frequency)
+    monitor.subscribe()
+    return janitor
@@ -0,0 +1,137 @@
+'''Cache keys of requests.
+
+Without any rules configured a key is the request path, followed by
+a hash of the query string if there is one. Rules make equivalent
+requests share a key:
+
+- local.cache.key.sort_params: order of query parameters does not matter
+- local.cache.key.ignore_params: list of query parameters which do not
+  affect the page, e.g. tracking parameters
+- local.cache.key.vary_headers: list of request headers the page depends
+  on; accept-encoding is reduced to whether the client accepts gzip
+- local.cache.key.cookie_state: requests with and without cookies get
+  separate keys, except on public paths where cookies are not sent upstream
+'''
+
+import urllib, threading, cherrypy
+
+import tools.hashlib_shortcuts, tools.gzip_shortcuts
+
+class KeyBuilder:
+    def __init__(self, sort_params=False, ignore_params=(), vary_headers=(), cookie_state=False, public_paths_re=None):
+        self.sort_params = sort_params
+        self.ignore_params = frozenset(ignore_params)
+        self.vary_headers = [header.lower() for header in vary_headers]
+        self.cookie_state = cookie_state
+        self.public_paths_re = public_paths_re
+        # rule name -> [requests whose key the rule changed, cache hits among them]
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+    
+    def build(self, path_info, query_string, headers=None):
+        '''Returns (key, rules) for a request, rules being names of
+        the rules which changed the key.
+        
+        headers are request headers; if None, rules depending on them
+        are not applied.'''
+        
+        rules = []
+        if query_string and (self.sort_params or self.ignore_params):
+            query_string = self._normalize_query_string(query_string, rules)
+        
+        if headers is not None:
+            variant = self._variant(path_info, headers, rules)
+        else:
+            variant = None
+        
+        if variant:
+            hashed = tools.hashlib_shortcuts.md5_hexdigest((query_string or '') + '\n' + variant)
+        elif query_string:
+            hashed = tools.hashlib_shortcuts.md5_hexdigest(query_string)
+        else:
+            return path_info, rules
+        return path_info + '::' + hashed, rules
+    
+    def _normalize_query_string(self, query_string, rules):
+        pairs = query_string.split('&')
+        if self.ignore_params:
+            kept = [pair for pair in pairs if pair and urllib.unquote_plus(pair.split('=', 1)[0]) not in self.ignore_params]
+            if len(kept) < len([pair for pair in pairs if pair]):
+                rules.append('ignore_params')
+            pairs = kept
+        if self.sort_params:
+            pairs = [pair for pair in pairs if pair]
+            sorted_pairs = sorted(pairs)
+            if sorted_pairs != pairs:
+                rules.append('sort_params')
+            pairs = sorted_pairs
+        return '&'.join(pairs)
+    
+    def _variant(self, path_info, headers, rules):
+        parts = []
+        for header in self.vary_headers:
+            value = headers.get(header)
+            if header == 'accept-encoding':
+                if tools.gzip_shortcuts.accepts_gzip(value):
+                    value = 'gzip'
+                else:
+                    value = None
+            if value is not None:
+                parts.append('%s: %s' % (header, value))
+                rules.append('vary:' + header)
+        if self.cookie_state and headers.has_key('cookie'):
+            if self.public_paths_re is None or not self.public_paths_re.match(path_info):
+                parts.append('cookie')
+                rules.append('cookie_state')
+        return '\n'.join(parts)
+    
+    def record(self, rules, hit):
+        '''Records whether a request whose key was changed by rules was
+        served from the cache'''
+        
+        if not rules:
+            return
+        self._stats_lock.acquire()
+        try:
+            for rule in rules:
+                counts = self._stats.get(rule)
+                if counts is None:
+                    counts = self._stats[rule] = [0, 0]
+                counts[0] += 1
+                if hit:
+                    counts[1] += 1
+        finally:
+            self._stats_lock.release()
+    
+    def stats(self):
+        '''Returns a dict of rule name -> (requests whose key the rule changed,
+        cache hits among them).
+        
+        Hits on keys changed by sort_params and ignore_params are requests
+        which would have missed the cache without the rule, or at least
+        would have needed an entry of their own.'''
+        
+        self._stats_lock.acquire()
+        try:
+            return dict([(rule, tuple(counts)) for rule, counts in self._stats.items()])
+        finally:
+            self._stats_lock.release()
+
+def format_stats(stats):
+    '''Returns stats of KeyBuilder as a human readable string'''
+    
+    parts = []
+    for rule in sorted(stats.keys()):
+        applied, hits = stats[rule]
+        parts.append('%s: %d of %d hit' % (rule, hits, applied))
+    return ', '.join(parts)
+
+def subscribe(bus, builder):
+    '''Logs statistics of builder's rules when bus stops'''
+    
+    def log_stats():
+        stats = builder.stats()
+        if stats:
+            cherrypy.log('Cache key rules: %s' % format_stats(stats))
+    
+    bus.subscribe('stop', log_stats)
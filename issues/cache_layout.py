@@ -0,0 +1,62 @@
+import os, os.path
+
+import tools.hashlib_shortcuts, tools.file
+
+class MirrorLayout:
+    '''Stores pages under their request paths'''
+    
+    name = 'mirror'
+    
+    def file_path(self, key):
+        '''Returns path of the file holding page with given key, relative to cache directory'''
+        
+        return key[1:]
+    
+    def prepare(self, cache_dir):
+        pass
+    
+    def has_fixed_dirs(self):
+        return False
+
+class ShardedLayout:
+    '''Stores pages under hashes of their keys in a fixed number
+    of directory levels, e.g. ab/cd/abcd... for depth of 2'''
+    
+    name = 'sharded'
+    
+    def __init__(self, depth=2):
+        self.depth = depth
+    
+    def file_path(self, key):
+        hash = tools.hashlib_shortcuts.md5_hexdigest(key)
+        parts = [hash[level*2:level*2+2] for level in range(self.depth)]
+        parts.append(hash)
+        return '/'.join(parts)
+    
+    def prepare(self, cache_dir):
+        '''Creates all shard directories, so that saving pages never has to'''
+        
+        shards = ['%02x' % shard for shard in range(256)]
+        dirs = ['']
+        for level in range(self.depth):
+            dirs = [os.path.join(dir, shard) for dir in dirs for shard in shards]
+        for dir in dirs:
+            path = os.path.join(cache_dir, dir)
+            if not os.path.isdir(path):
+                tools.file.safe_mkdirs(path)
+    
+    def has_fixed_dirs(self):
+        return True
+
+# each level has 256 directories, so that 4 levels would be 4 billion of them
+MIN_SHARD_DEPTH = 1
+MAX_SHARD_DEPTH = 3
+
+def create_layout(name, shard_depth=2):
+    if not isinstance(shard_depth, (int, long)) or not MIN_SHARD_DEPTH <= shard_depth <= MAX_SHARD_DEPTH:
+        raise ValueError('Shard depth must be between %d and %d: %r' % (MIN_SHARD_DEPTH, MAX_SHARD_DEPTH, shard_depth))
+    if name == 'mirror':
+        return MirrorLayout()
+    if name == 'sharded':
+        return ShardedLayout(shard_depth)
+    raise ValueError('Unknown cache layout: %s' % name)
@@ -0,0 +1,146 @@
+'''Moves cached pages into another cache layout.
+
+Usage: script/migrate-cache [-l layout] [-d shard_depth]
+
+Layout and shard depth, 1 to 3, default to local.cache.layout and
+local.cache.shard_depth.
+Configure the proxy with the target layout first; it keeps serving pages
+from their old locations until they are moved, since the cache index
+records where each page is stored.
+'''
+
+import os, os.path, errno, sys, getopt, cherrypy
+
+import tools.file
+import environment, settings, cache_layout, proxy
+
+# seconds to wait for a page being fetched before leaving it in place
+LOCK_TIMEOUT = 60
+
+def migrate(index, cache_dir, layout, log=None, locks_dir=None):
+    '''Moves bodies of all indexed pages to where layout puts them.
+    
+    Pages are never moved over one a running proxy saved there in the
+    meantime. If proxies share fetches through lock files in locks_dir,
+    each page is moved under the lock they hold while saving it.
+    
+    Returns number of pages moved.'''
+    
+    layout.prepare(cache_dir)
+    moved = 0
+    for key in index.keys():
+        lock = None
+        if locks_dir is not None:
+            lock = proxy.shared_flight_lock(locks_dir, key)
+            if not lock.acquire(LOCK_TIMEOUT):
+                # being fetched for a long time; moved on the next run
+                continue
+        try:
+            if _move(index, cache_dir, layout, key, log):
+                moved += 1
+        finally:
+            if lock is not None:
+                lock.release()
+    
+    _remove_empty_dirs(cache_dir)
+    # empty shard directories were removed as well
+    layout.prepare(cache_dir)
+    return moved
+
+def _move(index, cache_dir, layout, key, log):
+    headers = index.get(key)
+    if headers is None:
+        # removed while we were going
+        return False
+    old_file = headers.get('x-cache-file') or key[1:]
+    new_file = layout.file_path(key)
+    if old_file == new_file:
+        return False
+    
+    suffixes = []
+    if headers.get('x-cache-raw', True):
+        suffixes.append('')
+    if headers.get('x-cache-gzip'):
+        suffixes.append('.gz')
+    new_dir = os.path.dirname(os.path.join(cache_dir, new_file))
+    if not os.path.exists(new_dir):
+        tools.file.safe_mkdirs(new_dir)
+    old_paths = [os.path.join(cache_dir, old_file) + suffix for suffix in suffixes]
+    new_paths = [os.path.join(cache_dir, new_file) + suffix for suffix in suffixes]
+    # bodies are linked into the new location rather than renamed, since
+    # os.rename would replace a body saved there again in the meantime
+    try:
+        for old_path, new_path in zip(old_paths, new_paths):
+            os.link(old_path, new_path)
+    except OSError, e:
+        if e.errno not in (errno.ENOENT, errno.EEXIST):
+            raise
+        # removed by the janitor, or saved again into the new layout
+        _remove_links(old_paths, new_paths)
+        return False
+    
+    expires_at = headers['x-expires-timestamp']
+    headers['x-cache-file'] = new_file
+    # the old bodies are only removed once the index points to the new ones;
+    # the page may have been saved again or revalidated in the meantime
+    if not index.update_headers(key, headers, expires_at, old_file):
+        _remove_links(old_paths, new_paths)
+        return False
+    for old_path in old_paths:
+        tools.file.safe_unlink(old_path)
+    if log is not None:
+        log('%s: %s -> %s' % (key, old_file, new_file))
+    return True
+
+def _remove_links(old_paths, new_paths):
+    # removes links made into the new location, but not bodies saved there since
+    for old_path, new_path in zip(old_paths, new_paths):
+        try:
+            if os.path.samefile(old_path, new_path):
+                os.unlink(new_path)
+        except OSError:
+            pass
+
+def _remove_empty_dirs(cache_dir):
+    for dir, dirs, files in os.walk(cache_dir, topdown=False):
+        if dir != cache_dir and not os.listdir(dir):
+            try:
+                os.rmdir(dir)
+            except OSError:
+                # a page was saved into it in the meantime
+                pass
+
+def usage():
+    sys.stderr.write(__doc__.split('\n\n')[1] + '\n')
+    sys.exit(2)
+
+def main(args):
+    environment.load_config(os.path.join(os.path.dirname(__file__), '..'))
+    environment.add_config('production.ini')
+    
+    opts, args = getopt.getopt(args, 'l:d:v')
+    layout_name = cherrypy.config.get('local.cache.layout', 'mirror')
+    shard_depth = cherrypy.config.get('local.cache.shard_depth', 2)
+    log = None
+    for opt, value in opts:
+        if opt == '-l':
+            layout_name = value
+        elif opt == '-d':
+            try:
+                shard_depth = int(value)
+            except ValueError:
+                usage()
+        elif opt == '-v':
+            log = lambda message: sys.stdout.write(message + '\n')
+    
+    try:
+        layout = cache_layout.create_layout(layout_name, shard_depth)
+    except ValueError, e:
+        sys.stderr.write('%s\n' % e)
+        usage()
+    locks_dir = None
+    if cherrypy.config.get('local.cache.single_flight.shared'):
+        locks_dir = settings.get().locks_dir
+    moved = migrate(environment.get_cache_index(), cherrypy.config['local.cache.dir'], layout, log, locks_dir)
+    print 'Moved %d pages into %s layout' % (moved, layout.name)
+
@@ -0,0 +1,339 @@
+'''Publishes cached pages for nginx to serve without asking the proxy.
+
+Pages whose key is their request path, that is pages requested without
+a query string and not varying on request headers, are published as
+symlinks to their cached bodies:
+
+    <publish dir>/<path>.<extension>
+
+where extension stands for the content type of the page, e.g.
+issues-text-html. nginx tries the published names for the requested
+path and serves the first that exists with the content type mapped to
+its extension; everything else goes to the proxy.
+
+nginx knows nothing of when pages expire. The primary proxy process
+unpublishes pages somewhat ahead of expiring, every
+local.cache.publish.interval, so that nginx does not serve a page the proxy
+would revalidate, and unpublishes all pages when it stops. Pages left
+published by a proxy which was killed are served until the proxy is
+started again and unpublishes them on its first sweep.
+
+Published pages are sent with Cache-Control public,
+max-age=local.cache.publish.max_age in place of their own, and without
+an ETag. Their Last-Modified is carried over as modification time of
+their bodies. Pages with an ETag or Content-Disposition, which nginx
+cannot send, are not published.
+
+nginx configuration doing this is generated from the same configuration
+the proxy uses, by script/nginx-cache-config, which script/nginx runs
+before starting or reloading nginx:
+
+Usage: script/nginx-cache-config [-o path]
+
+Without -o the configuration is written to standard output.
+
+Configuration:
+
+local.cache.publish.enabled
+local.cache.publish.dir: defaults to .published in the cache directory
+local.cache.publish.content_types: content types of pages to publish
+local.cache.publish.charset_types: content types which are published
+    only if their charset is utf-8; others only if they have no charset
+local.cache.publish.max_age
+local.cache.publish.interval: how often expiring pages are unpublished
+'''
+
+import os, os.path, sys, re, time, getopt, shutil
+import cherrypy
+
+import environment
+import tools.file, tools.http_headers
+
+DEFAULT_CONTENT_TYPES = ('text/html', 'text/xml', 'application/xml', 'application/json', 'text/css',
+    'application/javascript', 'text/javascript', 'image/png', 'image/gif', 'image/jpeg')
+DEFAULT_CHARSET_TYPES = ('text/html', 'text/xml', 'application/xml', 'application/json')
+
+# named location the generated configuration passes requests to
+FALLBACK_LOCATION = '@issues'
+
+def extension(content_type):
+    '''Returns extension of published names of pages of content_type'''
+    
+    return 'issues-' + re.sub(r'[^a-z0-9]+', '-', content_type.lower()).strip('-')
+
+def parse_content_type(value):
+    '''Returns (type, charset) of a content type header value,
+    both in lower case, charset being None if not given'''
+    
+    parts = [part.strip() for part in value.lower().split(';')]
+    charset = None
+    for part in parts[1:]:
+        if part.startswith('charset='):
+            charset = part[len('charset='):].strip('"')
+    return parts[0], charset
+
+class Publisher:
+    def __init__(self, dir, content_types=DEFAULT_CONTENT_TYPES, charset_types=DEFAULT_CHARSET_TYPES, max_age=0, interval=30):
+        self.dir = dir
+        self.content_types = [content_type.lower() for content_type in content_types]
+        # nginx always adds the charset to text/html
+        self.charset_types = frozenset([content_type.lower() for content_type in charset_types] + ['text/html'])
+        self.max_age = max_age
+        self.interval = interval
+        # pages are unpublished this long before they expire; nginx may not look
+        # at the link again for up to an interval and clients keep what they got for max_age
+        self.ahead = interval + max_age
+        # unpublish_expiring has looked at pages expiring before this time
+        self._checked_until = 0
+        # key -> (expires_at, absolute_path, time) of pages this process knows
+        # to have been published at that time, sparing a look at their links
+        # on every request
+        self._published = {}
+    
+    # pages published by this process are forgotten beyond this number
+    max_known = 100000
+    
+    def publishable_extension(self, key, headers):
+        '''Returns extension of the published name of a cached page,
+        None if the page cannot be published'''
+        
+        # keys of other requests contain a hash of their query string and headers,
+        # see cache_key.KeyBuilder.build
+        if '::' in key or len(key) < 2:
+            return None
+        # nginx would serve error pages and redirects with status 200;
+        # try_files needs the uncompressed body
+        if headers.has_key('x-cache-status') or not headers.get('x-cache-raw', True):
+            return None
+        if not headers.has_key('content-type'):
+            return None
+        # nginx sends its own validators and no other headers of the page
+        if headers.has_key('etag') or headers.has_key('content-disposition'):
+            return None
+        if headers.has_key('last-modified') and tools.http_headers.parse_http_date(headers['last-modified']) is None:
+            return None
+        content_type, charset = parse_content_type(headers['content-type'])
+        if content_type not in self.content_types:
+            return None
+        if content_type in self.charset_types:
+            if charset != 'utf-8':
+                return None
+        elif charset is not None:
+            return None
+        return extension(content_type)
+    
+    def publish(self, key, headers, absolute_path, replace=True):
+        '''Publishes cached page stored under key with body in absolute_path,
+        if it can be published and does not expire soon.
+        
+        Unless replace is True, a page which is published already is left alone.'''
+        
+        ext = self.publishable_extension(key, headers)
+        now = time.time()
+        expires_at = headers['x-expires-timestamp']
+        if ext is None or expires_at - self.ahead <= now:
+            return
+        link = os.path.join(self.dir, key[1:] + '.' + ext)
+        if not replace:
+            known = self._published.get(key)
+            # other processes unpublish pages too; look at the link again once in an interval
+            if known is not None and known[:2] == (expires_at, absolute_path) and known[2] + self.interval > now:
+                return
+            if os.path.lexists(link):
+                self._remember(key, expires_at, absolute_path, now)
+                return
+        paths = [absolute_path]
+        if headers.get('x-cache-gzip'):
+            paths.append(absolute_path + '.gz')
+        try:
+            dir = os.path.dirname(link)
+            if not os.path.exists(dir):
+                tools.file.safe_mkdirs(dir)
+            if headers.has_key('last-modified'):
+                # nginx sends modification time of the file it serves as Last-Modified
+                last_modified = tools.http_headers.parse_http_date(headers['last-modified'])
+                for path in paths:
+                    os.utime(path, (last_modified, last_modified))
+            tools.file.safe_symlink(absolute_path, link)
+            if headers.get('x-cache-gzip'):
+                # picked by gzip_static
+                tools.file.safe_symlink(absolute_path + '.gz', link + '.gz')
+            else:
+                tools.file.safe_unlink(link + '.gz')
+        except OSError, e:
+            # e.g. a path clashing with a directory; such a page is served by the proxy
+            cherrypy.log('Cannot publish %s: %s' % (key, e))
+            return
+        self._remember(key, expires_at, absolute_path, now)
+    
+    def _remember(self, key, expires_at, absolute_path, now):
+        if len(self._published) >= self.max_known:
+            self._published.clear()
+        self._published[key] = (expires_at, absolute_path, now)
+    
+    def unpublish(self, key):
+        '''Removes published names of the page stored under key'''
+        
+        if '::' in key or len(key) < 2:
+            return
+        self._published.pop(key, None)
+        base = os.path.join(self.dir, key[1:]) + '.'
+        for content_type in self.content_types:
+            link = base + extension(content_type)
+            # most pages are never published; save the unlinks
+            if os.path.lexists(link):
+                tools.file.safe_unlink(link)
+                tools.file.safe_unlink(link + '.gz')
+    
+    def unpublish_all(self):
+        '''Removes all published pages'''
+        
+        self._published.clear()
+        if not os.path.isdir(self.dir):
+            return
+        # moved aside first, so that nginx stops serving all of them at once
+        removed = '%s.removed.%d' % (self.dir.rstrip('/'), os.getpid())
+        try:
+            os.rename(self.dir, removed)
+        except OSError, e:
+            cherrypy.log('Cannot unpublish %s: %s' % (self.dir, e))
+            return
+        shutil.rmtree(removed, True)
+    
+    def unpublish_expiring(self, index, limit=1000):
+        '''Unpublishes pages which expire soon, returning their number'''
+        
+        until = time.time() + self.ahead
+        after = self._checked_until
+        count = 0
+        while True:
+            entries = index.expiring(after, until, limit)
+            for key, expires_at, accessed_at in entries:
+                self.unpublish(key)
+            count += len(entries)
+            if len(entries) < limit:
+                break
+            # entries expiring at the same time as the last one are looked at twice
+            after = entries[-1][1]
+        self._checked_until = until
+        return count
+    
+    def nginx_config(self, key_builder, public_paths_re):
+        '''Returns nginx directives serving published pages for location /,
+        passing requests for other pages to FALLBACK_LOCATION.
+        
+        key_builder and public_paths_re are those the proxy uses,
+        see environment.get_cache_key_builder.'''
+        
+        lines = [
+            'error_page 418 = %s;' % FALLBACK_LOCATION,
+            '# requests whose cache key is not their path',
+            'if ($request_method !~ ^(GET|HEAD)$) {',
+            '    return 418;',
+            '}',
+            'if ($args) {',
+            '    return 418;',
+            '}',
+        ]
+        for header in key_builder.vary_headers:
+            lines.extend([
+                'if ($http_%s) {' % header.replace('-', '_'),
+                '    return 418;',
+                '}',
+            ])
+        if key_builder.cookie_state:
+            lines.extend([
+                'set $issues_cookie $http_cookie;',
+                'if ($uri ~ "^%s") {' % public_paths_re.pattern.lstrip('^'),
+                '    set $issues_cookie "";',
+                '}',
+                'if ($issues_cookie) {',
+                '    return 418;',
+                '}',
+            ])
+        lines.append('')
+        lines.append('root %s;' % self.dir)
+        lines.append('types {')
+        for content_type in self.content_types:
+            lines.append('    %s %s;' % (content_type, extension(content_type)))
+        lines.append('}')
+        lines.append('charset utf-8;')
+        lines.append('charset_types %s;' % ' '.join(sorted(self.charset_types.intersection(self.content_types))))
+        lines.append('gzip_static on;')
+        lines.append('gzip_vary on;')
+        lines.append('# validators of the pages themselves are not known to nginx')
+        lines.append('etag off;')
+        lines.append('add_header Cache-Control "public, max-age=%d";' % self.max_age)
+        lines.append('try_files %s %s;' % (' '.join(['$uri.' + extension(content_type) for content_type in self.content_types]), FALLBACK_LOCATION))
+        return '\n'.join(lines) + '\n'
+
+def create_publisher():
+    '''Returns a publisher configured from cherrypy.config'''
+    
+    dir = cherrypy.config.get('local.cache.publish.dir')
+    if dir is None:
+        dir = os.path.join(cherrypy.config['local.cache.dir'], '.published')
+    return Publisher(dir,
+        content_types=cherrypy.config.get('local.cache.publish.content_types', DEFAULT_CONTENT_TYPES),
+        charset_types=cherrypy.config.get('local.cache.publish.charset_types', DEFAULT_CHARSET_TYPES),
+        max_age=cherrypy.config.get('local.cache.publish.max_age', 0),
+        interval=cherrypy.config.get('local.cache.publish.interval', 30))
+
+def nginx_config():
+    '''Returns nginx directives for location / as configured in cherrypy.config'''
+    
+    header = '# generated from proxy configuration by script/nginx-cache-config, do not edit\n'
+    publisher = environment.get_cache_publisher()
+    if publisher is None:
+        # everything goes to the proxy
+        return header + 'error_page 418 = %s;\nreturn 418;\n' % FALLBACK_LOCATION
+    
+    import proxy
+    
+    return header + publisher.nginx_config(environment.get_cache_key_builder(), proxy.Proxy.public_paths_re)
+
+def nginx_config_path():
+    return os.path.join(environment.fs_root, 'config', 'nginx.cache.conf')
+
+def subscribe(bus):
+    '''Unpublishes expiring pages in a monitor thread on bus and all
+    pages on stop, and warns on start if nginx configuration does not
+    match proxy configuration'''
+    
+    publisher = environment.get_cache_publisher()
+    
+    def check_nginx_config():
+        path = nginx_config_path()
+        if os.path.exists(path) and tools.file.read(path) != nginx_config():
+            cherrypy.log('%s does not match cache configuration, run script/nginx reload' % path)
+    
+    def unpublish():
+        try:
+            publisher.unpublish_expiring(environment.get_cache_index())
+        except Exception:
+            cherrypy.log('Error unpublishing cache', traceback=True)
+    
+    bus.subscribe('start', check_nginx_config)
+    # nobody would unpublish pages as they expire
+    bus.subscribe('stop', publisher.unpublish_all)
+    from cherrypy.process import plugins
+    
+    monitor = plugins.Monitor(bus, unpublish, frequency=publisher.interval)
+    monitor.subscribe()
+    return publisher
+
+def main(args):
+    environment.load_config(os.path.join(os.path.dirname(__file__), '..'))
+    environment.add_config('production.ini')
+    
+    opts, args = getopt.getopt(args, 'o:')
+    output = None
+    for opt, value in opts:
+        if opt == '-o':
+            output = value
+    
+    config = nginx_config()
+    if output is None:
+        sys.stdout.write(config)
+    elif not os.path.exists(output) or tools.file.read(output) != config:
+        tools.file.safe_write(output, config)
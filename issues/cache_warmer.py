@@ -0,0 +1,276 @@
+'''Fills the cache ahead of visitors.
+
+Warming fetches pages listed in a seed file, or the pages requested most
+often according to an nginx access log, through the caching proxy, so that
+they are cached the way pages fetched on behalf of visitors are.
+Refreshing revalidates cached pages which were accessed recently shortly
+before they expire.
+
+Usage: script/warm-cache [-a access_log] [-n top] [-c concurrency] [-H host] [-v] [seed_file]
+
+Seed files list one path, optionally with query string, per line; blank lines
+and lines starting with # are ignored. Pages from an access log are ranked
+by number of successful GET requests. Options default to configuration:
+
+-a  local.cache.warmer.access_log
+-n  local.cache.warmer.top, number of pages to warm
+-c  local.cache.warmer.concurrency, number of pages fetched at a time
+-H  local.cache.warmer.host, host links in pages point to; defaults to
+    local.host, or the remote host
+'''
+
+import os.path, sys, re, time, threading, Queue, getopt, urllib
+import cherrypy
+from cherrypy import _cprequest
+from cherrypy.lib import httputil
+
+import environment, main_controller
+
+access_log_request_re = re.compile(r'"GET (\S+) HTTP/[\d.]+" (\d{3}) ')
+
+def read_seed_file(path):
+    '''Returns paths listed in a seed file'''
+    
+    paths = []
+    for line in open(path):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            paths.append(line)
+    return paths
+
+def read_access_log(path, top):
+    '''Returns up to top paths requested most often according to
+    an nginx access log in combined or default format'''
+    
+    counts = {}
+    for line in open(path):
+        match = access_log_request_re.search(line)
+        if match is not None and match.group(2) in ('200', '304'):
+            path = match.group(1)
+            counts[path] = counts.get(path, 0) + 1
+    ranked = sorted(counts.items(), key=lambda item: -item[1])
+    return [path for path, count in ranked[:top]]
+
+def run_bounded(function, items, concurrency):
+    '''Calls function with each of items, in up to concurrency threads at a time'''
+    
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+    
+    def work():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                break
+            function(item)
+    
+    threads = [threading.Thread(target=work) for i in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+class CacheWarmer:
+    def __init__(self, host, concurrency=4, refresh_ahead=60, refresh_accessed_within=3600, log=None):
+        self.host = host
+        self.concurrency = concurrency
+        self.refresh_ahead = refresh_ahead
+        self.refresh_accessed_within = refresh_accessed_within
+        self.log = log
+        self._counts_lock = threading.Lock()
+    
+    def warm(self, paths):
+        '''Fetches paths which are not cached yet.
+        
+        Returns a dict of outcome -> number of paths, outcomes being
+        cached (fetched and saved), hit (cached already), uncacheable,
+        skipped (served without the proxy) and failed.'''
+        
+        counts = {}
+        run_bounded(lambda path: self._warm_one(path, counts), paths, self.concurrency)
+        return counts
+    
+    def refresh_expiring(self):
+        '''Revalidates pages accessed within refresh_accessed_within seconds
+        which expire within refresh_ahead seconds.
+        
+        Returns number of pages revalidated.'''
+        
+        import proxy
+        
+        now = time.time()
+        accessed_after = now - self.refresh_accessed_within
+        keys = []
+        for key, expires_at, accessed_at in environment.get_cache_index().expiring(now, now + self.refresh_ahead):
+            # accesses are written to the index periodically by the janitor
+            if max(accessed_at, proxy.cache_access_times.get(key, 0)) >= accessed_after:
+                keys.append(key)
+        counts = {}
+        run_bounded(lambda key: self._refresh_one(key, counts), keys, self.concurrency)
+        return counts.get('refreshed', 0)
+    
+    def _warm_one(self, path, counts):
+        import proxy
+        
+        path_info, query_string = (path.split('?', 1) + [''])[:2]
+        path_info = urllib.unquote(path_info)
+        if self._served_by_controller(path_info):
+            self._count(counts, 'skipped')
+            return
+        try:
+            try:
+                self._load_request(path_info, query_string)
+                response = environment.get_proxy().perform_and_propagate(stream=False)
+                if isinstance(response, proxy.ContentWrapper):
+                    outcome = 'hit'
+                elif environment.get_cache_index().has(environment.get_proxy().cache_relative_path):
+                    outcome = 'cached'
+                else:
+                    outcome = 'uncacheable'
+            except Exception:
+                cherrypy.log('Error warming %s' % path, traceback=True)
+                outcome = 'failed'
+        finally:
+            cherrypy.serving.clear()
+        self._count(counts, outcome)
+        if self.log is not None:
+            self.log('%s: %s' % (path, outcome))
+    
+    def _refresh_one(self, key, counts):
+        try:
+            if environment.get_proxy().refresh(key):
+                self._count(counts, 'refreshed')
+        except Exception:
+            cherrypy.log('Error refreshing %s' % key, traceback=True)
+    
+    def _served_by_controller(self, path_info):
+        # e.g. robots.txt; cherrypy maps dots in names of handlers to underscores
+        name = path_info.lstrip('/').split('/', 1)[0].replace('.', '_')
+        handler = getattr(main_controller.MainController, name, None)
+        return name != 'default' and getattr(handler, 'exposed', False)
+    
+    def _load_request(self, path_info, query_string):
+        # pages are fetched the way a visitor's requests are
+        local = httputil.Host('127.0.0.1', 80)
+        request = _cprequest.Request(local, local, 'http', 'HTTP/1.1')
+        request.method = 'GET'
+        request.path_info = path_info
+        request.query_string = query_string
+        request.params = httputil.parse_query_string(query_string)
+        request.headers = httputil.HeaderMap()
+        request.headers['Host'] = self.host
+        request.headers['Accept-Encoding'] = 'gzip'
+        cherrypy.serving.load(request, _cprequest.Response())
+        main_controller.MainController()._munge_params()
+    
+    def _count(self, counts, outcome):
+        self._counts_lock.acquire()
+        try:
+            counts[outcome] = counts.get(outcome, 0) + 1
+        finally:
+            self._counts_lock.release()
+
+def format_counts(counts):
+    return ', '.join(['%d %s' % (counts[outcome], outcome) for outcome in sorted(counts.keys())]) or 'nothing'
+
+def create_warmer(host=None, concurrency=None, log=None):
+    '''Returns a warmer configured from cherrypy.config'''
+    
+    if host is None:
+        host = cherrypy.config.get('local.cache.warmer.host') or cherrypy.config.get('local.host') or cherrypy.config['remote.host']
+    if concurrency is None:
+        concurrency = cherrypy.config.get('local.cache.warmer.concurrency', 4)
+    return CacheWarmer(host, concurrency,
+        refresh_ahead=cherrypy.config.get('local.cache.warmer.refresh_ahead', 60),
+        refresh_accessed_within=cherrypy.config.get('local.cache.warmer.refresh_accessed_within', 3600),
+        log=log)
+
+def configured_paths(seed_file=None, access_log=None, top=None):
+    '''Returns paths to warm from a seed file or an access log,
+    which default to those in cherrypy.config'''
+    
+    if seed_file is None and access_log is None:
+        seed_file = cherrypy.config.get('local.cache.warmer.seed_file')
+        access_log = cherrypy.config.get('local.cache.warmer.access_log')
+    if top is None:
+        top = cherrypy.config.get('local.cache.warmer.top', 100)
+    if seed_file is not None:
+        return read_seed_file(seed_file)[:top]
+    if access_log is not None:
+        return read_access_log(access_log, top)
+    return []
+
+def subscribe(bus):
+    '''Warms the cache in a background thread once bus starts and refreshes
+    expiring pages in a monitor thread, as configured in cherrypy.config'''
+    
+    import cache_janitor, proxy
+    
+    warmer = create_warmer()
+    janitor = cherrypy.config.get('local.cache.janitor.enabled')
+    
+    def warm():
+        try:
+            paths = configured_paths()
+            if paths:
+                started = time.time()
+                counts = warmer.warm(paths)
+                cherrypy.log('Warmed cache in %.1f seconds: %s' % (time.time() - started, format_counts(counts)))
+        except Exception:
+            cherrypy.log('Error warming cache', traceback=True)
+    
+    def start():
+        thread = threading.Thread(target=warm)
+        thread.setDaemon(True)
+        thread.start()
+    
+    def refresh():
+        try:
+            if not janitor:
+                # access times which pages to refresh are chosen by are left to us
+                cache_janitor.record_accesses(environment.get_cache_index(), proxy.cache_access_times)
+            warmer.refresh_expiring()
+        except Exception:
+            cherrypy.log('Error refreshing cache', traceback=True)
+    
+    bus.subscribe('start', start)
+    if cherrypy.config.get('local.cache.warmer.refresh_ahead', 60):
+        from cherrypy.process import plugins
+        
+        proxy.record_access_times = True
+        monitor = plugins.Monitor(bus, refresh, frequency=cherrypy.config.get('local.cache.warmer.refresh_interval', 30))
+        monitor.subscribe()
+    return warmer
+
+def main(args):
+    environment.load_config(os.path.join(os.path.dirname(__file__), '..'))
+    environment.add_config('production.ini')
+    
+    opts, args = getopt.getopt(args, 'a:n:c:H:v')
+    access_log = top = concurrency = host = log = None
+    for opt, value in opts:
+        if opt == '-a':
+            access_log = value
+        elif opt == '-n':
+            top = int(value)
+        elif opt == '-c':
+            concurrency = int(value)
+        elif opt == '-H':
+            host = value
+        elif opt == '-v':
+            log = lambda message: sys.stdout.write(message + '\n')
+    if args:
+        seed_file = args[0]
+    else:
+        seed_file = None
+    
+    if not cherrypy.config.get('local.cache.enabled'):
+        print 'Cache is not enabled'
+        sys.exit(1)
+    environment.get_cache_layout().prepare(cherrypy.config['local.cache.dir'])
+    paths = configured_paths(seed_file, access_log, top)
+    counts = create_warmer(host, concurrency, log).warm(paths)
+    print 'Warmed %d pages: %s' % (len(paths), format_counts(counts))
@@ -1,7 +1,21 @@
 import cherrypy, os.path, threading
 
 _thread_local_data = threading.local()
+_memory_cache = None
+_memory_cache_lock = threading.Lock()
+_cache_index = None
+_cache_layout = None
+_cache_key_builder = None
+_cache_publisher = None
+_upstream_pool = None
+_upstream_pool_lock = threading.Lock()
+_upstream_guard = None
+_upstream_guard_lock = threading.Lock()
+_in_flight = None
+_in_flight_lock = threading.Lock()
 fs_root = None
+# configuration files in the order they were added, for reloading
+_config_files = []
 
 def compute_config_path(config_file):
     config_path = os.path.join(fs_root, 'config', config_file)
@@ -14,10 +28,24 @@ def load_config(root):
 
 def add_config(config_file):
     config_path = compute_config_path(config_file)
+    if config_path not in _config_files:
+        _config_files.append(config_path)
     if os.path.exists(config_path):
         cherrypy.config.update(config_path)
 
-def setup(root):
+def config_paths():
+    '''Returns paths of configuration files added so far'''
+    
+    return list(_config_files)
+
+def reload_config():
+    '''Reads configuration files again, in the order they were added'''
+    
+    for config_path in _config_files:
+        if os.path.exists(config_path):
+            cherrypy.config.update(config_path)
+
+def setup(root, plugins=True):
     global fs_root
     fs_root = root
     import main_controller
@@ -28,6 +56,42 @@ def setup(root):
     cherrypy.tree.mount(main_controller.MainController(), '/', **kwargs)
     # import during setup
     import proxy
+    
+    if cherrypy.config.get('local.cache.enabled'):
+        get_cache_layout().prepare(cherrypy.config['local.cache.dir'])
+    
+    if plugins:
+        subscribe_plugins(cherrypy.engine)
+
+def subscribe_plugins(bus, primary=True):
+    '''Subscribes background work of a process serving requests to bus.
+    
+    Of several processes sharing the cache only one is primary;
+    the others leave sweeping, warming and refreshing the cache to it.'''
+    
+    import settings
+    
+    settings.subscribe(bus)
+    
+    if cherrypy.config.get('local.cache.enabled'):
+        import cache_key
+        
+        cache_key.subscribe(bus, get_cache_key_builder())
+    
+    if cherrypy.config.get('local.cache.enabled') and cherrypy.config.get('local.cache.janitor.enabled'):
+        import cache_janitor
+        
+        cache_janitor.subscribe(bus, primary)
+    
+    if cherrypy.config.get('local.cache.enabled') and cherrypy.config.get('local.cache.warmer.enabled') and primary:
+        import cache_warmer
+        
+        cache_warmer.subscribe(bus)
+    
+    if get_cache_publisher() is not None and primary:
+        import cache_publish
+        
+        cache_publish.subscribe(bus)
 
 def get_proxy():
     global _thread_local_data
@@ -35,11 +99,154 @@ def get_proxy():
     try:
         proxy = _thread_local_data.proxy
     except AttributeError:
-        import proxy as proxy_module
-        
-        if cherrypy.config['local.cache.enabled']:
-            cls = proxy_module.CachingProxy
-        else:
-            cls = proxy_module.Proxy
-        _thread_local_data.proxy = proxy = cls()
+        _thread_local_data.proxy = proxy = get_proxy_class()()
     return proxy
+
+def get_proxy_class():
+    import proxy as proxy_module
+    
+    if cherrypy.config['local.cache.enabled']:
+        return proxy_module.CachingProxy
+    else:
+        return proxy_module.Proxy
+
+def get_memory_cache():
+    global _memory_cache
+    
+    if _memory_cache is None:
+        if not cherrypy.config.get('local.cache.memory.enabled'):
+            return None
+        
+        import tools.lru
+        
+        _memory_cache_lock.acquire()
+        try:
+            # another thread may have created the cache while we were waiting for the lock
+            if _memory_cache is None:
+                _memory_cache = tools.lru.LruCache(
+                    cherrypy.config.get('local.cache.memory.max_entries', 10000),
+                    cherrypy.config.get('local.cache.memory.max_bytes', 64*1024*1024))
+        finally:
+            _memory_cache_lock.release()
+    return _memory_cache
+
+def get_cache_index():
+    global _cache_index
+    
+    if _cache_index is None:
+        import cache_index, tools.file
+        
+        path = cherrypy.config.get('local.cache.index.path')
+        if path is None:
+            path = os.path.join(cherrypy.config['local.cache.dir'], '.index.sqlite')
+        dir = os.path.dirname(path)
+        if not os.path.exists(dir):
+            tools.file.safe_mkdirs(dir)
+        # connections are made per thread on demand, racing here is harmless
+        _cache_index = cache_index.CacheIndex(path)
+    return _cache_index
+
+def get_cache_layout():
+    global _cache_layout
+    
+    if _cache_layout is None:
+        import cache_layout
+        
+        _cache_layout = cache_layout.create_layout(cherrypy.config.get('local.cache.layout', 'mirror'),
+            cherrypy.config.get('local.cache.shard_depth', 2))
+    return _cache_layout
+
+def get_cache_key_builder():
+    global _cache_key_builder
+    
+    if _cache_key_builder is None:
+        import cache_key, proxy
+        
+        _cache_key_builder = cache_key.KeyBuilder(
+            sort_params=cherrypy.config.get('local.cache.key.sort_params', False),
+            ignore_params=cherrypy.config.get('local.cache.key.ignore_params', ()),
+            vary_headers=cherrypy.config.get('local.cache.key.vary_headers', ()),
+            cookie_state=cherrypy.config.get('local.cache.key.cookie_state', False),
+            public_paths_re=proxy.Proxy.public_paths_re)
+    return _cache_key_builder
+
+def get_cache_publisher():
+    global _cache_publisher
+    
+    if _cache_publisher is None:
+        if not cherrypy.config.get('local.cache.enabled') or not cherrypy.config.get('local.cache.publish.enabled'):
+            return None
+        
+        import cache_publish
+        
+        # racing here is harmless
+        _cache_publisher = cache_publish.create_publisher()
+    return _cache_publisher
+
+def get_upstream_pool():
+    global _upstream_pool
+    
+    if _upstream_pool is None:
+        import tools.connection_pool
+        
+        _upstream_pool_lock.acquire()
+        try:
+            # all proxies must share a single pool
+            if _upstream_pool is None:
+                _upstream_pool = tools.connection_pool.ConnectionPool(
+                    max_connections=cherrypy.config.get('remote.pool.max_connections', 16),
+                    idle_timeout=cherrypy.config.get('remote.pool.idle_timeout', 60),
+                    idle_timeouts=cherrypy.config.get('remote.pool.idle_timeouts'),
+                    connect_timeout=cherrypy.config.get('remote.connect_timeout', 10),
+                    read_timeout=cherrypy.config.get('remote.read_timeout', 60),
+                    wait_timeout=cherrypy.config.get('remote.pool.wait_timeout', 30))
+        finally:
+            _upstream_pool_lock.release()
+    return _upstream_pool
+
+def get_upstream_guard():
+    global _upstream_guard
+    
+    if _upstream_guard is None:
+        import tools.load_shedding
+        
+        _upstream_guard_lock.acquire()
+        try:
+            # all proxies must share a single breaker and limit
+            if _upstream_guard is None:
+                breaker = limit = None
+                if cherrypy.config.get('remote.breaker.enabled'):
+                    breaker = tools.load_shedding.CircuitBreaker(
+                        failure_threshold=cherrypy.config.get('remote.breaker.failures', 5),
+                        reset_timeout=cherrypy.config.get('remote.breaker.reset_timeout', 30))
+                if cherrypy.config.get('remote.limit.enabled'):
+                    limit = tools.load_shedding.AdaptiveLimit(
+                        min_limit=cherrypy.config.get('remote.limit.min', 1),
+                        max_limit=cherrypy.config.get('remote.limit.max', cherrypy.config.get('remote.pool.max_connections', 16)),
+                        max_queue=cherrypy.config.get('remote.limit.queue', 8),
+                        queue_timeout=cherrypy.config.get('remote.limit.queue_timeout', 1))
+                _upstream_guard = tools.load_shedding.UpstreamGuard(breaker, limit,
+                    slow_call=cherrypy.config.get('remote.slow_call'))
+        finally:
+            _upstream_guard_lock.release()
+    return _upstream_guard
+
+def get_in_flight():
+    '''Returns registry of cache misses currently being fetched from
+    the remote host'''
+    
+    global _in_flight
+    
+    if _in_flight is None:
+        import tools.single_flight
+        
+        _in_flight_lock.acquire()
+        try:
+            # shared by all threads; streamed responses keep their flight until
+            # the client reads the whole body, clients that never do would
+            # otherwise leave the flight open forever
+            if _in_flight is None:
+                _in_flight = tools.single_flight.SingleFlight(cherrypy.config.get('local.cache.single_flight.max_age', 300))
+        finally:
+            _in_flight_lock.release()
+    return _in_flight
@@ -0,0 +1,440 @@
+'''Evented server mode.
+
+Serves requests from a single asyncore event loop instead of a CherryPy
+thread per request, so that slow remote requests do not tie up threads.
+Requests are handled by the same proxy classes as in the threaded server;
+remote requests are sent from the event loop; cache lookups and saves and
+the processing of remote responses run in a small pool of worker threads
+(local.evented.io_threads).
+
+Usage: script/evented-server [-p]
+
+-p adds production.ini to configuration, as script/production-server does.
+'''
+
+import asynchat, asyncore, socket, time, sys, os.path, getopt, urllib, traceback, httplib, cStringIO
+import cherrypy
+from cherrypy import _cprequest
+from cherrypy.lib import httputil
+
+import environment, main_controller, metrics
+import tools.evented, tools.load_shedding
+
+class EventedServer(asyncore.dispatcher):
+    def __init__(self, host, port, backlog=128):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+        self.local_address = self.socket.getsockname()
+        
+        self.trigger = tools.evented.Trigger(self.map)
+        self.tasks = tools.evented.TaskPool(self.trigger, cherrypy.config.get('local.evented.io_threads', 4))
+        self.resolver = tools.evented.Resolver(self.tasks)
+        
+        self.connect_timeout = cherrypy.config.get('remote.connect_timeout', 10)
+        self.read_timeout = cherrypy.config.get('remote.read_timeout', 60)
+        self.client_timeout = cherrypy.config.get('server.socket_timeout', 10)
+        # remote requests in progress are capped like the connection pool of the threaded server
+        self.max_fetches = cherrypy.config.get('remote.pool.max_connections', 16)
+        self.fetches = {}
+        self.pending_fetches = []
+        self.channels = {}
+        # cache key -> callbacks of requests waiting for another request to fetch the page
+        self.waiting = {}
+        self.running = False
+    
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            try:
+                # select cannot wait on descriptors numbered 1024 and above
+                asyncore.loop(timeout=1, map=self.map, count=1, use_poll=True)
+                self._check_timeouts(time.time())
+            except Exception:
+                # a single failing iteration must not take the server down
+                cherrypy.log('Error in evented server loop', traceback=True)
+    
+    def stop(self):
+        # may be called from another thread
+        self.running = False
+        self.trigger.call(self.close)
+    
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, address = pair
+            ClientChannel(self, sock, address)
+    
+    def handle_error(self):
+        cherrypy.log('Error in evented server', traceback=True)
+    
+    def fetch(self, request, callback):
+        '''Issues urllib2 request, calling callback with (response, exc_info)'''
+        
+        if len(self.fetches) >= self.max_fetches:
+            self.pending_fetches.append((request, callback))
+        else:
+            self._start_fetch(request, callback)
+    
+    def _start_fetch(self, request, callback):
+        token = object()
+        # resolving does not have a fetch object yet
+        self.fetches[token] = None
+        
+        def done(response, exc_info):
+            del self.fetches[token]
+            if self.pending_fetches:
+                self._start_fetch(*self.pending_fetches.pop(0))
+            callback(response, exc_info)
+        
+        def resolved(result, exc_info):
+            if exc_info is not None:
+                done(None, exc_info)
+                return
+            family, address = result
+            try:
+                self.fetches[token] = tools.evented.HttpFetch(self.map, family, address,
+                    request.get_full_url(), request.get_method(), tools.evented.format_request(request), done,
+                    self.connect_timeout, self.read_timeout)
+            except:
+                done(None, sys.exc_info())
+        
+        host, port = urllib.splitport(request.get_host())
+        try:
+            self.resolver.resolve(host, int(port or 80), resolved)
+        except:
+            # not counted as in progress, the caller handles the error
+            self.fetches.pop(token, None)
+            raise
+    
+    def _check_timeouts(self, now):
+        for fetch in self.fetches.values():
+            if fetch is not None:
+                fetch.check_timeout(now)
+        for channel in self.channels.keys():
+            channel.check_timeout(now)
+
+class ClientChannel(asynchat.async_chat):
+    '''Connection from a client, possibly carrying several requests one after another'''
+    
+    max_head_size = 65536
+    
+    def __init__(self, server, sock, address):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.address = address
+        server.channels[self] = True
+        self._reset()
+    
+    def _reset(self):
+        self._buffer = []
+        self._head = None
+        self._requests = []
+        self.busy = False
+        self.last_activity = time.time()
+        self.set_terminator('\r\n\r\n')
+    
+    def readable(self):
+        # requests are handled one at a time
+        return not self.busy
+    
+    def check_timeout(self, now):
+        if not self.busy and now - self.last_activity > self.server.client_timeout:
+            self.close()
+    
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        self._buffer.append(data)
+        if self._head is None and sum([len(part) for part in self._buffer]) > self.max_head_size:
+            self.send_error(400)
+    
+    def found_terminator(self):
+        data, self._buffer = ''.join(self._buffer), []
+        if self._head is None:
+            try:
+                self._head = self._parse_head(data)
+            except ValueError:
+                self.send_error(400)
+                return
+            length = int(self._head[3].get('content-length') or 0)
+            if length:
+                self.set_terminator(length)
+                return
+            data = ''
+        method, uri, version, headers = self._head
+        self._head = None
+        self.set_terminator('\r\n\r\n')
+        # pipelined requests wait for responses to earlier ones
+        self._requests.append((method, uri, version, headers, data))
+        if not self.busy:
+            self._next()
+    
+    def _next(self):
+        if self._requests:
+            self.busy = True
+            method, uri, version, headers, data = self._requests.pop(0)
+            Exchange(self.server, self, method, uri, version, headers, data).run()
+    
+    def _parse_head(self, head):
+        request_line, rest = (head + '\r\n').split('\r\n', 1)
+        method, uri, version = request_line.split()
+        if not version.startswith('HTTP/'):
+            raise ValueError('Bad request line: %s' % request_line)
+        headers = httplib.HTTPMessage(cStringIO.StringIO(rest + '\r\n'))
+        return method, uri, version, headers
+    
+    def send_response(self, status, header_list, body, keep_alive):
+        lines = ['HTTP/1.1 ' + status]
+        lines.extend(['%s: %s' % (key, value) for key, value in header_list])
+        if not keep_alive:
+            lines.append('Connection: close')
+        self.push('\r\n'.join(lines) + '\r\n\r\n' + body)
+        if keep_alive:
+            self.busy = False
+            self.last_activity = time.time()
+            self._next()
+        else:
+            self._requests = []
+            self.close_when_done()
+    
+    def send_error(self, code):
+        self.busy = True
+        code, reason, message = httputil.valid_status(code)
+        self.send_response('%d %s' % (code, reason), [('Content-Type', 'text/plain'), ('Content-Length', len(message))], message, False)
+    
+    def handle_error(self):
+        cherrypy.log('Error serving %s' % (self.address,), traceback=True)
+        self.close()
+    
+    def close(self):
+        self.server.channels.pop(self, None)
+        asynchat.async_chat.close(self)
+
+class Exchange:
+    '''Handles a single request, going through the same steps as
+    MainController and the proxies do in the threaded server'''
+    
+    def __init__(self, server, channel, method, uri, version, headers, body):
+        self.server = server
+        self.channel = channel
+        self.version = version
+        self.coalesce_key = None
+        # set while a remote request is in progress, see tools.load_shedding
+        self.guard_token = None
+        self.started = time.time()
+        
+        path, query_string = (uri.split('?', 1) + [''])[:2]
+        local = httputil.Host(server.local_address[0], server.local_address[1])
+        remote = httputil.Host(channel.address[0], channel.address[1])
+        request = self.request = _cprequest.Request(local, remote, 'http', version)
+        request.method = method
+        request.path_info = urllib.unquote(path)
+        request.query_string = query_string
+        request.headers = httputil.HeaderMap()
+        for key, value in headers.items():
+            request.headers[key] = value
+        # parameters are decoded by MainController._munge_params if need be
+        request.params = {}
+        request.raw_body = body or ''
+        self.response = _cprequest.Response()
+        
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+    
+    def run(self):
+        self._step(self._start)
+    
+    def _start(self):
+        controller = main_controller.MainController()
+        path = self.request.path_info
+        if path == '/robots.txt':
+            self._reply(controller.robots_txt())
+        elif path == '/blank_page':
+            self._reply(controller.blank_page())
+        elif path == '/metrics' and metrics.enabled():
+            # proxied like any other page when metrics are off, see MainController.metrics
+            self._reply(controller.metrics())
+        else:
+            controller._munge_params()
+            self.proxy = environment.get_proxy_class()()
+            if hasattr(self.proxy, 'lookup'):
+                self._lookup()
+            else:
+                self._fetch()
+    
+    def _lookup(self):
+        self.server.tasks.submit(self._in_thread, (self.proxy.lookup,), self._looked_up)
+    
+    def _looked_up(self, response, exc_info, coalesce=True):
+        if exc_info is not None:
+            self._fail(exc_info)
+        elif response is not None:
+            self._step(self._reply, response.content)
+        elif coalesce:
+            self._step(self._fetch_once)
+        else:
+            self._step(self._fetch)
+    
+    def _fetch_once(self):
+        if self.proxy._can_coalesce():
+            key = self.proxy.cache_relative_path
+            if self.server.waiting.has_key(key):
+                # page is being fetched by another request
+                self.server.waiting[key].append(self._waited)
+                return
+            self.server.waiting[key] = []
+            self.coalesce_key = key
+        self._fetch()
+    
+    def _waited(self, stored):
+        # like waiters in proxy._coalesced_fetch, requests look the page up again
+        # once it is saved and otherwise fetch it on their own, rather than
+        # queueing up behind each other for pages which are not cached
+        if stored:
+            self.server.tasks.submit(self._in_thread, (self.proxy.lookup,),
+                lambda response, exc_info: self._looked_up(response, exc_info, False))
+        else:
+            self._step(self._fetch)
+    
+    def _fetch(self):
+        # the whole response is collected before it is passed on, so there is nothing to stream
+        request = self.proxy.prepare_remote_request(stream=False)
+        try:
+            # the event loop must not wait; misses beyond the limit are shed rather than queued
+            self.guard_token = environment.get_upstream_guard().enter(wait=False)
+        except tools.load_shedding.Rejected:
+            self._fetched(None, sys.exc_info())
+            return
+        try:
+            self.server.fetch(request, self._fetched)
+        except:
+            # such as running out of descriptors
+            self._fetched(None, sys.exc_info())
+    
+    def _fetched(self, raw_response, exc_info):
+        if self.guard_token is not None:
+            environment.get_upstream_guard().exit(self.guard_token, exc_info is not None or raw_response.code >= 500)
+            self.guard_token = None
+        if exc_info is not None:
+            if hasattr(self.proxy, 'serve_stale'):
+                self.server.tasks.submit(self._in_thread, (self.proxy.serve_stale,),
+                    lambda response, stale_exc_info: self._served_stale(response, exc_info))
+            else:
+                self._fail(exc_info)
+            return
+        # rewriting links, serving stale copies in place of server errors
+        # and saving the page must not hold up the event loop
+        self.server.tasks.submit(self._in_thread, (self._complete, raw_response), self._completed)
+    
+    def _complete(self, raw_response):
+        # runs in a worker thread, returns the response and whether the page is in the cache
+        response = self.proxy.complete_and_propagate(raw_response)
+        if hasattr(self.proxy, 'store'):
+            return response, self.proxy.store(response)
+        return response, False
+    
+    def _completed(self, result, exc_info):
+        if exc_info is not None:
+            self._fail(exc_info)
+            return
+        response, stored = result
+        self._release_waiting(stored)
+        self._step(self._reply, response.content)
+    
+    def _served_stale(self, response, exc_info):
+        # exc_info is that of the failed remote request
+        self._release_waiting(response is not None)
+        if response is None:
+            self._fail(exc_info)
+        else:
+            self._step(self._reply, response.content)
+    
+    def _release_waiting(self, stored=False):
+        # stored tells waiting requests whether the page is in the cache now
+        if self.coalesce_key is not None:
+            for callback in self.server.waiting.pop(self.coalesce_key, []):
+                callback(stored)
+            self.coalesce_key = None
+    
+    def _reply(self, content):
+        response = self.response
+        # x-accel-redirect responses have no content
+        response.body = content or ''
+        metrics.observe_since('request', self.started)
+        metrics.add_timing_header()
+        response.finalize()
+        if self.request.method == 'HEAD':
+            body = ''
+        else:
+            body = ''.join(response.body)
+        self.channel.send_response(response.output_status, response.header_list, body, self.keep_alive)
+    
+    def _fail(self, exc_info):
+        cherrypy.log('Error proxying %s\n%s' % (self.request.path_info, ''.join(traceback.format_exception(*exc_info))))
+        if isinstance(exc_info[1], tools.load_shedding.Rejected):
+            code = 503
+        elif isinstance(exc_info[1], socket.timeout):
+            code = 504
+        elif isinstance(exc_info[1], (socket.error, httplib.HTTPException)):
+            code = 502
+        else:
+            code = 500
+        self.keep_alive = False
+        self.channel.send_error(code)
+        # requests waiting for this one to fetch the page must not wait forever;
+        # does nothing if they were released already
+        self._release_waiting()
+    
+    def _load(self):
+        cherrypy.serving.load(self.request, self.response)
+    
+    def _in_thread(self, function, *args):
+        self._load()
+        try:
+            return function(*args)
+        finally:
+            cherrypy.serving.clear()
+    
+    def _step(self, function, *args):
+        # runs a step in the event loop thread with this exchange's request being current
+        self._load()
+        try:
+            try:
+                return function(*args)
+            except:
+                self._fail(sys.exc_info())
+        finally:
+            cherrypy.serving.clear()
+
+def main(args):
+    opts, args = getopt.getopt(args, 'p')
+    root = os.path.join(os.path.dirname(__file__), '..')
+    environment.load_config(root)
+    for opt, value in opts:
+        if opt == '-p':
+            environment.add_config('production.ini')
+    environment.setup(root)
+    
+    server = EventedServer(cherrypy.config.get('server.socket_host', '127.0.0.1'),
+        cherrypy.config.get('server.socket_port', 8080),
+        cherrypy.config.get('server.socket_queue_size') or 128)
+    
+    # the engine still runs plugins such as the cache janitor,
+    # its http server and autoreloader are not used
+    cherrypy.server.unsubscribe()
+    cherrypy.engine.autoreload.unsubscribe()
+    if hasattr(cherrypy.engine, 'signal_handler'):
+        cherrypy.engine.signal_handler.subscribe()
+    cherrypy.engine.subscribe('stop', server.stop)
+    cherrypy.engine.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.tasks.stop()
+        cherrypy.engine.exit()
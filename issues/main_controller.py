@@ -1,12 +1,27 @@
-import cherrypy
+import cherrypy, time, urllib, urlparse
 
-import environment
+import environment, metrics, settings
+import tools.load_shedding
 
 class MainController:
+    _cp_config = {'request.process_request_body': False}
+    
     @cherrypy.expose
     def default(self, *args, **kwargs):
+        started = time.time()
         self._munge_params()
-        return self._proxy_content()
+        try:
+            content = self._proxy_content()
+        except tools.load_shedding.Rejected, e:
+            # shed load quickly rather than tie up a thread cache hits could use.
+            # cherrypy's error pages drop Retry-After
+            cherrypy.response.status = 503
+            cherrypy.response.headers['content-type'] = 'text/plain'
+            cherrypy.response.headers['retry-after'] = str(e.retry_after)
+            content = str(e.reason) + '\n'
+        metrics.observe_since('request', started)
+        metrics.add_timing_header()
+        return content
     
     def _proxy(self, **kwargs):
         response = environment.get_proxy().perform_and_propagate(**kwargs)
@@ -16,22 +31,76 @@ class MainController:
         response = self._proxy(**kwargs)
         return response.content
     
-    def _replace_host(self, search_host, replace_host):
-        params = cherrypy.request.params
+    def _read_body(self):
+        # the body is read here rather than by cherrypy, which would
+        # decode form parameters whether or not they are rewritten
+        request = cherrypy.request
+        body = getattr(request, 'raw_body', None)
+        if body is not None:
+            return body
+        body = ''
+        if request.method in request.methods_with_bodies and request.rfile is not None:
+            # without a length or chunks there is nothing to read
+            if request.headers.has_key('Content-Length') or request.headers.has_key('Transfer-Encoding'):
+                body = request.rfile.read()
+        request.raw_body = body
+        return body
+    
+    def _is_form(self):
+        content_type = cherrypy.request.headers.get('Content-Type', '')
+        return content_type.lower().startswith('application/x-www-form-urlencoded')
+    
+    def _mentions_host(self, encoded, hosts):
+        # false positives only cost decoding, links to this proxy are
+        # not missed: they carry host names unescaped
+        encoded = encoded.lower()
+        for host in hosts:
+            if host.split(':')[0].lower() in encoded:
+                return True
+        return False
+    
+    def _replace_host(self, encoded, search_hosts, replace_host):
+        # returns urlencoded parameters with values linking to search hosts
+        # pointed at replace host, None if no value links to them
+        if not self._mentions_host(encoded, search_hosts):
+            return None
         prefix = 'http://'
-        search = prefix + search_host
+        searches = tuple([prefix + host for host in search_hosts])
         replace = prefix + replace_host
-        for key, value in params.items():
-            # todo: check if non-strings contain host
-            if isinstance(value, basestring) and value.startswith(search):
-                value = replace + value[len(search):]
-                params[key] = value
+        # values are kept as byte strings, in the order they were given
+        pairs = urlparse.parse_qsl(encoded, True)
+        replaced = False
+        for i, (key, value) in enumerate(pairs):
+            if value.startswith(searches):
+                for search in searches:
+                    if value.startswith(search):
+                        pairs[i] = (key, replace + value[len(search):])
+                        replaced = True
+                        break
+        if not replaced:
+            return None
+        return urllib.urlencode(pairs)
     
     def _munge_params(self):
-        self._replace_host(cherrypy.request.headers['host'], cherrypy.config['remote.host'])
-        local_host = cherrypy.config.get('local.host')
-        if local_host:
-            self._replace_host(local_host, cherrypy.config['remote.host'])
+        '''Points links to this proxy in request parameters at the remote host.
+        
+        The query string and form bodies are only decoded when they mention
+        a host to replace, and are rewritten independently of each other.
+        What is forwarded is left on the request as forward_query_string and
+        forward_body, see BaseProxy._collect_request_parameters; other bodies
+        are forwarded as they were received.'''
+        
+        request = cherrypy.request
+        current = settings.get()
+        body = self._read_body()
+        hosts = [request.headers['host']]
+        if current.local_host:
+            hosts.append(current.local_host)
+        
+        request.forward_query_string = self._replace_host(request.query_string, hosts, current.remote_host) or request.query_string
+        request.forward_body = body
+        if body and self._is_form():
+            request.forward_body = self._replace_host(body, hosts, current.remote_host) or body
     
     # Googlebot gets its nose in everywhere.
     # Save us the aggravation of putting up with it.
@@ -41,6 +110,19 @@ class MainController:
         cherrypy.response.headers['content-type'] = 'text/plain'
         return "User-Agent: *\nDisallow: /\n"
     
+    # Metrics for monitoring, see metrics.py.
+    # Requests are proxied as usual unless metrics are enabled.
+    @cherrypy.expose
+    def metrics(self, *args, **kwargs):
+        if not metrics.enabled():
+            return self.default(*args, **kwargs)
+        if not metrics.allowed(cherrypy.request.remote.ip):
+            cherrypy.response.status = 403
+            cherrypy.response.headers['content-type'] = 'text/plain'
+            return 'Forbidden\n'
+        cherrypy.response.headers['content-type'] = 'text/plain; version=0.0.4'
+        return metrics.render()
+    
     # We rewrite some useless urls to blank_page on varnish
     @cherrypy.expose
     def blank_page(self, *args, **kwargs):
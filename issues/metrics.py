@@ -0,0 +1,222 @@
+'''Timings and counters of request handling.
+
+Stages of handling a request are timed into latency histograms:
+
+- request: whole request, as seen by MainController
+- cache_lookup: looking the page up in memory, index and on disk
+- upstream_connect: connecting to the remote host, for new connections only
+- upstream_ttfb: from sending the remote request until response headers arrived
+- body_read: reading the remote response body; for streamed responses,
+  the time spent waiting for chunks
+- adjust_cache_directives, adjust_host_in_links: response adjustments;
+  for streamed responses links are rewritten as chunks are sent,
+  which is not included
+- cache_save: saving the page, unless it is streamed
+- propagate: copying the remote response to the client response
+
+Metrics are kept per process and rendered in Prometheus text format by
+MainController.metrics when local.metrics.enabled is set, to clients whose
+addresses are in local.metrics.allow (loopback by default); with the prefork
+server each scrape is answered by whichever worker accepts it. nginx does
+not pass /metrics on, so that scrapes go to the proxy's port. With
+local.metrics.timing_headers set, responses carry a Server-Timing header
+with the stages of the request done by the time headers are sent.
+'''
+
+import threading, time
+import cherrypy
+
+import settings
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # counts per bucket, not cumulative; the last one is for values above all bounds
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    '''Histograms of stage timings and counters of events'''
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        # stage -> Histogram
+        self._stages = {}
+        # (name, label value) -> count
+        self._counters = {}
+    
+    def observe(self, stage, seconds):
+        self._lock.acquire()
+        try:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram()
+            histogram.observe(seconds)
+        finally:
+            self._lock.release()
+    
+    def count(self, name, label=None, amount=1):
+        key = (name, label)
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        finally:
+            self._lock.release()
+    
+    def snapshot(self):
+        '''Returns (stages, counters), stages being a dict of stage ->
+        (bucket counts, sum, count) and counters a dict of (name, label) -> count'''
+        
+        self._lock.acquire()
+        try:
+            stages = dict([(stage, (list(histogram.counts), histogram.sum, histogram.count))
+                for stage, histogram in self._stages.items()])
+            return stages, dict(self._counters)
+        finally:
+            self._lock.release()
+
+registry = Registry()
+
+# counter name -> (label name, help)
+COUNTERS = {
+    'cache_requests': ('result', 'Cache lookups by result: hit or miss'),
+    'cache_stale_serves': (None, 'Cache hits served stale while the page is revalidated'),
+    'cache_error_serves': (None, 'Stale pages served because the remote host failed'),
+    'cache_not_modified': (None, 'Conditional requests for static assets answered from cache metadata'),
+    'upstream_bytes': (None, 'Bytes of response bodies received from the remote host'),
+    'cache_bytes': (None, 'Bytes of response bodies served from the cache'),
+}
+
+def enabled():
+    return settings.get().metrics
+
+def allowed(address):
+    '''Returns True if metrics may be served to a client at address'''
+    
+    return address in settings.get().metrics_allow
+
+def _request_timings():
+    # timings are kept on requests being served only; other threads,
+    # e.g. those revalidating pages, share a default request object
+    if not settings.get().timing_headers or not cherrypy.serving.__dict__.has_key('request'):
+        return None
+    request = cherrypy.serving.request
+    try:
+        return request.stage_timings
+    except AttributeError:
+        request.stage_timings = timings = []
+        return timings
+
+def observe(stage, seconds):
+    '''Records that stage took seconds'''
+    
+    if not enabled():
+        return
+    registry.observe(stage, seconds)
+    timings = _request_timings()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+def observe_since(stage, started):
+    '''Records that stage took from started until now'''
+    
+    observe(stage, time.time() - started)
+
+def count(name, label=None, amount=1):
+    if enabled():
+        registry.count(name, label, amount)
+
+def add_timing_header():
+    '''Adds Server-Timing header with stages of the current request
+    timed so far to the response'''
+    
+    timings = _request_timings()
+    if timings:
+        cherrypy.response.headers['Server-Timing'] = ', '.join(['%s;dur=%.1f' % (stage, seconds * 1000) for stage, seconds in timings])
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels])
+
+def render():
+    '''Returns metrics of this process in Prometheus text format'''
+    
+    import environment
+    
+    lines = []
+    
+    def add(name, type, help, samples):
+        lines.append('# HELP issues_%s %s' % (name, help))
+        lines.append('# TYPE issues_%s %s' % (name, type))
+        for suffix, labels, value in samples:
+            lines.append('issues_%s%s%s %s' % (name, suffix, _format_labels(labels), value))
+    
+    stages, counters = registry.snapshot()
+    samples = []
+    for stage in sorted(stages.keys()):
+        counts, sum, count = stages[stage]
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + ('+Inf',), counts):
+            cumulative += bucket_count
+            samples.append(('_bucket', [('stage', stage), ('le', bound)], cumulative))
+        samples.append(('_sum', [('stage', stage)], repr(sum)))
+        samples.append(('_count', [('stage', stage)], count))
+    add('stage_seconds', 'histogram', 'Time spent in stages of handling requests', samples)
+    
+    for name in sorted(COUNTERS.keys()):
+        label_name, help = COUNTERS[name]
+        samples = []
+        for (counter, label), value in sorted(counters.items()):
+            if counter == name:
+                if label_name is None:
+                    samples.append(('', [], value))
+                else:
+                    samples.append(('', [(label_name, label)], value))
+        if label_name is None and not samples:
+            samples.append(('', [], 0))
+        add(name + '_total', 'counter', help, samples)
+    
+    pool_stats = environment.get_upstream_pool().stats()
+    add('upstream_connections', 'gauge', 'Connections to the remote host by state',
+        [('', [('state', state)], pool_stats[state]) for state in ('in_use', 'idle')])
+    add('upstream_pool_events_total', 'counter', 'Connection pool events',
+        [('', [('event', event)], pool_stats[event]) for event in ('created', 'waits', 'wait_timeouts', 'reconnects', 'expired')])
+    
+    guard_stats = environment.get_upstream_guard().stats()
+    if guard_stats.has_key('breaker_state'):
+        add('upstream_breaker_open', 'gauge', 'Whether the circuit breaker stops requests to the remote host',
+            [('', [], int(guard_stats['breaker_state'] == 'open'))])
+        add('upstream_breaker_opened_total', 'counter', 'Times the circuit breaker opened', [('', [], guard_stats['breaker_opened'])])
+    if guard_stats.has_key('limit'):
+        add('upstream_limit', 'gauge', 'Current limit of concurrent requests to the remote host', [('', [], guard_stats['limit'])])
+        add('upstream_limit_queued', 'gauge', 'Requests waiting for the concurrency limit', [('', [], guard_stats['queued'])])
+    add('upstream_rejected_total', 'counter', 'Requests to the remote host not made to protect it',
+        [('', [('reason', reason)], guard_stats[reason + '_rejected']) for reason in ('breaker', 'limit') if guard_stats.has_key(reason + '_rejected')])
+    
+    if cherrypy.config.get('local.cache.enabled'):
+        key_stats = environment.get_cache_key_builder().stats()
+        add('cache_key_rule_requests_total', 'counter', 'Requests whose cache key a normalization rule changed',
+            [('', [('rule', rule)], key_stats[rule][0]) for rule in sorted(key_stats.keys())])
+        add('cache_key_rule_hits_total', 'counter', 'Cache hits among requests whose cache key a normalization rule changed',
+            [('', [('rule', rule)], key_stats[rule][1]) for rule in sorted(key_stats.keys())])
+        memory_cache = environment.get_memory_cache()
+        if memory_cache is not None:
+            add('memory_cache_entries', 'gauge', 'Pages in the memory cache', [('', [], len(memory_cache))])
+            add('memory_cache_bytes', 'gauge', 'Size of pages in the memory cache', [('', [], memory_cache.size)])
+    
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,293 @@
+'''Prefork serving mode.
+
+The master process binds server.socket_file, or server.socket_host and
+server.socket_port, and forks local.prefork.workers worker processes
+accepting requests on the shared socket. Workers which exit are restarted,
+after local.prefork.restart_delay seconds if they exited soon after
+starting.
+
+Usage: script/prefork-server [-p] [-f] [-n workers]
+
+-p  adds production.ini to configuration, as script/production-server does
+-f  serves FastCGI rather than HTTP, as cherryd -f does
+-n  number of workers, overriding local.prefork.workers which defaults
+    to the number of processors
+
+Signals to the master:
+
+TERM, INT  workers finish requests in progress and exit, then the master exits
+HUP        graceful reload: the master re-executes itself keeping the listening
+           socket, starts workers with fresh code and configuration and only
+           then stops the old workers
+
+Pages are shared by workers through the disk cache; with more than one worker
+local.cache.single_flight.shared defaults to True so that a page missing from
+the cache is fetched by one worker at a time. Memory caches are per worker.
+The first worker sweeps, warms and refreshes the cache if configured to.
+'''
+
+import os, os.path, sys, signal, socket, time, errno, getopt, traceback, multiprocessing
+import cherrypy
+from cherrypy.process import plugins, servers
+
+import environment
+
+# code run by script/prefork-server, used to re-execute the master
+MAIN = 'import sys; from issues import prefork; prefork.main(sys.argv[1:])'
+
+# environment variables passing state to the re-executed master
+LISTENER_VAR = 'ISSUES_PREFORK_LISTENER'
+OLD_WORKERS_VAR = 'ISSUES_PREFORK_OLD_WORKERS'
+
+def bind_listener():
+    '''Returns listening socket configured in cherrypy.config,
+    or the one inherited from the previous master'''
+    
+    inherited = os.environ.pop(LISTENER_VAR, None)
+    if inherited:
+        family, fd = [int(part) for part in inherited.split(':')]
+        listener = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        # fromfd duplicates the descriptor
+        os.close(fd)
+        return listener
+    
+    socket_file = cherrypy.config.get('server.socket_file')
+    if socket_file:
+        if os.path.exists(socket_file):
+            # left behind by a previous run
+            os.unlink(socket_file)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_file)
+        # as cherrypy does, so that the web server can connect
+        os.chmod(socket_file, 0777)
+    else:
+        host = cherrypy.config.get('server.socket_host', '127.0.0.1')
+        port = cherrypy.config.get('server.socket_port', 8080)
+        family, type, proto, canonname, address = socket.getaddrinfo(host, port,
+            socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(address)
+    listener.listen(cherrypy.config.get('server.socket_queue_size') or 128)
+    return listener
+
+class SharedSocketAdapter(servers.ServerAdapter):
+    '''Server adapter which does not wait for the port to be freed
+    when stopping, as the master and other workers keep it open'''
+    
+    def stop(self):
+        if self.running:
+            if hasattr(self.httpserver, 'tick'):
+                self._stop_accepting()
+            self.httpserver.stop()
+            self.running = False
+            self.bus.log('HTTP Server %s shut down' % self.httpserver)
+    
+    def _stop_accepting(self):
+        # cherrypy's http server drops connections accepted while it is stopping,
+        # which other workers would have served. stop accepting first and
+        # give an accept in progress time to complete, accept timing out
+        # after a second
+        self.httpserver.tick = lambda: time.sleep(0.1)
+        time.sleep(1.1)
+
+def run_worker(listener, slot, fastcgi=False):
+    '''Serves requests on listener until the engine exits'''
+    
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    
+    # the listening socket is handed over the way process managers do:
+    # fastcgi servers accept on standard input when given no address,
+    # cherrypy's http server supports systemd socket activation
+    if fastcgi:
+        fd = 0
+    else:
+        fd = 3
+        os.environ['LISTEN_PID'] = str(os.getpid())
+        os.environ['LISTEN_FDS'] = '1'
+    if listener.fileno() != fd:
+        os.dup2(listener.fileno(), fd)
+        listener.close()
+    
+    cherrypy.server.unsubscribe()
+    if fastcgi:
+        server, bind_addr = servers.FlupFCGIServer(application=cherrypy.tree, bindAddress=None), None
+    else:
+        server, bind_addr = cherrypy.server.httpserver_from_self()
+    SharedSocketAdapter(cherrypy.engine, server, bind_addr).subscribe()
+    
+    # the master takes care of reloading
+    cherrypy.engine.autoreload.unsubscribe()
+    master_pid = os.getppid()
+    
+    def check_master():
+        # do not linger if the master was killed
+        if os.getppid() != master_pid:
+            cherrypy.engine.exit()
+    
+    plugins.Monitor(cherrypy.engine, check_master, frequency=1, name='MasterMonitor').subscribe()
+    cherrypy.engine.signal_handler.handlers.pop('SIGHUP', None)
+    cherrypy.engine.signal_handler.subscribe()
+    environment.subscribe_plugins(cherrypy.engine, primary=slot == 0)
+    cherrypy.engine.start()
+    cherrypy.engine.block()
+
+class Supervisor:
+    def __init__(self, listener, workers, run_worker, shutdown_timeout=10, restart_delay=5):
+        self.listener = listener
+        self.workers = workers
+        self.run_worker = run_worker
+        self.shutdown_timeout = shutdown_timeout
+        self.restart_delay = restart_delay
+        # pid -> (slot, started_at)
+        self.children = {}
+        # slot -> time of restart, for workers which kept exiting
+        self.pending = {}
+        self.stopping = self.reloading = False
+    
+    def run(self, old_workers=()):
+        '''Runs workers until asked to stop or reload.
+        
+        old_workers are pids of workers started by the previous master,
+        which are stopped once new workers are running.
+        
+        Returns True if the master should re-execute itself.'''
+        
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        
+        for slot in range(self.workers):
+            self._spawn(slot)
+        if old_workers:
+            self._stop_workers(old_workers)
+        
+        while not self.stopping and not self.reloading:
+            self._reap()
+            now = time.time()
+            for slot, restart_at in self.pending.items():
+                if restart_at <= now:
+                    del self.pending[slot]
+                    self._spawn(slot)
+            time.sleep(0.5)
+        
+        if self.reloading and not self.stopping:
+            # workers keep serving until the new master's workers are running
+            return True
+        self._stop_workers(self.children.keys())
+        return False
+    
+    def _handle_stop(self, signum, frame):
+        self.stopping = True
+    
+    def _handle_reload(self, signum, frame):
+        self.reloading = True
+    
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                try:
+                    self.run_worker(self.listener, slot)
+                    code = 0
+                except SystemExit, e:
+                    code = e.code
+                except:
+                    traceback.print_exc()
+            finally:
+                os._exit(code or 0)
+        self.children[pid] = (slot, time.time())
+        cherrypy.log('Started worker %d (pid %d)' % (slot, pid))
+    
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+            if not self.children.has_key(pid):
+                # worker of the previous master
+                continue
+            slot, started_at = self.children.pop(pid)
+            cherrypy.log('Worker %d (pid %d) exited with status %d' % (slot, pid, status))
+            if time.time() - started_at < self.restart_delay:
+                # do not spin if workers die right away, e.g. because of a broken configuration
+                self.pending[slot] = time.time() + self.restart_delay
+            else:
+                self._spawn(slot)
+    
+    def _stop_workers(self, pids):
+        pids = list(pids)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + self.shutdown_timeout
+        while pids:
+            for pid in list(pids):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                        continue
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno != errno.ECHILD:
+                        raise
+                pids.remove(pid)
+                self.children.pop(pid, None)
+            if pids and time.time() >= deadline:
+                cherrypy.log('Killing workers which did not stop in time: %s' % pids)
+                for pid in pids:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                deadline = time.time() + self.shutdown_timeout
+            time.sleep(0.1)
+
+def reexec(listener, workers, args):
+    '''Replaces the master with a fresh one, passing on listener
+    and pids of running workers'''
+    
+    # until the new master handles it, hangup would kill it
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    os.environ[LISTENER_VAR] = '%d:%d' % (listener.family, listener.fileno())
+    os.environ[OLD_WORKERS_VAR] = ','.join([str(pid) for pid in workers])
+    os.execv(sys.executable, [sys.executable, '-c', MAIN] + list(args))
+
+def main(args):
+    opts, rest = getopt.getopt(args, 'pfn:')
+    opts = dict(opts)
+    root = os.path.join(os.path.dirname(__file__), '..')
+    environment.load_config(root)
+    if opts.has_key('-p'):
+        environment.add_config('production.ini')
+    if opts.has_key('-n'):
+        workers = int(opts['-n'])
+    else:
+        workers = cherrypy.config.get('local.prefork.workers') or multiprocessing.cpu_count()
+    if workers > 1 and cherrypy.config.get('local.cache.single_flight.shared') is None:
+        cherrypy.config.update({'local.cache.single_flight.shared': True})
+    
+    # application is loaded once and shared by forked workers
+    environment.setup(root, plugins=False)
+    listener = bind_listener()
+    old_workers = [int(pid) for pid in os.environ.pop(OLD_WORKERS_VAR, '').split(',') if pid]
+    
+    fastcgi = opts.has_key('-f')
+    supervisor = Supervisor(listener, workers,
+        lambda listener, slot: run_worker(listener, slot, fastcgi),
+        shutdown_timeout=cherrypy.config.get('local.prefork.shutdown_timeout', 10),
+        restart_delay=cherrypy.config.get('local.prefork.restart_delay', 5))
+    if supervisor.run(old_workers):
+        cherrypy.log('Reloading')
+        reexec(listener, supervisor.children.keys(), args)
@@ -1,39 +1,90 @@
-import cherrypy, re, os.path, cPickle as pickle, time, calendar
+import cherrypy, re, os, os.path, time, threading, zlib, urllib2, socket, httplib
 
 from base_proxy import BaseProxy
-import tools.hashlib_shortcuts, tools.file
+import environment, rewriter, metrics
+import tools.hashlib_shortcuts, tools.gzip_shortcuts, tools.file, tools.file_lock, tools.http_headers
 
 def expires_to_timestamp(expires):
-    try:
-        # Expires: 0
-        int(expires)
+    timestamp = tools.http_headers.parse_http_date(expires)
+    if timestamp is None:
+        # Expires: 0 and other invalid dates mean already expired
         return time.time()-86400
-    except:
-        return calendar.timegm(time.strptime(expires, '%a, %d %b %Y %H:%M:%S %Z'))
+    return timestamp
 
-class Proxy(BaseProxy):
-    default_remote_host = cherrypy.config['remote.host']
+def get_cache_control(response):
+    '''Returns parsed cache-control header of response.
+    
+    The header is parsed once and shared by all stages adjusting the response;
+    changes are written back to the header with set_cache_control.'''
     
-    reverse_host_map = {
-        cherrypy.config['remote.host']: '',
-    }
+    value = response.headers.get('cache-control')
+    parsed = getattr(response, 'parsed_cache_control', None)
+    # reparsed if the header was replaced directly
+    if parsed is None or parsed[0] is not value:
+        parsed = (value, tools.http_headers.CacheControl(value))
+        response.parsed_cache_control = parsed
+    return parsed[1]
+
+def set_cache_control(response, cache_control):
+    value = str(cache_control)
+    if value:
+        response.headers['cache-control'] = value
+    else:
+        response.headers.pop('cache-control', None)
+        value = None
+    response.parsed_cache_control = (value, cache_control)
+
+# headers sent with 304 responses, which update those of the copy clients have
+NOT_MODIFIED_HEADERS = ('cache-control', 'expires', 'etag', 'last-modified', 'vary')
+
+def add_vary(headers, header):
+    '''Adds header to the vary header in headers dictionary unless it is already there'''
+    
+    if headers.has_key('vary'):
+        varies = [part.strip().lower() for part in headers['vary'].split(',')]
+        if header.lower() not in varies and '*' not in varies:
+            headers['vary'] += ', ' + header
+    else:
+        headers['vary'] = header
+
+def shared_flight_lock(locks_dir, key):
+    '''Returns lock which processes sharing the cache hold while fetching
+    and saving the page for key'''
     
+    if not os.path.exists(locks_dir):
+        tools.file.safe_mkdirs(locks_dir)
+    # a fixed set of lock files is shared by all pages, so that lock files
+    # never need to be removed; unrelated pages occasionally wait on each other
+    return tools.file_lock.FileLock(os.path.join(locks_dir, tools.hashlib_shortcuts.md5_hexdigest(key)[:3]))
+
+class Proxy(BaseProxy):
     adjust_host_in_content_types = ('text/html', 'application/xml', 'application/json')
     
+    # note: we use re.match which requires match from beginning
+    public_paths_re = re.compile(r'/(s/|images/|favicon\.ico|rest/api/1\.0/(header-separator|dropdowns)($|\?))')
+    
     def __init__(self):
         BaseProxy.__init__(self)
         
-        self.html_comment_re = re.compile(r'<!--.*?-->', re.S)
         self.html_script_re = re.compile(r'<script.*?</script>', re.S)
+    
+    def _load_settings(self):
+        BaseProxy._load_settings(self)
         
-        # note: we use re.match which requires match from beginning
-        self.public_paths_re = re.compile(r'/(s/|images/|favicon\.ico|rest/api/1\.0/(header-separator|dropdowns)($|\?))')
+        self.default_remote_host = self.settings.remote_host
+        self.reverse_host_map = self.settings.reverse_host_map
+        self.local_host = self.settings.local_host
     
-    def perform(self, **kwargs):
-        BaseProxy.perform(self, **kwargs)
+    def _complete_remote_request(self):
+        BaseProxy._complete_remote_request(self)
         
+        started = time.time()
         self._adjust_cache_directives()
+        metrics.observe_since('adjust_cache_directives', started)
+        self._adjust_content_encoding()
+        started = time.time()
         self._adjust_host_in_links()
+        metrics.observe_since('adjust_host_in_links', started)
     
     def _adjust_cache_directives(self):
         r = self._remote_response
@@ -47,13 +98,10 @@ class Proxy(BaseProxy):
             if value == 'no-cache':
                 del r.headers['pragma']
         if r.headers.has_key('cache-control'):
-            value = r.headers['cache-control']
-            parts = [part.strip() for part in value.split(',')]
-            new_parts = [part for part in parts if part not in ['no-cache', 'no-store']]
-            if len(parts) != len(new_parts):
-                new_value = ', '.join(new_parts)
-                r.headers['cache-control'] = new_value
-            if 'public' in new_parts:
+            cache_control = get_cache_control(r)
+            if cache_control.remove('no-cache', 'no-store'):
+                set_cache_control(r, cache_control)
+            if cache_control.has('public'):
                 r.public = True
         # kill past expiration dates
         if r.headers.has_key('expires'):
@@ -61,28 +109,51 @@ class Proxy(BaseProxy):
             if expires_at < time.time():
                 del r.headers['expires']
         
-    def _adjust_host_in_links(self):
+    def _adjust_content_encoding(self):
         r = self._remote_response
         
+        # compressed responses are passed through to clients that accept them,
+        # unless we need to edit the content
+        encoding = r.headers.get('content-encoding')
+        if encoding in (None, 'identity'):
+            return
+        if encoding != 'gzip':
+            # passed on as is, as the remote host chose it
+            add_vary(r.headers, 'Accept-Encoding')
+            return
+        edited = self._needs_host_adjustment(r)
+        if edited or not tools.gzip_shortcuts.accepts_gzip(r.params.accept_encoding):
+            if r.streaming:
+                r.content = tools.gzip_shortcuts.gunzip_chunks(r.content)
+            else:
+                r.content = tools.gzip_shortcuts.gunzip(r.content)
+            del r.headers['content-encoding']
+        if not edited:
+            # clients accepting gzip get it compressed
+            add_vary(r.headers, 'Accept-Encoding')
+    
+    def _needs_host_adjustment(self, r):
         # post responses have no content type, thus nothing to adjust
         if not r.headers.has_key('content-type'):
-            return
+            return False
         
         content_type = r.headers['content-type'].lower()
         for check in self.__class__.adjust_host_in_content_types:
             if content_type.startswith(check):
-                content = r.content
-                content = self.html_comment_re.sub('', content)
-                local_host = cherrypy.config.get('local.host')
-                incoming_host = cherrypy.request.headers.get('host')
-                search = cherrypy.config['remote.host']
-                replace = local_host or incoming_host or self.__class__.default_remote_host
-                content = content.replace(search, replace)
-                if local_host:
-                    content = content.replace(incoming_host, local_host)
-                #content = self.html_script_re.sub(lambda match: match.group(0).replace(search, replace), content)
-                r.content = content
-                break
+                return True
+        return False
+    
+    def _adjust_host_in_links(self):
+        r = self._remote_response
+        
+        if self._needs_host_adjustment(r):
+            host_rewriter = rewriter.get_host_rewriter(self.default_remote_host,
+                self.local_host, r.params.incoming_host, self.default_remote_host)
+            if r.streaming:
+                r.content = host_rewriter.rewrite_chunks(r.content)
+            else:
+                r.content = host_rewriter.rewrite(r.content)
+            #content = self.html_script_re.sub(lambda match: match.group(0).replace(search, replace), content)
     
     def _collect_request_parameters(self, **kwargs):
         BaseProxy._collect_request_parameters(self, **kwargs)
@@ -100,132 +171,716 @@ class Proxy(BaseProxy):
     def _adjust_request(self):
         if self.public_paths_re.match(self._params.path):
             self._params.clear_cookies()
+        # compressed responses are decompressed if we need to edit them
+        if self.settings.remote_gzip:
+            self._params.headers['Accept-Encoding'] = 'gzip'
     
-    def _issue_remote_request(self):
-        BaseProxy._issue_remote_request(self)
+    def _accept_remote_response(self, response):
+        BaseProxy._accept_remote_response(self, response)
         
         # see note in _collect_request_parameters.
         # do what should be done in varnish
         self._adjust_response()
     
+    def _keeps_cookies(self):
+        # cookies on public paths are cleared by _adjust_response; save parsing them
+        return not self.public_paths_re.match(self._params.path)
+    
     # header adjustments from varnish
     def _adjust_response(self):
         if self.public_paths_re.match(self._params.path):
             self._remote_response.clear_cookies()
             self._make_response_public()
-            # be aggressive here since we don't get much traffic
-            self._force_min_expiration(86400)
+            if self._versioned(self._params.path) and self._remote_response.code in (None, 200):
+                # content behind a versioned url never changes
+                self._force_min_expiration(self.settings.static_max_age)
+                self._add_cache_directive('immutable')
+            else:
+                # be aggressive here since we don't get much traffic
+                self._force_min_expiration(86400)
+    
+    def _versioned(self, path):
+        # static assets whose urls change with their content, see local.cache.static
+        return self.settings.static and self.settings.static_versioned_re.match(path) is not None
+    
+    def _add_cache_directive(self, directive):
+        r = self._remote_response
+        cache_control = get_cache_control(r)
+        cache_control.add(directive)
+        set_cache_control(r, cache_control)
     
     def _make_response_public(self):
-        h = self._remote_response.headers
-        if h.has_key('cache-control'):
-            cache_control = [part.strip() for part in h['cache-control'].split(',')]
-            if 'private' in cache_control:
-                # asked to make public a private response...
-                # we strip cookies on public paths so we should be ok to ignore this
-                cache_control.delete('private')
-            if 'public' not in cache_control:
-                cache_control.append('public')
-            cache_control = ', '.join(cache_control)
-        else:
-            cache_control = 'public'
-        h['cache-control'] = cache_control
+        r = self._remote_response
+        cache_control = get_cache_control(r)
+        # asked to make public a private response...
+        # we strip cookies on public paths so we should be ok to ignore this
+        cache_control.remove('private')
+        cache_control.add('public')
+        set_cache_control(r, cache_control)
     
     def _force_min_expiration(self, time_in_seconds):
-        h = self._remote_response.headers
-        expires_at = self._determine_response_expiration_time(self._remote_response)
+        r = self._remote_response
+        expires_at = self._determine_response_expiration_time(r)
         min_expires_at = int(time.time()) + time_in_seconds
         if expires_at is None or expires_at < min_expires_at:
-            if h.has_key('cache-control'):
-                cache_control = [part.strip() for part in h['cache-control'].split(',')]
-                for part in cache_control:
-                    if part.startswith('max-age='):
-                        cache_control.remove(part)
-                        break
-            else:
-                cache_control = []
-            cache_control.append('max-age=%d' % time_in_seconds)
-            h['cache-control'] = ', '.join(cache_control)
-            if h.has_key('expires'):
-                del h['expires']
+            cache_control = get_cache_control(r)
+            # the new max-age goes last, as it used to
+            cache_control.remove('max-age')
+            cache_control.add('max-age', str(time_in_seconds))
+            set_cache_control(r, cache_control)
+            if r.headers.has_key('expires'):
+                del r.headers['expires']
     
     def _determine_response_expiration_time(self, response):
         h = response.headers
         expires_at = None
         # max-age takes precedence over expires
         if h.has_key('cache-control'):
-            parts = [part.strip() for part in h['cache-control'].split(',')]
-            for part in parts:
-                if part.startswith('max-age='):
-                    age = int(part[8:])
-                    expires_at = int(time.time()) + age
-                    break
+            age = get_cache_control(response).max_age()
+            if age is not None:
+                expires_at = int(time.time()) + age
         if expires_at is None and h.has_key('expires'):
             expires_at = expires_to_timestamp(h['expires'])
         return expires_at
 
+# failures to get a response from the remote host
+remote_errors = (urllib2.URLError, socket.error, httplib.HTTPException)
+
 class ContentWrapper:
     def __init__(self, content):
         self.content = content
 
+def cached_body_paths(absolute_path, headers):
+    '''Returns paths of files holding bodies of a cached page'''
+    
+    paths = []
+    if headers.get('x-cache-raw', True):
+        paths.append(absolute_path)
+    if headers.get('x-cache-gzip'):
+        paths.append(absolute_path + '.gz')
+    return paths
+
+# last time each cached page was served, for the janitor and the warmer.
+# they write access times to the cache index, emptying this; unless one
+# of them runs nothing would, so accesses are not recorded at all
+cache_access_times = {}
+record_access_times = False
+
+def note_access(key):
+    if record_access_times:
+        cache_access_times[key] = time.time()
+
 class CachingProxy(Proxy):
     def perform_and_propagate(self, **kwargs):
+        response = self.lookup()
+        if response is None:
+            if self._can_coalesce(**kwargs):
+                response = self._coalesced_fetch(**kwargs)
+            else:
+                response = self._fetch_and_save(**kwargs)
+        return response
+    
+    def lookup(self):
+        '''Returns cached response to the current request, propagating
+        its headers, or None if the page is not in the cache'''
+        
+        started = time.time()
         self._setup_cache_variables()
         content = self._find_in_cache()
+        environment.get_cache_key_builder().record(self.cache_key_rules, content is not None)
+        metrics.observe_since('cache_lookup', started)
         if content is None:
-            response = Proxy.perform_and_propagate(self, **kwargs)
-            if response.public:
-                self._save_to_cache(response)
-        else:
-            # small hack for x-accel-redirect support
-            if content is True:
-                content = None
-            response = ContentWrapper(content)
+            metrics.count('cache_requests', 'miss')
+            return None
+        metrics.count('cache_requests', 'hit')
+        if isinstance(content, str):
+            metrics.count('cache_bytes', amount=len(content))
+        return self._wrap_cached_content(content)
+    
+    def store(self, response):
+        '''Saves response to the current request if it may be cached.
+        
+        Returns True if the page is in the cache.'''
+        
+        # stale pages served in place of failed responses are in the cache already
+        if isinstance(response, ContentWrapper):
+            return True
+        if not self._cacheable(response):
+            return False
+        started = time.time()
+        saved = self._save_to_cache(response)
+        metrics.observe_since('cache_save', started)
+        return saved
+    
+    def _wrap_cached_content(self, content):
+        # small hack for x-accel-redirect support
+        if content is True:
+            content = None
+        return ContentWrapper(content)
+    
+    def complete_and_propagate(self, response):
+        self._accept_remote_response(response)
+        self._complete_remote_request()
+        return self._propagate_unless_failed()
+    
+    def serve_stale(self):
+        '''Serves cached copy of the current page in place of a failed
+        remote response, provided it expired no longer than
+        local.cache.stale_if_error seconds ago.
+        
+        Returns the cached response, or None if there is no such copy.'''
+        
+        stale_if_error = self.settings.stale_if_error
+        if not stale_if_error or self.cache_absolute_path is None:
+            return None
+        entry = self._lookup_cached_entry(max(stale_if_error, self._stale_grace()))
+        if entry is None:
+            return None
+        headers, bodies = entry
+        content = self._serve_cached(headers, bodies)
+        if content is None:
+            return None
+        note_access(self.cache_relative_path)
+        cherrypy.response.headers['warning'] = '111 - "Revalidation failed"'
+        metrics.count('cache_error_serves')
+        return self._wrap_cached_content(content)
+    
+    def _fetch_and_save(self, **kwargs):
+        try:
+            self.perform(**kwargs)
+        except remote_errors:
+            response = self.serve_stale()
+            if response is None:
+                raise
+            cherrypy.log('Serving stale %s, remote request failed' % self.cache_relative_path, traceback=True)
+            return response
+        response = self._propagate_unless_failed()
+        self.store(response)
         return response
     
-    def _setup_cache_variables(self):
-        self.cache_absolute_path = self.cache_absolute_path_meta = None
+    def _propagate_unless_failed(self):
+        # server errors are replaced with stale copies of the page when there are any,
+        # so that a struggling remote host does not get the whole load at once
+        r = self._remote_response
+        if self._failed(r):
+            response = self.serve_stale()
+            if response is not None:
+                if r.streaming:
+                    # returns the connection to the pool
+                    r.content.close()
+                return response
+        self._propagate_remote_response()
+        return r
+    
+    def _failed(self, response):
+        return response.code is not None and response.code >= 500
+    
+    def _cacheable(self, response):
+        # keepalive handler sets code on successful responses too
+        if response.code in (None, 200):
+            return response.public
+        return self._status_ttl(response) is not None
+    
+    def _status_ttl(self, response):
+        # returns seconds a response with a status other than 200 is cached for,
+        # None if it is not cached. such responses are rarely marked public,
+        # so only those which cannot differ between visitors are cached
+        ttl = self.settings.status_ttls.get(response.code)
+        if ttl is None or response.params.cookie or len(response.cookies):
+            return None
+        if get_cache_control(response).has('private'):
+            return None
+        return ttl
+    
+    def _can_coalesce(self, **kwargs):
+        # only coalesce requests whose responses do not depend on the client,
+        # that is, requests which are sent to the remote host without cookies
+        if self.cache_absolute_path is None:
+            return False
+        method = kwargs.get('method') or cherrypy.request.method.lower()
+        if method != 'get':
+            return False
+        return not self._sends_cookies(kwargs.get('path_info') or cherrypy.request.path_info)
+    
+    def _sends_cookies(self, path):
+        # whether the current request is sent to the remote host with cookies,
+        # so that the response may differ from what anonymous visitors get
+        return cherrypy.request.headers.has_key('Cookie') and not self.public_paths_re.match(path)
+    
+    def _coalesced_fetch(self, **kwargs):
+        key = self.cache_relative_path
+        timeout = self.settings.single_flight_timeout
+        flight, leader = environment.get_in_flight().begin(key)
+        if leader:
+            lock = self._shared_flight_lock(key)
+            try:
+                if lock is not None and not lock.acquire():
+                    # another process is fetching this page
+                    if not lock.acquire(timeout):
+                        lock = None
+                    content = self._find_in_cache()
+                    if content is not None:
+                        self._finish_flight(flight, lock)
+                        return self._wrap_cached_content(content)
+                response = self._fetch_and_save(**kwargs)
+            except:
+                self._finish_flight(flight, lock)
+                raise
+            if not isinstance(response, ContentWrapper) and response.streaming:
+                # page is saved once the client has read all of it
+                response.content = self._finish_flight_after(response.content, flight, lock)
+            else:
+                self._finish_flight(flight, lock)
+            return response
+        
+        # another thread is fetching this page; once it is done
+        # the page is in the cache, provided it was cacheable
+        if flight.wait(timeout):
+            content = self._find_in_cache()
+            if content is not None:
+                return self._wrap_cached_content(content)
+        # response was not cacheable or the other thread is taking too long
+        return self._fetch_and_save(**kwargs)
+    
+    def _shared_flight_lock(self, key):
+        # lock coalescing fetches across processes sharing the cache
+        if not self.settings.single_flight_shared:
+            return None
+        return shared_flight_lock(self.settings.locks_dir, key)
+    
+    def _finish_flight(self, flight, lock):
+        if lock is not None:
+            lock.release()
+        environment.get_in_flight().finish(flight)
+    
+    def _finish_flight_after(self, chunks, flight, lock):
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            self._finish_flight(flight, lock)
+    
+    def _setup_cache_variables(self, path_info=None, query_string=None, key=None):
+        self._load_settings()
+        self.cache_absolute_path = self.cache_file_path = None
+        self.cache_key_rules = []
         r = cherrypy.request
-        if r.query_string:
-            hashed_qs = tools.hashlib_shortcuts.md5_hexdigest(r.query_string)
-            relative_path = r.path_info + '::' + hashed_qs
+        if path_info is None:
+            path_info, query_string = r.path_info, r.query_string
+            headers = r.headers
         else:
-            relative_path = r.path_info
+            # not the request being served
+            headers = None
+        self.cache_static = self.settings.static and self.public_paths_re.match(path_info) is not None
+        self.cache_versioned = self.cache_static and self._versioned(path_info)
+        # remembered with the cached page so that it can be refetched later
+        self.cache_request = (path_info, query_string, r.headers.get('host'))
+        if key is None:
+            relative_path, self.cache_key_rules = environment.get_cache_key_builder().build(path_info, query_string, headers)
+        else:
+            relative_path = key
         if relative_path.find('..') >= 0:
             raise ValueError('Suspicious request relative path: %s' % relative_path)
         assert relative_path[0] == '/'
         self.cache_relative_path = relative_path
-        relative_path = relative_path[1:]
-        if relative_path:
-            assert relative_path[0] != '/'
-            self.cache_absolute_path = os.path.join(cherrypy.config['local.cache.dir'], relative_path)
-            self.cache_absolute_path_meta = self.cache_absolute_path + '.meta'
+        if relative_path[1:]:
+            assert relative_path[1] != '/'
+            self.cache_file_path = environment.get_cache_layout().file_path(relative_path)
+            self.cache_absolute_path = os.path.join(self.settings.cache_dir, self.cache_file_path)
     
     def _find_in_cache(self):
-        if self.cache_absolute_path_meta is not None and os.path.exists(self.cache_absolute_path_meta):
-            headers = pickle.loads(tools.file.read(self.cache_absolute_path_meta))
+        if self.cache_absolute_path is None:
+            return None
+        
+        entry = self._lookup_cached_entry()
+        if entry is None:
+            return None
+        headers, bodies = entry
+        if self.cache_static and self._not_modified(headers):
+            content = self._serve_not_modified(headers)
+        else:
+            content = self._serve_cached(headers, bodies)
+            if content is None:
+                return None
+        note_access(self.cache_relative_path)
+        if headers['x-expires-timestamp'] < time.time():
+            # within grace period; serve what we have and refresh it behind the scenes
+            self._start_revalidation(headers)
+            cherrypy.response.headers['warning'] = '110 - "Response is stale"'
+            metrics.count('cache_stale_serves')
+        else:
+            # pages are unpublished when they expire soon but may be requested again
+            # before they are revalidated, and are lost when nginx's cache dir is cleaned up
+            self._publish(headers, replace=False)
+        return content
+    
+    def _lookup_cached_entry(self, grace=None):
+        # returns (headers, bodies) of cached page if it is fresh or
+        # still within grace period, stale grace by default, None otherwise.
+        # bodies maps content encodings to content and holds whatever
+        # variants were read from disk so far
+        memory_cache = environment.get_memory_cache()
+        if memory_cache is not None:
+            entry = memory_cache.get(self.cache_relative_path)
+            if entry is not None:
+                headers, bodies, checked_at = entry
+                if checked_at + self.settings.memory_check_interval > time.time():
+                    return self._servable((headers, bodies))
+                # pages are purged, and removed by janitors of other processes,
+                # without this memory cache knowing; look at the index now and then
+                indexed = environment.get_cache_index().get(self.cache_relative_path)
+                if indexed is not None and self._same_entry(indexed, headers):
+                    self._remember_in_memory(headers, bodies)
+                    return self._servable((headers, bodies))
+                memory_cache.delete(self.cache_relative_path)
+        
+        headers = environment.get_cache_index().get(self.cache_relative_path)
+        if headers is not None:
             expires = headers['x-expires-timestamp']
             now = time.time()
-            if expires >= now:
-                for key, value in headers.items():
-                    cherrypy.response.headers[key] = value
-                if cherrypy.config.get('local.cache.x_accel_redirect.enabled'):
-                    cherrypy.response.headers['x-accel-redirect'] = cherrypy.config['local.cache.x_accel_redirect.prefix'] + self.cache_relative_path
-                    content = True
-                else:
-                    content = tools.file.read(self.cache_absolute_path)
-                return content
+            if grace is None:
+                grace = self._stale_grace()
+            if expires + grace >= now:
+                self._remember_in_memory(headers, {})
+                return self._servable((headers, {}))
     
-    def _save_to_cache(self, response):
-        if self.cache_absolute_path is None or response.code is not None:
+    def _same_entry(self, headers, other):
+        # whether both headers are of the same save of the page
+        return headers['x-expires-timestamp'] == other['x-expires-timestamp'] and \
+            self._cached_file_path(headers) == self._cached_file_path(other)
+    
+    def _servable(self, entry):
+        # error pages and redirects are only cached from requests without
+        # cookies, see _status_ttl; a session may be allowed to see the page
+        # anonymous visitors were denied or redirected to the login for
+        headers, bodies = entry
+        if headers.has_key('x-cache-status') and self._sends_cookies(cherrypy.request.path_info):
+            return None
+        return entry
+    
+    def _stale_grace(self):
+        return self.settings.stale_grace
+    
+    def _serve_cached(self, headers, bodies):
+        # returns None if the page was removed from disk after its metadata was read
+        # nginx would serve error pages and redirects with status 200
+        x_accel_redirect = self.settings.x_accel_redirect and not headers.has_key('x-cache-status')
+        encoding = 'identity'
+        if x_accel_redirect:
+            # nginx picks the compressed variant by itself, see gzip_static in nginx.conf.erb,
+            # and would answer 404 for a page which was removed in the meantime
+            absolute_path = os.path.join(self.settings.cache_dir, self._cached_file_path(headers))
+            if not headers.get('x-cache-raw', True):
+                absolute_path += '.gz'
+            if not os.path.exists(absolute_path):
+                return None
+            content = True
+        else:
+            if headers.get('x-cache-gzip') and tools.gzip_shortcuts.accepts_gzip(cherrypy.request.headers.get('accept-encoding')):
+                encoding = 'gzip'
+            if not bodies.has_key(encoding):
+                try:
+                    body = self._read_cached_body(headers, encoding)
+                except (IOError, OSError):
+                    # janitor got to it
+                    return None
+                # entries in memory are shared between threads; do not modify them
+                bodies = dict(bodies)
+                bodies[encoding] = body
+                self._remember_in_memory(headers, bodies)
+            content = bodies[encoding]
+        
+        if headers.has_key('x-cache-status'):
+            cherrypy.response.status = headers['x-cache-status']
+        for key, value in headers.items():
+            if not key.startswith('x-cache-'):
+                cherrypy.response.headers[key] = value
+        if self._varies_on_encoding(headers):
+            add_vary(cherrypy.response.headers, 'Accept-Encoding')
+        if encoding == 'gzip':
+            cherrypy.response.headers['content-encoding'] = 'gzip'
+        if x_accel_redirect:
+            cherrypy.response.headers['x-accel-redirect'] = self.settings.x_accel_redirect_prefix + '/' + self._cached_file_path(headers)
+        return content
+    
+    def _varies_on_encoding(self, headers):
+        # compressed variants are served to clients accepting them, and pages
+        # stored compressed only are decompressed for the others
+        return headers.get('x-cache-gzip') or not headers.get('x-cache-raw', True)
+    
+    def _not_modified(self, headers):
+        # whether the client has the cached page already, judging by
+        # validators it sent. stale pages are left for revalidation to confirm
+        if headers.has_key('x-cache-status') or headers['x-expires-timestamp'] < time.time():
+            return False
+        request_headers = cherrypy.request.headers
+        if request_headers.has_key('if-none-match'):
+            if not headers.has_key('etag'):
+                return False
+            # weak comparison, as for any get request
+            etag = headers['etag']
+            if etag.startswith('W/'):
+                etag = etag[2:]
+            for tag in request_headers['if-none-match'].split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'):
+                    tag = tag[2:]
+                if tag == etag or tag == '*':
+                    return True
+            return False
+        if request_headers.has_key('if-modified-since'):
+            if self.cache_versioned:
+                # any copy of a versioned url is current
+                return True
+            if not headers.has_key('last-modified'):
+                return False
+            last_modified = tools.http_headers.parse_http_date(headers['last-modified'])
+            if_modified_since = tools.http_headers.parse_http_date(request_headers['if-modified-since'])
+            return last_modified is not None and if_modified_since is not None and last_modified <= if_modified_since
+        return False
+    
+    def _serve_not_modified(self, headers):
+        # answers a conditional request from cached metadata, without reading the body
+        cherrypy.response.status = 304
+        cherrypy.response.headers.pop('content-type', None)
+        for key in NOT_MODIFIED_HEADERS:
+            if headers.has_key(key):
+                cherrypy.response.headers[key] = headers[key]
+        if self._varies_on_encoding(headers):
+            add_vary(cherrypy.response.headers, 'Accept-Encoding')
+        metrics.count('cache_not_modified')
+        return ''
+    
+    def _cached_file_path(self, headers):
+        # pages saved before the cache layout was changed stay where they were
+        # until they are migrated
+        return headers.get('x-cache-file') or self.cache_relative_path[1:]
+    
+    def _read_cached_body(self, headers, encoding):
+        absolute_path = os.path.join(self.settings.cache_dir, self._cached_file_path(headers))
+        if encoding == 'gzip':
+            return tools.file.read(absolute_path + '.gz')
+        if headers.get('x-cache-raw', True):
+            return tools.file.read(absolute_path)
+        # only compressed variant is stored
+        return tools.gzip_shortcuts.gunzip(tools.file.read(absolute_path + '.gz'))
+    
+    def _start_revalidation(self, headers):
+        # pages cached before request information was stored with them
+        # cannot be refetched
+        if not headers.has_key('x-cache-request'):
+            return
+        key = self.cache_relative_path
+        flight, leader = environment.get_in_flight().begin(key)
+        if not leader:
+            # page is being fetched or revalidated already
             return
+        thread = threading.Thread(target=self._revalidate_in_background, args=(flight, headers))
+        thread.setDaemon(True)
+        try:
+            thread.start()
+        except:
+            environment.get_in_flight().finish(flight)
+            raise
+    
+    def _revalidate_in_background(self, flight, headers):
+        try:
+            try:
+                self.__class__().revalidate(headers, flight.key)
+            except:
+                cherrypy.log('Error revalidating %s' % flight.key, traceback=True)
+        finally:
+            environment.get_in_flight().finish(flight)
+    
+    def refresh(self, key):
+        '''Revalidates cached page stored under key, unless it is being
+        fetched or revalidated already.
+        
+        Returns False if there is no such page or it cannot be refetched.'''
         
-        headers = response.headers
+        headers = environment.get_cache_index().get(key)
+        if headers is None or not headers.has_key('x-cache-request'):
+            return False
+        flight, leader = environment.get_in_flight().begin(key)
+        if leader:
+            try:
+                self.revalidate(headers, key)
+            finally:
+                environment.get_in_flight().finish(flight)
+        return True
+    
+    def revalidate(self, headers, key=None):
+        '''Refetches cached page described by headers, sending validators
+        stored with the page so that an unchanged page is not transferred again.
+        
+        key is the cache key of the page; it can only be recomputed
+        if it does not depend on request headers.'''
+        
+        path_info, query_string, incoming_host = headers['x-cache-request']
+        self._setup_cache_variables(path_info, query_string, key)
+        self.cache_request = headers['x-cache-request']
+        conditional_headers = {}
+        if headers.has_key('etag'):
+            conditional_headers['If-None-Match'] = headers['etag']
+        if headers.has_key('last-modified'):
+            conditional_headers['If-Modified-Since'] = headers['last-modified']
+        self.perform(method='get', path_info=path_info, query_string=query_string or '',
+            incoming_host=incoming_host, headers=conditional_headers, stream=False)
+        response = self._remote_response
+        if response.code == 304:
+            self._extend_cached_entry(headers, response)
+        elif self._failed(response):
+            # keep the page we have, it may be served while the remote host is failing
+            pass
+        elif self._cacheable(response):
+            self._save_to_cache(response)
+    
+    def _extend_cached_entry(self, headers, response):
+        # 304 responses may carry updated caching headers;
+        # otherwise reapply caching headers stored with the page
         expires_at = self._determine_response_expiration_time(response)
+        if expires_at is None:
+            expires_at = self._determine_response_expiration_time(self.ResponseClass(headers=headers))
+        if expires_at is None or expires_at < time.time():
+            return
+        
+        headers = dict(headers)
+        for key in ('cache-control', 'expires', 'etag', 'last-modified'):
+            if response.headers.has_key(key):
+                headers[key] = response.headers[key]
+        headers['x-expires-timestamp'] = expires_at
+        # body is unchanged; only rewrite metadata, unless the body was moved
+        # into another cache layout in the meantime
+        if not environment.get_cache_index().update_headers(self.cache_relative_path, headers, file=self._cached_file_path(headers)):
+            return
+        self._remember_in_memory(headers, {})
+        self._publish(headers, replace=False)
+    
+    def _remember_in_memory(self, headers, bodies):
+        memory_cache = environment.get_memory_cache()
+        if memory_cache is not None:
+            size = len(self.cache_relative_path) + sum([len(key) + len(str(value)) for key, value in headers.items()])
+            size += sum([len(body) for body in bodies.values()])
+            expires_at = headers['x-expires-timestamp'] + self._stale_grace()
+            memory_cache.set(self.cache_relative_path, (headers, bodies, time.time()), size, expires_at)
+    
+    def _save_to_cache(self, response):
+        # returns True if the page was saved
+        if self.cache_absolute_path is None:
+            return False
+        
+        if response.code in (None, 200):
+            expires_at = self._determine_response_expiration_time(response)
+        else:
+            # negative responses and redirects, see local.cache.status_ttls
+            ttl = self._status_ttl(response)
+            if ttl is None:
+                return False
+            expires_at = int(time.time()) + ttl
         if expires_at is not None:
+            headers = dict(response.headers)
+            if response.code not in (None, 200):
+                headers['x-cache-status'] = response.code
+            # content encoding is chosen when serving the page
+            encoding = headers.pop('content-encoding', None)
             headers['x-expires-timestamp'] = expires_at
-            dir = os.path.dirname(self.cache_absolute_path)
-            if not os.path.exists(dir):
-                tools.file.safe_mkdirs(dir)
-            tools.file.safe_write(self.cache_absolute_path, response.content)
-            tools.file.safe_write(self.cache_absolute_path_meta, pickle.dumps(headers))
+            headers['x-cache-request'] = self.cache_request
+            headers['x-cache-file'] = self.cache_file_path
+            headers['x-cache-gzip'] = self.settings.gzip or self._precompress(headers)
+            headers['x-cache-raw'] = not headers['x-cache-gzip'] or self.settings.gzip_keep_raw
+            # directories of fixed layouts are created at startup
+            if not environment.get_cache_layout().has_fixed_dirs():
+                dir = os.path.dirname(self.cache_absolute_path)
+                if not os.path.exists(dir):
+                    tools.file.safe_mkdirs(dir)
+            if response.streaming:
+                # saved once the client has read all of it
+                response.content = self._stream_to_cache(response.content, headers, encoding)
+                return False
+            self._write_cached_bodies(response.content, headers, encoding)
+            return True
+        return False
+    
+    def _precompress(self, headers):
+        # static assets are compressed once when saved rather than by nginx on every request
+        if not self.cache_static or not headers.has_key('content-type'):
+            return False
+        content_type = headers['content-type'].split(';')[0].strip().lower()
+        return content_type in self.settings.static_gzip_types
+    
+    def _write_cached_bodies(self, content, headers, encoding):
+        bodies = {}
+        if encoding == 'gzip':
+            bodies['gzip'] = content
+            if headers['x-cache-raw']:
+                bodies['identity'] = tools.gzip_shortcuts.gunzip(content)
+                tools.file.safe_write(self.cache_absolute_path, bodies['identity'])
+            if headers['x-cache-gzip']:
+                tools.file.safe_write(self.cache_absolute_path + '.gz', content)
+        else:
+            bodies['identity'] = content
+            if headers['x-cache-raw']:
+                tools.file.safe_write(self.cache_absolute_path, content)
+            if headers['x-cache-gzip']:
+                tools.file.safe_write_gzip(self.cache_absolute_path + '.gz', content)
+        if not headers['x-cache-gzip']:
+            # pass-through compressed content is not kept unless configured
+            bodies.pop('gzip', None)
+        self._save_cache_meta(headers, bodies)
+    
+    def _stream_to_cache(self, chunks, headers, encoding):
+        # writes chunks to the cache as they are passed on to the client.
+        # the page is only saved if the client reads all of it
+        writers = []
+        raw_writer = gzip_writer = decompressor = None
+        completed = False
+        try:
+            if headers['x-cache-raw']:
+                raw_writer = tools.file.SafeWriter(self.cache_absolute_path)
+                writers.append(raw_writer)
+                if encoding == 'gzip':
+                    decompressor = zlib.decompressobj(tools.gzip_shortcuts.GZIP_WBITS)
+            if headers['x-cache-gzip']:
+                if encoding == 'gzip':
+                    gzip_writer = tools.file.SafeWriter(self.cache_absolute_path + '.gz')
+                else:
+                    gzip_writer = tools.file.SafeGzipWriter(self.cache_absolute_path + '.gz')
+                writers.append(gzip_writer)
+            for chunk in chunks:
+                if gzip_writer is not None:
+                    gzip_writer.write(chunk)
+                if decompressor is not None:
+                    raw_writer.write(decompressor.decompress(chunk))
+                elif raw_writer is not None:
+                    raw_writer.write(chunk)
+                yield chunk
+            if decompressor is not None:
+                raw_writer.write(decompressor.flush())
+            completed = True
+        finally:
+            if completed:
+                for writer in writers:
+                    writer.commit()
+                self._save_cache_meta(headers, {})
+            else:
+                for writer in writers:
+                    writer.abort()
+    
+    def _save_cache_meta(self, headers, bodies):
+        size = files = 0
+        for path in cached_body_paths(self.cache_absolute_path, headers):
+            size += os.stat(path).st_size
+            files += 1
+        environment.get_cache_index().put(self.cache_relative_path, headers, size, files)
+        if self.settings.x_accel_redirect:
+            # nginx serves the content
+            bodies = {}
+        self._remember_in_memory(headers, bodies)
+        self._publish(headers)
+    
+    def _publish(self, headers, replace=True):
+        # lets nginx serve the page without asking us, see cache_publish.py
+        publisher = environment.get_cache_publisher()
+        if publisher is not None:
+            absolute_path = os.path.join(self.settings.cache_dir, self._cached_file_path(headers))
+            publisher.publish(self.cache_relative_path, headers, absolute_path, replace)
@@ -0,0 +1,123 @@
+import tools.lru
+
+class HostRewriter:
+    '''Removes html comments from response content and substitutes host names in it.
+    
+    replacements is a sequence of (search, replace) pairs which are applied in order.
+    The rewriting plan is computed once: replacements that cannot change anything
+    are dropped, and comments are cut out with plain string searches into a single
+    output buffer, over which host names are then replaced.
+    
+    Matching comments and host names with one compiled alternation would scan
+    content only once, but re.sub calling back into python for every match is
+    several times slower than str.replace; see bench/rewriter.py.
+    
+    Rewriters hold no per-response state and may be shared between threads.
+    '''
+    
+    comment_opener = '<!--'
+    comment_closer = '-->'
+    
+    def __init__(self, replacements):
+        self.replacements = [(search, replace) for search, replace in replacements if search and search != replace]
+        self.searches = [search for search, replace in self.replacements]
+        
+        # enough content to hold back for a comment opener or a host name
+        # to be completed by the next chunk
+        self.holdback = max([len(self.comment_opener) - 1] + [len(search) - 1 for search in self.searches])
+    
+    def rewrite(self, content):
+        content = self._strip_comments(content)
+        for search, replace in self.replacements:
+            content = content.replace(search, replace)
+        return content
+    
+    def _strip_comments(self, content):
+        # equivalent to removing matches of <!--.*?--> with re.S
+        opener, closer = self.comment_opener, self.comment_closer
+        opener_length, closer_length = len(opener), len(closer)
+        find = content.find
+        start = find(opener)
+        if start < 0:
+            return content
+        parts = []
+        append = parts.append
+        pos = 0
+        while start >= 0:
+            end = find(closer, start + opener_length)
+            if end < 0:
+                # unterminated comments are left alone
+                break
+            append(content[pos:start])
+            pos = end + closer_length
+            start = find(opener, pos)
+        append(content[pos:])
+        return ''.join(parts)
+    
+    def rewrite_chunks(self, chunks):
+        '''Rewrites content arriving in chunks, yielding rewritten chunks.
+        
+        Content is held back as necessary so that comments and host names
+        split across chunk boundaries are still rewritten.'''
+        
+        pending = ''
+        for chunk in chunks:
+            pending += chunk
+            cut = self._safe_cut(pending)
+            if cut > 0:
+                yield self.rewrite(pending[:cut])
+                pending = pending[cut:]
+        if pending:
+            yield self.rewrite(pending)
+    
+    def _safe_cut(self, data):
+        # returns length of the longest prefix of data that can be rewritten
+        # independently of content that is yet to arrive
+        cut = len(data) - self.holdback
+        
+        # move cut before any comment, comment opener or host name it would split
+        moved = True
+        while moved and cut > 0:
+            moved = False
+            start = self._comment_containing(data, cut)
+            if start is not None:
+                cut = start
+                moved = True
+            for search in [self.comment_opener] + self.searches:
+                start = data.find(search, max(0, cut - len(search) + 1), cut + len(search) - 1)
+                if start >= 0 and start < cut:
+                    cut = start
+                    moved = True
+        return max(cut, 0)
+    
+    def _comment_containing(self, data, pos):
+        # returns start of the comment spanning pos, if any.
+        # comments are located the same way _strip_comments finds them,
+        # unterminated comments extend to the end of data
+        start = data.find(self.comment_opener)
+        while 0 <= start < pos:
+            end = data.find(self.comment_closer, start + len(self.comment_opener))
+            if end < 0 or end + len(self.comment_closer) > pos:
+                return start
+            start = data.find(self.comment_opener, end + 3)
+        return None
+
+# incoming host comes from the client, so keep the number of rewriters bounded
+_rewriters = tools.lru.LruCache(256, 256)
+
+def get_host_rewriter(remote_host, local_host, incoming_host, default_host):
+    '''Returns a rewriter pointing links to remote_host at local_host if it is set,
+    otherwise at incoming_host or default_host. With local_host set, links to
+    incoming_host are pointed at local_host as well.
+    
+    Rewriters are built once per combination of hosts and reused.'''
+    
+    key = (remote_host, local_host, incoming_host, default_host)
+    host_rewriter = _rewriters.get(key)
+    if host_rewriter is None:
+        replacements = [(remote_host, local_host or incoming_host or default_host)]
+        if local_host:
+            replacements.append((incoming_host, local_host))
+        host_rewriter = HostRewriter(replacements)
+        _rewriters.set(key, host_rewriter, 1)
+    return host_rewriter
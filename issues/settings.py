@@ -0,0 +1,145 @@
+'''Snapshot of the configuration read while serving requests.
+
+Settings are read from cherrypy.config once, together with values derived
+from them such as the host map used for rewriting redirects, and shared
+by all threads. Proxies take the current settings when they start
+handling a request.
+
+Settings are rebuilt from the configuration files on hangup, and when
+the files change if local.config.check_interval is set (5 seconds by
+default, 0 disables). Settings not listed here are only read at startup,
+e.g. those of the server, the connection pool, the cache directory, layout, index,
+memory cache and key rules. Keys removed from the files keep their
+values until restart.
+
+Compiled host rewriters are keyed by hosts, see rewriter.get_host_rewriter,
+and follow changes of local.host.
+'''
+
+import os.path, re, threading
+import cherrypy
+
+import environment
+
+# jira puts a build number and a plugin version into resource urls,
+# e.g. /s/en_USabc123/6346/1/1.0/_/download/batch/...
+DEFAULT_VERSIONED_RE = r'/s/.+/_/'
+DEFAULT_GZIP_TYPES = ('text/css', 'text/javascript', 'application/javascript', 'application/x-javascript',
+    'application/json', 'text/xml', 'application/xml', 'text/plain', 'image/svg+xml')
+
+class Settings:
+    def __init__(self, config, previous=None):
+        self.remote_host = config['remote.host']
+        self.local_host = config.get('local.host')
+        # redirects to the remote host are made relative
+        self.reverse_host_map = {self.remote_host: ''}
+        self.remote_gzip = config.get('remote.gzip.enabled', False)
+        self.user_agent = config.get('remote.user_agent')
+        self.pool_retries = config.get('remote.pool.retries', 1)
+        self.debug_http_requests = config.get('debug.http_requests', False)
+        
+        self.stream = config.get('local.stream.enabled', False)
+        self.stream_chunk_size = config.get('local.stream.chunk_size', 65536)
+        
+        if previous is not None:
+            # the cache was laid out in this directory on startup
+            self.cache_dir = previous.cache_dir
+        else:
+            self.cache_dir = config.get('local.cache.dir')
+        self.stale_grace = config.get('local.cache.stale_grace', 0)
+        self.stale_if_error = config.get('local.cache.stale_if_error', 0)
+        self.status_ttls = dict(config.get('local.cache.status_ttls', {}))
+        self.memory_check_interval = config.get('local.cache.memory.check_interval', 5)
+        self.single_flight_timeout = config.get('local.cache.single_flight.timeout', 30)
+        self.single_flight_shared = config.get('local.cache.single_flight.shared', False)
+        self.gzip = bool(config.get('local.cache.gzip.enabled', False))
+        self.gzip_keep_raw = config.get('local.cache.gzip.keep_raw', True)
+        self.x_accel_redirect = config.get('local.cache.x_accel_redirect.enabled', False)
+        self.x_accel_redirect_prefix = config.get('local.cache.x_accel_redirect.prefix')
+        self.static = config.get('local.cache.static.enabled', False)
+        self.static_versioned_re = re.compile(config.get('local.cache.static.versioned_re', DEFAULT_VERSIONED_RE))
+        self.static_max_age = config.get('local.cache.static.max_age', 365*86400)
+        self.static_gzip_types = frozenset(config.get('local.cache.static.gzip_types', DEFAULT_GZIP_TYPES))
+        if self.cache_dir is not None:
+            self.locks_dir = os.path.join(self.cache_dir, '.locks')
+        else:
+            self.locks_dir = None
+        
+        self.metrics = config.get('local.metrics.enabled', False)
+        # metrics tell about the remote host and the cache; by default only
+        # those on this machine, talking to the proxy directly, may read them
+        self.metrics_allow = frozenset(config.get('local.metrics.allow', ('127.0.0.1', '::1')))
+        self.timing_headers = config.get('local.metrics.timing_headers', False)
+
+_current = None
+_lock = threading.Lock()
+
+def get():
+    '''Returns current settings'''
+    
+    global _current
+    
+    current = _current
+    if current is None:
+        _lock.acquire()
+        try:
+            # another thread may have built settings while we were waiting for the lock
+            if _current is None:
+                _current = Settings(cherrypy.config)
+            current = _current
+        finally:
+            _lock.release()
+    return current
+
+def reload():
+    '''Rereads configuration files and replaces current settings.
+    
+    Returns False, keeping current settings, if configuration could not be read.'''
+    
+    global _current
+    
+    _lock.acquire()
+    try:
+        try:
+            environment.reload_config()
+            _current = Settings(cherrypy.config, _current)
+        except Exception:
+            cherrypy.log('Error reloading configuration, keeping previous settings', traceback=True)
+            return False
+    finally:
+        _lock.release()
+    cherrypy.log('Reloaded configuration')
+    return True
+
+def _config_mtimes():
+    mtimes = {}
+    for path in environment.config_paths():
+        try:
+            mtimes[path] = os.stat(path).st_mtime
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+def subscribe(bus):
+    '''Reloads settings on hangup rather than restarting the process,
+    and when configuration files change'''
+    
+    handler = getattr(bus, 'signal_handler', None)
+    if handler is not None:
+        # replaces restarting the engine. takes effect unless the handler
+        # was subscribed already, as in prefork workers whose master re-executes on hangup
+        handler.handlers['SIGHUP'] = reload
+    
+    interval = cherrypy.config.get('local.config.check_interval', 5)
+    if interval:
+        from cherrypy.process import plugins
+        
+        mtimes = [_config_mtimes()]
+        
+        def check():
+            current = _config_mtimes()
+            if current != mtimes[0]:
+                mtimes[0] = current
+                reload()
+        
+        plugins.Monitor(bus, check, frequency=interval, name='ConfigMonitor').subscribe()
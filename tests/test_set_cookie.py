@@ -0,0 +1,157 @@
+'''Set-Cookie headers passed on by tools.set_cookie, compared with those
+the proxy sent when it went through cookielib.CookieJar and Cookie.SimpleCookie.
+
+Differences which are intended, see tools/set_cookie.py, are tested for separately.
+'''
+
+import unittest, time, calendar, re, cookielib, urllib2, mimetools, Cookie, cStringIO
+
+from tools import set_cookie
+
+remote_host = 'tracker.phpbb.com'
+
+class CapturedResponse:
+    def __init__(self, values):
+        self._info = mimetools.Message(cStringIO.StringIO(''.join(['Set-Cookie: %s\r\n' % value for value in values]) + '\r\n'))
+    
+    def info(self):
+        return self._info
+
+def former_headers(path, values, host=remote_host):
+    # cookie handling of BaseProxy before tools.set_cookie
+    jar = cookielib.CookieJar()
+    jar.extract_cookies(CapturedResponse(values), urllib2.Request('http://' + host + path))
+    cookies = Cookie.SimpleCookie()
+    now = int(time.time())
+    for cookie in jar:
+        cookies[cookie.name] = cookie.value
+        morsel = cookies[cookie.name]
+        if cookie.secure:
+            morsel['secure'] = cookie.secure
+        if cookie.path:
+            morsel['path'] = cookie.path
+        if cookie.expires:
+            morsel['expires'] = cookie.expires - now
+        if cookie.get_nonstandard_attr('httponly', False) != False:
+            morsel['httponly'] = cookie.get_nonstandard_attr('httponly')
+    output = cookies.output()
+    if not output:
+        return []
+    return output.split('\r\n')
+
+def current_headers(path, values, host=remote_host):
+    cookies = []
+    for value in CapturedResponse(values).info().getheaders('set-cookie'):
+        cookie = set_cookie.parse(value, host, path)
+        if cookie is not None:
+            cookies.append(cookie)
+    if not cookies:
+        return []
+    return set_cookie.SetCookieHeaders(cookies).output().split('\r\n')
+
+expires_re = re.compile(r'; expires=([^;]*)')
+
+def split_expires(header):
+    # returns header without its expiration date, and the date
+    match = expires_re.search(header)
+    if match is None:
+        return header, None
+    return header[:match.start()] + header[match.end():], calendar.timegm(time.strptime(match.group(1), '%a, %d %b %Y %H:%M:%S GMT'))
+
+def by_name(headers):
+    # httponly given in other case than lower was dropped by cookielib,
+    # see IntendedDifferenceTest.test_httponly_in_any_case
+    cookies = {}
+    for header in headers:
+        cookies[header[len('Set-Cookie: '):].split('=', 1)[0]] = split_expires(header.replace('; httponly', ''))
+    return cookies
+
+class EquivalenceTest(unittest.TestCase):
+    def assert_equivalent(self, path, values, host=remote_host):
+        former = by_name(former_headers(path, values, host))
+        current = by_name(current_headers(path, values, host))
+        self.assertEqual(sorted(former.keys()), sorted(current.keys()))
+        for name in former.keys():
+            former_header, former_expires = former[name]
+            current_header, current_expires = current[name]
+            self.assertEqual(former_header, current_header)
+            if former_expires is None or current_expires is None:
+                self.assertEqual(former_expires, current_expires)
+            else:
+                # expiration dates of the former propagation may be a second late
+                self.assertTrue(abs(former_expires - current_expires) <= 1, (former_expires, current_expires))
+    
+    def test_attributes(self):
+        self.assert_equivalent('/browse/PHPBB3-1', ['JSESSIONID=0123456789ABCDEF; Path=/; HttpOnly'])
+        self.assert_equivalent('/browse/PHPBB3-1', ['remember=YWJjZGVm; Path=/secure; secure; HttpOnly'])
+        self.assert_equivalent('/browse/PHPBB3-1', ['lang=en_US; PATH=/browse; SECURE'])
+        self.assert_equivalent('/browse/PHPBB3-1', ['token=B4RT-U2VR|0123|lin; Path=/; Comment=ignored; Version=1'])
+    
+    def test_expires_formats(self):
+        for expires in ('Sun, 18 Oct 2037 10:00:00 GMT', 'Sunday, 18-Oct-37 10:00:00 GMT',
+                'Sun, 18-Oct-2037 10:00:00 GMT', '18 Oct 2037 10:00:00 GMT', 'Sun, 18 Oct 2037 12:00:00 +0200',
+                'not a date'):
+            self.assert_equivalent('/login.jsp', ['seraph.rememberme.cookie=12345%%3Aabc; Expires=%s; Path=/' % expires])
+    
+    def test_max_age(self):
+        self.assert_equivalent('/secure/Dashboard.jspa', ['remember=1; Max-Age=3600; Path=/'])
+        # max-age takes precedence over expires
+        self.assert_equivalent('/secure/Dashboard.jspa', ['remember=1; Expires=Sun, 18 Oct 2037 10:00:00 GMT; Max-Age=3600; Path=/'])
+    
+    def test_multiple_headers(self):
+        self.assert_equivalent('/login.jsp', [
+            'JSESSIONID=FEDCBA9876543210; Path=/; HttpOnly',
+            'seraph.rememberme.cookie=12345%3A0123456789abcdef; Expires=Sun, 18 Oct 2037 10:00:00 GMT; Path=/; HttpOnly',
+            'atlassian.xsrf.token=B4RT-U2VR-5EA2-N9TH|0123456789abcdef|lin; Path=/',
+        ])
+    
+    def test_default_path(self):
+        self.assert_equivalent('/browse/PHPBB3-1', ['lang=en_US'])
+        self.assert_equivalent('/secure/admin/ViewApplicationProperties.jspa', ['lang=en_US'])
+        self.assert_equivalent('/login.jsp', ['lang=en_US'])
+        self.assert_equivalent('/', ['lang=en_US'])
+    
+    def test_domain(self):
+        self.assert_equivalent('/browse/PHPBB3-2', ['session=abc; Domain=.phpbb.com; Path=/'])
+        self.assert_equivalent('/browse/PHPBB3-2', ['session=abc; Domain=tracker.phpbb.com; Path=/'])
+        self.assert_equivalent('/browse/PHPBB3-2', ['tracking=1; Domain=.example.com; Path=/'])
+        # host of the request may carry a port
+        self.assert_equivalent('/browse/PHPBB3-2', ['session=abc; Domain=.phpbb.com; Path=/'], 'tracker.phpbb.com:8080')
+
+class IntendedDifferenceTest(unittest.TestCase):
+    def parse(self, value, path='/browse/PHPBB3-1', now=None):
+        return set_cookie.parse(value, remote_host, path, now)
+    
+    def test_value_not_quoted(self):
+        cookie = self.parse('jira.conglomerate.cookie="|jira.toggleblocks.cong.cookie=plugin"; Path=/')
+        self.assertEqual(cookie.output(), 'jira.conglomerate.cookie="|jira.toggleblocks.cong.cookie=plugin"; Path=/')
+    
+    def test_httponly_in_any_case(self):
+        for value in ('a=b; httponly; Path=/', 'a=b; HttpOnly; Path=/', 'a=b; HTTPONLY; Path=/'):
+            self.assertEqual(self.parse(value).output(), 'a=b; httponly; Path=/')
+    
+    def test_deletion_passed_on(self):
+        cookie = self.parse('seraph.rememberme.cookie=""; Expires=Thu, 01 Jan 1970 00:00:00 GMT; Path=/')
+        self.assertEqual(cookie.output(), 'seraph.rememberme.cookie=""; expires=Thu, 01 Jan 1970 00:00:00 GMT; Path=/')
+        cookie = self.parse('a=b; Max-Age=0; Path=/', now=1000000000)
+        self.assertEqual(cookie.output(), 'a=b; expires=Sun, 09 Sep 2001 01:46:40 GMT; Path=/')
+    
+    def test_asctime_expires(self):
+        # cookielib took such cookies for session cookies
+        cookie = self.parse('a=b; Expires=Sun Oct 18 10:00:00 2037; Path=/')
+        self.assertEqual(cookie.output(), 'a=b; expires=Sun, 18 Oct 2037 10:00:00 GMT; Path=/')
+    
+    def test_dropped(self):
+        # without a value, malformed
+        self.assertEqual(self.parse('flag'), None)
+        self.assertEqual(self.parse('=b; Path=/'), None)
+        self.assertEqual(self.parse('badage=1; Max-Age=soon'), None)
+    
+    def test_output(self):
+        cookie = self.parse('remember=1; Max-Age=3600; Path=/; secure; httponly', now=1000000000)
+        self.assertEqual(cookie.output(), 'remember=1; expires=Sun, 09 Sep 2001 02:46:40 GMT; httponly; Path=/; secure')
+        headers = set_cookie.SetCookieHeaders([self.parse('a=b; Path=/'), self.parse('c=d')])
+        self.assertEqual(headers.output(), 'Set-Cookie: a=b; Path=/\r\nSet-Cookie: c=d; Path=/browse')
+
+if __name__ == '__main__':
+    unittest.main()
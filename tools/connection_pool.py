@@ -0,0 +1,270 @@
+'''Pool of keep-alive http connections shared by threads, and an urllib2
+handler issuing requests over it.
+
+Connections are created lazily up to max_connections across all hosts;
+callers wanting a connection beyond that wait for one to be released.
+Idle connections are closed once they have been idle for longer than
+the idle timeout of their host.
+'''
+
+import httplib, urllib2, socket, threading, time
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+class PoolTimeout(urllib2.URLError):
+    '''Raised when no connection became available within wait timeout'''
+
+class HTTPConnection(httplib.HTTPConnection):
+    '''Connection applying connect timeout while connecting and
+    read timeout afterwards'''
+    
+    def __init__(self, host, connect_timeout=None, read_timeout=None):
+        httplib.HTTPConnection.__init__(self, host, timeout=connect_timeout)
+        self.read_timeout = read_timeout
+        # httplib splits port off host
+        self.pool_host = host
+        self.idle_since = None
+        # seconds taken by connecting for the current request, None if already connected
+        self.connect_time = None
+    
+    def connect(self):
+        started = time.time()
+        httplib.HTTPConnection.connect(self)
+        self.sock.settimeout(self.read_timeout)
+        self.connect_time = time.time() - started
+
+class ConnectionPool:
+    def __init__(self, max_connections=16, idle_timeout=60, idle_timeouts=None,
+        connect_timeout=None, read_timeout=None, wait_timeout=None):
+        
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        # host -> idle timeout, for hosts which should not use the default
+        self.idle_timeouts = idle_timeouts or {}
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.wait_timeout = wait_timeout
+        
+        self._condition = threading.Condition()
+        # host -> list of idle connections, most recently released last
+        self._idle = {}
+        self._idle_count = 0
+        self._in_use = 0
+        
+        self.created = self.waits = self.wait_timeouts = self.reconnects = self.expired = 0
+    
+    def acquire(self, host):
+        '''Returns (connection, reused) for host, reused being True
+        if connection has been used for earlier requests'''
+        
+        self._condition.acquire()
+        try:
+            deadline = None
+            while True:
+                now = time.time()
+                self._expire_idle(now)
+                connection = self._take_idle(host)
+                if connection is not None:
+                    self._in_use += 1
+                    return connection, True
+                
+                if self._in_use + self._idle_count >= self.max_connections:
+                    # make room by dropping a connection idling to another host
+                    self._close_oldest_idle()
+                if self._in_use + self._idle_count < self.max_connections:
+                    self._in_use += 1
+                    self.created += 1
+                    break
+                
+                if deadline is None:
+                    self.waits += 1
+                    if self.wait_timeout is not None:
+                        deadline = now + self.wait_timeout
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    if now >= deadline:
+                        self.wait_timeouts += 1
+                        raise PoolTimeout('no connection to %s available within %s seconds' % (host, self.wait_timeout))
+                    self._condition.wait(deadline - now)
+        finally:
+            self._condition.release()
+        
+        # connecting happens when the first request is sent
+        return HTTPConnection(host, self.connect_timeout, self.read_timeout), False
+    
+    def release(self, connection, reusable=True):
+        '''Returns connection to the pool; connections which are not
+        reusable, e.g. because of errors, are closed'''
+        
+        self._condition.acquire()
+        try:
+            self._in_use -= 1
+            if reusable:
+                connection.idle_since = time.time()
+                self._idle.setdefault(connection.pool_host, []).append(connection)
+                self._idle_count += 1
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        if not reusable:
+            connection.close()
+    
+    def record_reconnect(self):
+        self._condition.acquire()
+        try:
+            self.reconnects += 1
+        finally:
+            self._condition.release()
+    
+    def stats(self):
+        '''Returns a dict of pool counters'''
+        
+        self._condition.acquire()
+        try:
+            return dict(in_use=self._in_use, idle=self._idle_count, created=self.created,
+                waits=self.waits, wait_timeouts=self.wait_timeouts,
+                reconnects=self.reconnects, expired=self.expired)
+        finally:
+            self._condition.release()
+    
+    def close_idle(self):
+        '''Closes all idle connections'''
+        
+        self._condition.acquire()
+        try:
+            idle, self._idle, self._idle_count = self._idle, {}, 0
+        finally:
+            self._condition.release()
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+    
+    # the following methods must be called with the condition acquired
+    
+    def _take_idle(self, host):
+        connections = self._idle.get(host)
+        if not connections:
+            return None
+        connection = connections.pop()
+        if not connections:
+            del self._idle[host]
+        self._idle_count -= 1
+        return connection
+    
+    def _expire_idle(self, now):
+        for host, connections in self._idle.items():
+            timeout = self.idle_timeouts.get(host, self.idle_timeout)
+            if timeout is None:
+                continue
+            fresh = [connection for connection in connections if now - connection.idle_since < timeout]
+            if len(fresh) < len(connections):
+                for connection in connections:
+                    if now - connection.idle_since >= timeout:
+                        connection.close()
+                self.expired += len(connections) - len(fresh)
+                self._idle_count -= len(connections) - len(fresh)
+                if fresh:
+                    self._idle[host] = fresh
+                else:
+                    del self._idle[host]
+    
+    def _close_oldest_idle(self):
+        oldest = None
+        for host, connections in self._idle.items():
+            if oldest is None or connections[0].idle_since < oldest.idle_since:
+                oldest = connections[0]
+        if oldest is not None:
+            connections = self._idle[oldest.pool_host]
+            del connections[0]
+            if not connections:
+                del self._idle[oldest.pool_host]
+            self._idle_count -= 1
+            oldest.close()
+
+class _PooledResponse:
+    '''Reads a response and returns its connection to the pool
+    once the response has been read completely'''
+    
+    def __init__(self, pool, connection, response):
+        self._pool = pool
+        self._connection = connection
+        self._response = response
+    
+    def recv(self, size=-1):
+        try:
+            if size < 0:
+                data = self._response.read()
+            else:
+                data = self._response.read(size)
+        except:
+            self._release(False)
+            raise
+        if self._response.isclosed():
+            self._release(not self._response.will_close)
+        return data
+    
+    read = recv
+    
+    def close(self):
+        # connection can only be reused if response was read completely
+        self._release(self._response.isclosed() and not self._response.will_close)
+    
+    def _release(self, reusable):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection, reusable)
+
+class PooledHTTPHandler(urllib2.HTTPHandler):
+    '''Issues http requests over connections of pool.
+    
+    Idempotent requests failing on a reused connection, which the server
+    may have closed while it was idle, are retried up to retries times.
+    
+    Responses carry connect_time, seconds taken by connecting or None if
+    connection was reused, and first_byte_time, seconds from sending
+    the request until response headers were received.'''
+    
+    def __init__(self, pool, retries=1):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+        self.retries = retries
+    
+    def http_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict([(key, value) for key, value in req.headers.items() if key not in headers]))
+        headers = dict([(key.title(), value) for key, value in headers.items()])
+        
+        attempts = 0
+        while True:
+            connection, reused = self.pool.acquire(host)
+            connection.connect_time = None
+            started = time.time()
+            try:
+                connection.request(req.get_method(), req.get_selector(), req.data, headers)
+                response = connection.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                self.pool.release(connection, False)
+                if reused and attempts < self.retries and req.get_method() in IDEMPOTENT_METHODS:
+                    attempts += 1
+                    self.pool.record_reconnect()
+                    continue
+                raise urllib2.URLError(e)
+            except:
+                self.pool.release(connection, False)
+                raise
+            break
+        
+        # file object provides readline and friends which urllib2 expects
+        fp = socket._fileobject(_PooledResponse(self.pool, connection, response), close=True)
+        result = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        result.code = response.status
+        result.msg = response.reason
+        # for timing stages of requests
+        result.connect_time = connection.connect_time
+        result.first_byte_time = time.time() - started - (connection.connect_time or 0)
+        return result
@@ -0,0 +1,308 @@
+'''Building blocks for asyncore-based servers: waking up the event loop
+from other threads, running blocking functions in worker threads
+and issuing http requests without blocking.
+
+Everything here except Trigger.call and TaskPool.submit must be used
+from the thread running the event loop.
+'''
+
+import asyncore, asynchat, socket, threading, Queue, os, sys, time, httplib, cStringIO
+
+class Trigger(asyncore.dispatcher):
+    '''Runs callables in the event loop thread on behalf of other threads'''
+    
+    def __init__(self, map):
+        reader, self._writer = socket.socketpair()
+        asyncore.dispatcher.__init__(self, reader, map)
+        self._writer.setblocking(0)
+        self._lock = threading.Lock()
+        self._calls = []
+    
+    def call(self, function, *args):
+        '''Arranges for function to be called with args in the event loop thread'''
+        
+        self._lock.acquire()
+        try:
+            self._calls.append((function, args))
+        finally:
+            self._lock.release()
+        try:
+            self._writer.send('x')
+        except socket.error:
+            # socket buffer is full, so the loop is going to wake up anyway
+            pass
+    
+    def writable(self):
+        return False
+    
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        self._lock.acquire()
+        try:
+            calls, self._calls = self._calls, []
+        finally:
+            self._lock.release()
+        for function, args in calls:
+            try:
+                function(*args)
+            except:
+                self.handle_error()
+    
+    def handle_error(self):
+        # unlike asyncore, keep going
+        nil, t, v, tbinfo = asyncore.compact_traceback()
+        self.log_info('uncaptured python exception (%s:%s %s)' % (t, v, tbinfo), 'error')
+    
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self._writer.close()
+
+class TaskPool:
+    '''Runs blocking functions in worker threads, passing their outcome
+    to callbacks in the event loop thread'''
+    
+    def __init__(self, trigger, size):
+        self._trigger = trigger
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def submit(self, function, args, callback):
+        '''Calls function with args in a worker thread, then callback
+        with (result, exc_info) in the event loop thread; exc_info is None
+        unless function raised an exception'''
+        
+        self._queue.put((function, args, callback))
+    
+    def stop(self):
+        for thread in self._threads:
+            self._queue.put(None)
+    
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            function, args, callback = task
+            try:
+                result, exc_info = function(*args), None
+            except:
+                result, exc_info = None, sys.exc_info()
+            self._trigger.call(callback, result, exc_info)
+            # do not keep references to the last task's objects around
+            del task, function, args, callback, result, exc_info
+
+class Resolver:
+    '''Resolves host names in worker threads, remembering results for ttl seconds'''
+    
+    def __init__(self, tasks, ttl=60):
+        self._tasks = tasks
+        self.ttl = ttl
+        # (host, port) -> (expires_at, (family, address))
+        self._cache = {}
+    
+    def resolve(self, host, port, callback):
+        '''Calls callback with ((family, address), exc_info)'''
+        
+        key = (host, port)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > time.time():
+            callback(cached[1], None)
+            return
+        
+        def resolved(result, exc_info):
+            if exc_info is None:
+                self._cache[key] = (time.time() + self.ttl, result)
+            callback(result, exc_info)
+        
+        self._tasks.submit(self._lookup, (host, port), resolved)
+    
+    def _lookup(self, host, port):
+        family, type, proto, canonname, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        return family, address
+
+class FetchedResponse:
+    '''Completely received http response, looking like urllib2 responses'''
+    
+    def __init__(self, url, code, msg, headers, body):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self._body = body
+    
+    def info(self):
+        return self.headers
+    
+    def geturl(self):
+        return self.url
+    
+    def read(self, size=-1):
+        if size < 0:
+            data, self._body = self._body, ''
+        else:
+            data, self._body = self._body[:size], self._body[size:]
+        return data
+    
+    def close(self):
+        self._body = ''
+
+def format_request(request):
+    '''Returns urllib2 request as it is sent over the wire, asking the server
+    to close the connection afterwards'''
+    
+    headers = dict(request.unredirected_hdrs)
+    headers.update(dict([(key, value) for key, value in request.headers.items() if key not in headers]))
+    headers = dict([(key.title(), value) for key, value in headers.items()])
+    headers['Connection'] = 'close'
+    if not headers.has_key('Accept-Encoding'):
+        headers['Accept-Encoding'] = 'identity'
+    lines = ['%s %s HTTP/1.1' % (request.get_method(), request.get_selector())]
+    lines.extend(['%s: %s' % item for item in headers.items()])
+    return '\r\n'.join(lines) + '\r\n\r\n' + (request.get_data() or '')
+
+class HttpFetch(asynchat.async_chat):
+    '''Sends a formatted request to address and reads the response.
+    
+    callback is called exactly once, with (FetchedResponse, None) or
+    with (None, exc_info). check_timeout must be called periodically
+    for timeouts to be enforced.'''
+    
+    def __init__(self, map, family, address, url, method, data, callback, connect_timeout=None, read_timeout=None):
+        asynchat.async_chat.__init__(self, map=map)
+        self._url = url
+        self._method = method
+        self._callback = callback
+        self._read_timeout = read_timeout
+        self._touch(connect_timeout)
+        
+        self._state = 'head'
+        self._buffer = []
+        self._body = []
+        self.set_terminator('\r\n\r\n')
+        
+        self.create_socket(family, socket.SOCK_STREAM)
+        self.push(data)
+        try:
+            self.connect(address)
+        except:
+            self.close()
+            raise
+    
+    def check_timeout(self, now):
+        if self._deadline is not None and now > self._deadline:
+            try:
+                raise socket.timeout('timed out talking to %s' % self._url)
+            except socket.timeout:
+                self._fail(sys.exc_info())
+    
+    def handle_connect(self):
+        self._touch(self._read_timeout)
+    
+    def collect_incoming_data(self, data):
+        self._touch(self._read_timeout)
+        if self._state in ('body', 'chunk', 'until_close'):
+            self._body.append(data)
+        else:
+            self._buffer.append(data)
+    
+    def found_terminator(self):
+        line, self._buffer = ''.join(self._buffer), []
+        if self._state == 'head':
+            self._parse_head(line)
+        elif self._state == 'body':
+            self._finish()
+        elif self._state == 'chunk_size':
+            size = int(line.split(';', 1)[0].strip(), 16)
+            if size:
+                self._state = 'chunk'
+                self.set_terminator(size)
+            else:
+                self._state = 'trailer'
+        elif self._state == 'chunk':
+            self._state = 'chunk_end'
+            self.set_terminator('\r\n')
+        elif self._state == 'chunk_end':
+            self._state = 'chunk_size'
+        elif self._state == 'trailer':
+            if not line:
+                self._finish()
+    
+    def handle_close(self):
+        if self._state == 'until_close':
+            self._finish()
+        elif not self.connected:
+            error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            try:
+                raise socket.error(error, os.strerror(error))
+            except socket.error:
+                self._fail(sys.exc_info())
+        else:
+            try:
+                raise httplib.IncompleteRead(''.join(self._body))
+            except httplib.IncompleteRead:
+                self._fail(sys.exc_info())
+    
+    def handle_error(self):
+        self._fail(sys.exc_info())
+    
+    def _parse_head(self, head):
+        status_line, rest = (head + '\r\n').split('\r\n', 1)
+        try:
+            version, status = status_line.split(None, 1)
+            code = int(status.split(None, 1)[0])
+        except ValueError:
+            raise httplib.BadStatusLine(status_line)
+        if 100 <= code < 200:
+            # informational response; the real one follows
+            return
+        parts = status.split(None, 1)
+        if len(parts) > 1:
+            msg = parts[1]
+        else:
+            msg = ''
+        self._response = (code, msg, httplib.HTTPMessage(cStringIO.StringIO(rest + '\r\n')))
+        
+        headers = self._response[2]
+        if self._method == 'HEAD' or code in (204, 304):
+            self._finish()
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            self._state = 'chunk_size'
+            self.set_terminator('\r\n')
+        elif headers.has_key('content-length'):
+            length = int(headers['content-length'])
+            if length:
+                self._state = 'body'
+                self.set_terminator(length)
+            else:
+                self._finish()
+        else:
+            self._state = 'until_close'
+            self.set_terminator(None)
+    
+    def _touch(self, timeout):
+        if timeout is None:
+            self._deadline = None
+        else:
+            self._deadline = time.time() + timeout
+    
+    def _finish(self):
+        self._state = 'done'
+        code, msg, headers = self._response
+        self._complete(FetchedResponse(self._url, code, msg, headers, ''.join(self._body)), None)
+    
+    def _fail(self, exc_info):
+        self._complete(None, exc_info)
+    
+    def _complete(self, response, exc_info):
+        self.close()
+        callback, self._callback = self._callback, None
+        if callback is not None:
+            callback(response, exc_info)
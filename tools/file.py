@@ -59,6 +59,20 @@ def safe_unlink(path):
         # ignore to propagate original exception
         pass
 
+def safe_symlink(target, path):
+    '''Creates a symlink to target at path, atomically replacing
+    whatever path was'''
+    
+    import thread
+    
+    tmp_path = '%s.tmp.%d.%d' % (path, os.getpid(), thread.get_ident())
+    os.symlink(target, tmp_path)
+    try:
+        os.rename(tmp_path, path)
+    except:
+        safe_unlink(tmp_path)
+        raise
+
 def safe_mkdirs(path):
     '''Creates directories up to and including path,
     accounting for the possibility that another thread or process may be
@@ -131,3 +145,74 @@ def get_umask():
         _umask_lock.release()
     
     return _last_umask
+
+def read_chunks(f, chunk_size):
+    '''Iterates over contents of file object f in chunks of at most chunk_size bytes'''
+    
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+class SafeWriter:
+    '''Incrementally writes content to a temporary file in path's directory.
+    
+    commit atomically renames temporary file to path;
+    abort discards the temporary file.
+    '''
+    
+    def __init__(self, path):
+        import tempfile
+        
+        self.path = path
+        fd, self.tmp_path = tempfile.mkstemp(prefix=path+'.tmp.')
+        try:
+            # calling close() on file object opened with os.fdopen closes the file descriptor
+            self.file = os.fdopen(fd, 'w')
+        except:
+            os.close(fd)
+            safe_unlink(self.tmp_path)
+            raise
+    
+    def write(self, content):
+        self.file.write(content)
+    
+    def commit(self):
+        try:
+            # mkstemp creates files with 600 permissions
+            os.fchmod(self.file.fileno(), 0666 & ~get_umask())
+            self.file.close()
+        except:
+            self.abort()
+            raise
+        os.rename(self.tmp_path, self.path)
+    
+    def abort(self):
+        try:
+            self.file.close()
+        finally:
+            safe_unlink(self.tmp_path)
+
+class SafeGzipWriter(SafeWriter):
+    '''Incrementally writes content compressed with gzip to a temporary file
+    in path's directory; see SafeWriter'''
+    
+    def __init__(self, path):
+        import gzip
+        
+        SafeWriter.__init__(self, path)
+        # gzip.open defaults to compresslevel 9, but specify it explicitly in case default changes
+        self.gzip = gzip.GzipFile(fileobj=self.file, mode='w', compresslevel=9)
+    
+    def write(self, content):
+        self.gzip.write(content)
+    
+    def commit(self):
+        try:
+            # closing GzipFile writes the trailer but leaves underlying file open
+            self.gzip.close()
+        except:
+            self.abort()
+            raise
+        SafeWriter.commit(self)
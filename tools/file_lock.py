@@ -0,0 +1,43 @@
+import os, fcntl, errno, time
+
+class FileLock:
+    '''Exclusive advisory lock on a file, shared between processes.
+    
+    Lock files are never removed, since removing a lock file while
+    somebody waits on it would let two processes hold the lock.
+    '''
+    
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+    
+    def acquire(self, timeout=None, interval=0.05):
+        '''Acquires the lock, waiting up to timeout seconds for it,
+        or not at all if timeout is None.
+        
+        Returns True if the lock was acquired.'''
+        
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self._fd, fd = fd, None
+                    return True
+                except IOError, e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if timeout is None or time.time() >= deadline:
+                    return False
+                time.sleep(interval)
+        finally:
+            if fd is not None:
+                os.close(fd)
+    
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            # closing the descriptor releases the lock
+            os.close(fd)
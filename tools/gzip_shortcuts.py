@@ -0,0 +1,43 @@
+import zlib
+
+# window bits telling zlib to expect a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def accepts_gzip(accept_encoding):
+    '''Returns True if Accept-Encoding header value allows gzip-encoded responses'''
+    
+    if not accept_encoding:
+        return False
+    for part in accept_encoding.split(','):
+        params = part.split(';')
+        coding = params[0].strip().lower()
+        if coding not in ('gzip', 'x-gzip', '*'):
+            continue
+        for param in params[1:]:
+            name, sep, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    if float(value) == 0:
+                        break
+                except ValueError:
+                    break
+        else:
+            return True
+    return False
+
+def gunzip(data):
+    '''Decompresses gzip-encoded data'''
+    
+    return zlib.decompress(data, GZIP_WBITS)
+
+def gunzip_chunks(chunks):
+    '''Decompresses gzip-encoded data arriving in chunks, yielding decompressed chunks'''
+    
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
@@ -0,0 +1,115 @@
+'''Parsing of Cache-Control headers and http dates.
+
+Responses of the remote host carry few distinct dates, e.g. Expires in
+the past or Last-Modified of static resources, so parsed dates are remembered.
+'''
+
+import calendar, email.utils
+
+MONTHS = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12}
+
+# number of parsed dates remembered
+MAX_PARSED_DATES = 1024
+
+_parsed_dates = {}
+
+def parse_http_date(value):
+    '''Returns seconds since epoch of an http date, None if value is not a date'''
+    
+    try:
+        return _parsed_dates[value]
+    except KeyError:
+        pass
+    timestamp = _parse_http_date(value)
+    if len(_parsed_dates) >= MAX_PARSED_DATES:
+        # dates seen move on with time; starting over is simpler than tracking use.
+        # threads racing here at worst parse a date again
+        _parsed_dates.clear()
+    _parsed_dates[value] = timestamp
+    return timestamp
+
+def _parse_http_date(value):
+    # Sun, 06 Nov 1994 08:49:37 GMT, which servers are required to send
+    parts = value.split()
+    if len(parts) == 6 and parts[5] == 'GMT':
+        try:
+            hour, minute, second = [int(part) for part in parts[4].split(':')]
+            return calendar.timegm((int(parts[3]), MONTHS[parts[2].lower()], int(parts[1]), hour, minute, second, 0, 0, 0))
+        except (ValueError, KeyError):
+            pass
+    # obsolete formats and other time zones
+    try:
+        parsed = email.utils.parsedate_tz(value)
+    except (ValueError, IndexError, TypeError):
+        return None
+    if parsed is None:
+        return None
+    # dates without a time zone, as in asctime format, are in gmt
+    return calendar.timegm(parsed[:6] + (0, 0, 0)) - (parsed[9] or 0)
+
+class CacheControl:
+    '''Directives of a Cache-Control header value, in the order they were given.
+    
+    Directive names are kept in lower case; directives without
+    an argument have None as their value.'''
+    
+    def __init__(self, value=None):
+        self.directives = []
+        if value:
+            for part in value.split(','):
+                name, sep, argument = part.partition('=')
+                name = name.strip().lower()
+                if not name:
+                    continue
+                if sep:
+                    argument = argument.strip()
+                else:
+                    argument = None
+                self.directives.append((name, argument))
+    
+    def __str__(self):
+        parts = []
+        for name, argument in self.directives:
+            if argument is None:
+                parts.append(name)
+            else:
+                parts.append(name + '=' + argument)
+        return ', '.join(parts)
+    
+    def has(self, name):
+        for directive in self.directives:
+            if directive[0] == name:
+                return True
+        return False
+    
+    def get(self, name, default=None):
+        for directive_name, argument in self.directives:
+            if directive_name == name:
+                return argument
+        return default
+    
+    def add(self, name, argument=None):
+        '''Adds directive unless it is present already'''
+        
+        if not self.has(name):
+            self.directives.append((name, argument))
+    
+    def remove(self, *names):
+        '''Removes directives, returning True if any were present'''
+        
+        directives = [directive for directive in self.directives if directive[0] not in names]
+        removed = len(directives) != len(self.directives)
+        self.directives = directives
+        return removed
+    
+    def max_age(self):
+        '''Returns max-age in seconds, None if not given or malformed'''
+        
+        argument = self.get('max-age')
+        if argument is None:
+            return None
+        try:
+            return int(argument.strip('"'))
+        except ValueError:
+            return None
@@ -0,0 +1,209 @@
+'''Protection of a remote host that is failing or overloaded.
+
+A circuit breaker stops calls to the remote host after consecutive failures,
+then lets single trial calls through once in a while until one succeeds.
+An adaptive limit bounds the number of concurrent calls: it shrinks
+multiplicatively on failures and slow calls and grows by about one
+for each limit's worth of calls completing in time. Callers beyond
+the limit wait in a bounded queue for a short time, and are rejected
+when the queue is full or the time is up.
+'''
+
+import threading, time, urllib2
+
+class Rejected(urllib2.URLError):
+    '''Raised when a call is not made to protect the remote host'''
+    
+    def __init__(self, reason, retry_after=1):
+        urllib2.URLError.__init__(self, reason)
+        # seconds after which the call might succeed
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    # tokens returned by allow
+    CALL = 'call'
+    TRIAL = 'trial'
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self.opened = self.rejected = 0
+    
+    def allow(self):
+        '''Returns a token to pass to record once the call is done,
+        or None if the call may not be made.'''
+        
+        self._lock.acquire()
+        try:
+            if self.state == self.OPEN:
+                if time.time() < self._opened_at + self.reset_timeout:
+                    self.rejected += 1
+                    return None
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                # one trial call at a time
+                if self._trial_running:
+                    self.rejected += 1
+                    return None
+                self._trial_running = True
+                return self.TRIAL
+            return self.CALL
+        finally:
+            self._lock.release()
+    
+    def record(self, token, failed):
+        '''Records outcome of a call allowed with token; failed is None
+        if the call was allowed but not made after all.
+        
+        Once the breaker opened, only the trial call closes or reopens it.'''
+        
+        self._lock.acquire()
+        try:
+            if token == self.TRIAL:
+                self._trial_running = False
+            elif self.state != self.CLOSED:
+                # allowed before the breaker opened
+                return
+            if failed is None:
+                return
+            if not failed:
+                self.state = self.CLOSED
+                self._failures = 0
+                return
+            self._failures += 1
+            if token == self.TRIAL or self._failures >= self.failure_threshold:
+                self.opened += 1
+                self.state = self.OPEN
+                self._opened_at = time.time()
+        finally:
+            self._lock.release()
+    
+    def retry_after(self):
+        '''Returns seconds until the next trial call'''
+        
+        self._lock.acquire()
+        try:
+            if self.state != self.OPEN:
+                return 1
+            return max(1, int(self._opened_at + self.reset_timeout - time.time() + 0.5))
+        finally:
+            self._lock.release()
+
+class AdaptiveLimit:
+    def __init__(self, min_limit=1, max_limit=16, max_queue=8, queue_timeout=1, backoff=0.75):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.backoff = backoff
+        self.limit = float(max_limit)
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        self.queued = 0
+        self._decreased_at = 0
+        self.rejected = 0
+    
+    def acquire(self, wait=True):
+        '''Returns True once a call may be made, False if the call should
+        be rejected. Each successful acquire must be followed by release.'''
+        
+        self._condition.acquire()
+        try:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            if not wait or self.queued >= self.max_queue:
+                self.rejected += 1
+                return False
+            deadline = time.time() + self.queue_timeout
+            self.queued += 1
+            try:
+                while self.in_flight >= int(self.limit):
+                    now = time.time()
+                    if now >= deadline:
+                        self.rejected += 1
+                        return False
+                    self._condition.wait(deadline - now)
+            finally:
+                self.queued -= 1
+            self.in_flight += 1
+            return True
+        finally:
+            self._condition.release()
+    
+    def release(self, failed):
+        '''Records outcome of a call; failed is None if the call
+        was not made after all'''
+        
+        self._condition.acquire()
+        try:
+            self.in_flight -= 1
+            now = time.time()
+            if failed:
+                # calls failing together are one overload; back off once for them
+                if now - self._decreased_at >= 1:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._decreased_at = now
+            elif failed is not None:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+class UpstreamGuard:
+    '''Puts calls to the remote host through a circuit breaker and
+    an adaptive limit, either of which may be None.
+    
+    Calls failing or taking longer than slow_call seconds count as failures.'''
+    
+    def __init__(self, breaker=None, limit=None, slow_call=None):
+        self.breaker = breaker
+        self.limit = limit
+        self.slow_call = slow_call
+    
+    def enter(self, wait=True):
+        '''Returns a token to pass to exit once the call is done.
+        
+        Raises Rejected if the call should not be made. If wait is False,
+        calls beyond the limit are rejected rather than queued.'''
+        
+        if self.limit is not None and not self.limit.acquire(wait):
+            raise Rejected('too many concurrent requests to the remote host')
+        breaker_token = None
+        if self.breaker is not None:
+            breaker_token = self.breaker.allow()
+            if breaker_token is None:
+                if self.limit is not None:
+                    self.limit.release(None)
+                raise Rejected('remote host is failing', self.breaker.retry_after())
+        return time.time(), breaker_token
+    
+    def exit(self, token, failed):
+        started, breaker_token = token
+        if not failed and self.slow_call is not None and time.time() - started > self.slow_call:
+            failed = True
+        if self.limit is not None:
+            self.limit.release(failed)
+        if self.breaker is not None:
+            self.breaker.record(breaker_token, failed)
+    
+    def stats(self):
+        '''Returns a dict of breaker and limit state'''
+        
+        stats = {}
+        if self.breaker is not None:
+            stats.update(breaker_state=self.breaker.state, breaker_opened=self.breaker.opened,
+                breaker_rejected=self.breaker.rejected)
+        if self.limit is not None:
+            stats.update(limit=int(self.limit.limit), in_flight=self.limit.in_flight,
+                queued=self.limit.queued, limit_rejected=self.limit.rejected)
+        return stats
@@ -0,0 +1,102 @@
+import threading, time
+
+class _Node:
+    __slots__ = ('key', 'value', 'size', 'expires_at', 'prev', 'next')
+
+class LruCache:
+    '''Thread-safe least recently used cache bounded by entry count
+    and by total size of stored values.
+    
+    Sizes are supplied by the caller when values are stored, and entries
+    optionally carry an absolute expiration timestamp after which they
+    are no longer returned.
+    '''
+    
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._nodes = {}
+        # circular list with the most recently used node after the sentinel
+        self._head = _Node()
+        self._head.prev = self._head.next = self._head
+    
+    def __len__(self):
+        return len(self._nodes)
+    
+    def get(self, key, now=None):
+        '''Returns value stored under key, or None if key is not present or expired'''
+        
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(key)
+            if node is None:
+                return None
+            if node.expires_at is not None:
+                if now is None:
+                    now = time.time()
+                if node.expires_at < now:
+                    self._remove(node)
+                    return None
+            self._unlink(node)
+            self._link_first(node)
+            return node.value
+        finally:
+            self._lock.release()
+    
+    def set(self, key, value, size, expires_at=None):
+        '''Stores value under key, evicting least recently used entries
+        as necessary to stay within limits.
+        
+        Values larger than the byte limit are not stored.'''
+        
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(key)
+            if node is not None:
+                self._remove(node)
+            if size > self.max_bytes:
+                return
+            node = _Node()
+            node.key, node.value, node.size, node.expires_at = key, value, size, expires_at
+            self._nodes[key] = node
+            self._link_first(node)
+            self.size += size
+            while self.size > self.max_bytes or len(self._nodes) > self.max_entries:
+                self._remove(self._head.prev)
+        finally:
+            self._lock.release()
+    
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(key)
+            if node is not None:
+                self._remove(node)
+        finally:
+            self._lock.release()
+    
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._nodes.clear()
+            self._head.prev = self._head.next = self._head
+            self.size = 0
+        finally:
+            self._lock.release()
+    
+    def _remove(self, node):
+        self._unlink(node)
+        del self._nodes[node.key]
+        self.size -= node.size
+    
+    def _unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+    
+    def _link_first(self, node):
+        node.prev = self._head
+        node.next = self._head.next
+        self._head.next.prev = node
+        self._head.next = node
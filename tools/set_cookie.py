@@ -0,0 +1,113 @@
+'''Set-Cookie headers of remote responses, passed on to clients.
+
+Cookies are parsed from the headers as received and written out again
+with the domain dropped, so that they are set for the host clients talk to,
+and with max-age turned into an expiration date, in the form the proxy
+sent them in when it went through cookielib and Cookie:
+
+    name=value; expires=Sun, 18 Oct 2037 10:00:00 GMT; httponly; Path=/; secure
+
+Unlike cookielib, values are passed on unquoted, httponly is recognized
+in any case, expiration dates in asctime format are recognized and cookies
+expiring in the past, which ask clients to delete them, are passed on. Cookies for other domains, cookies without a value
+and malformed cookies are dropped.
+'''
+
+import time
+
+import http_headers
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = (None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def format_expires(timestamp):
+    '''Returns cookie expiration date of timestamp, in the format of the Cookie module'''
+    
+    year, month, day, hour, minute, second, weekday, yearday, dst = time.gmtime(timestamp)
+    return '%s, %02d %3s %4d %02d:%02d:%02d GMT' % (WEEKDAYS[weekday], day, MONTHS[month], year, hour, minute, second)
+
+class SetCookie:
+    def __init__(self, name, value, path, expires=None, secure=False, httponly=False):
+        self.name = name
+        self.value = value
+        self.path = path
+        # seconds since epoch, None for session cookies
+        self.expires = expires
+        self.secure = secure
+        self.httponly = httponly
+    
+    def output(self):
+        '''Returns Set-Cookie header value for clients'''
+        
+        parts = [self.name + '=' + self.value]
+        if self.expires is not None:
+            parts.append('expires=' + format_expires(self.expires))
+        if self.httponly:
+            parts.append('httponly')
+        parts.append('Path=' + self.path)
+        if self.secure:
+            parts.append('secure')
+        return '; '.join(parts)
+
+def default_path(request_path):
+    # directory of the request path, as browsers and cookielib have it
+    index = request_path.rfind('/')
+    if index > 0:
+        return request_path[:index]
+    return '/'
+
+def domain_matches(host, domain):
+    domain = domain.lstrip('.').lower()
+    return host == domain or host.endswith('.' + domain)
+
+def parse(value, request_host, request_path, now=None):
+    '''Returns SetCookie of a Set-Cookie header value received for a request
+    to request_host and request_path, None if the cookie is not passed on'''
+    
+    parts = value.split(';')
+    name, sep, cookie_value = parts[0].partition('=')
+    name = name.strip()
+    if not sep or not name:
+        return None
+    cookie = SetCookie(name, cookie_value.strip(), None)
+    max_age = None
+    for part in parts[1:]:
+        attribute, sep, argument = part.partition('=')
+        attribute = attribute.strip().lower()
+        argument = argument.strip()
+        if attribute == 'path':
+            if argument:
+                cookie.path = argument
+        elif attribute == 'domain':
+            if argument and not domain_matches(request_host.split(':')[0].lower(), argument):
+                return None
+        elif attribute == 'max-age':
+            try:
+                max_age = int(argument)
+            except ValueError:
+                return None
+        elif attribute == 'expires':
+            if argument:
+                cookie.expires = http_headers.parse_http_date(argument)
+        elif attribute == 'secure':
+            cookie.secure = True
+        elif attribute == 'httponly':
+            cookie.httponly = True
+    if max_age is not None:
+        # max-age takes precedence over expires
+        if now is None:
+            now = time.time()
+        cookie.expires = int(now) + max_age
+    if cookie.path is None:
+        cookie.path = default_path(request_path)
+    return cookie
+
+class SetCookieHeaders:
+    '''Set-Cookie headers serialized in advance, standing in
+    for Cookie.SimpleCookie as cherrypy.response.cookie'''
+    
+    def __init__(self, cookies):
+        self.values = [cookie.output() for cookie in cookies]
+    
+    def output(self, attrs=None, header='Set-Cookie:', sep='\r\n'):
+        return sep.join([header + ' ' + value for value in self.values])
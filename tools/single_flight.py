@@ -0,0 +1,61 @@
+import threading, time
+
+class Flight:
+    def __init__(self, key):
+        self.key = key
+        self.started_at = time.time()
+        self.done = threading.Event()
+        self.result = None
+    
+    def wait(self, timeout=None):
+        '''Waits for the leader to finish the flight.
+        
+        Returns True if the flight finished, False if timeout expired first.'''
+        
+        self.done.wait(timeout)
+        return self.done.isSet()
+
+class SingleFlight:
+    '''Registry of in-flight operations keyed by arbitrary hashable keys.
+    
+    The first caller to begin an operation for a key becomes its leader
+    and must eventually finish the flight it was given. Callers beginning
+    the same operation while the leader is still working are handed
+    the leader's flight and may wait on it instead of repeating the work.
+    
+    If max_age is given, flights older than max_age seconds are considered
+    abandoned by their leaders and the next caller takes over.
+    '''
+    
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._flights = {}
+    
+    def begin(self, key):
+        '''Returns a (flight, leader) tuple for key, where leader is True
+        if the caller is responsible for performing the operation'''
+        
+        self._lock.acquire()
+        try:
+            flight = self._flights.get(key)
+            if flight is not None:
+                if self.max_age is None or flight.started_at + self.max_age >= time.time():
+                    return flight, False
+            flight = self._flights[key] = Flight(key)
+            return flight, True
+        finally:
+            self._lock.release()
+    
+    def finish(self, flight, result=None):
+        '''Publishes result to and wakes up everybody waiting on flight'''
+        
+        self._lock.acquire()
+        try:
+            # flight may have been taken over if it took too long
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        finally:
+            self._lock.release()
+        flight.result = result
+        flight.done.set()